@@ -1,12 +1,17 @@
 from __future__ import absolute_import
 import logging
-from collections import defaultdict as ddict
-from itertools import chain
+import multiprocessing
+from collections import defaultdict as ddict, deque
+from heapq import heappush, heappop
+from itertools import chain, takewhile
 
-from mzos.feature import PeakelIndex, Attribution
+from mzos.feature import PeakelIndex2D, CompactPeakel, Attribution, _nearest_by_query
 from mzos.peakel_clusterer import PeakelClusterer
+from mzos.isotopes import ISOTOPES, IsotopesTable
+from mzos.utils import get_nb_jobs
+import numpy as np
 import six
-from six.moves import range
+from six.moves import range, zip
 
 
 class PeakelsAnnotator(object):
@@ -23,25 +28,85 @@ class PeakelsAnnotator(object):
 
     """
 
-    # isotopes to look for
-    ISOTOPES = {1.003355: "Isotope C13",
-                0.997035: "Isotope N15",
-                1.995796: "Isotope S34"}  # 1.997953: "Br79-81"}
+    # isotopes to look for by default, see also `mzos.isotopes.HALOGEN_ISOTOPES`
+    ISOTOPES = ISOTOPES
 
-    def __init__(self, peakels, exp_settings):
+    # name of the method resolving isotopes of a rt cluster
+    ISOTOPES_RESOLVERS = {'legacy': '_find_isotopes',
+                          'graph': '_find_isotopes_by_graph'}
+
+    def __init__(self, peakels, exp_settings, isotopes=None):
         self.peakels = peakels
         self.exp_settings = exp_settings
-        self.index = PeakelIndex(peakels)
+        self.index = PeakelIndex2D(peakels)
+
+        # dict key: mass shift, value: tag
+        self.isotopes = dict(PeakelsAnnotator.ISOTOPES if isotopes is None else isotopes)
+        self._isotopes_tables = {}
 
         self.peakel_clusterer = None
         self.adducts_or_fragments = self.exp_settings.get_mass_to_check()
 
+        # adducts and fragments table as arrays, see `_get_parents_candidates`
+        table = self.exp_settings.get_mass_to_check_table()
+        self.adducts_names = [name for name, _, _, _ in table]
+        self.adducts_charges = [max(abs(charge), 1) for _, _, charge, _ in table]
+        self.adducts_nmols = np.array([nmol for _, nmol, _, _ in table], dtype=np.float64)
+        self.adducts_masses = np.array([mass for _, _, _, mass in table], dtype=np.float64)
+
+    @classmethod
+    def annotate_by_chunks(cls, chunks, exp_settings, **kwargs):
+        """
+        annotate a peaklist read by chunks (see `PeakListReader.iter_peakels`).
+        Each peakel is owned by one chunk, the peakels of the overlap are copies
+        only used as context: charge and attributions of a peakel are the ones found
+        by its owner chunk, isotopes and adducts of a parent are the peakels that
+        their owner chunk attributed to it. A chunk is yielded once no later
+        chunk holds its peakels, relations link the peakels of the yielded chunks.
+
+        :param chunks: iterable of (peakels, core peakels), ids are the same in all chunks
+        :param exp_settings:
+        :param kwargs: passed to `annotate`
+        :return: generator of core peakels, one list per chunk
+        """
+        # core peakels of the chunks not yielded yet
+        pending, peakel_by_id = deque(), {}
+        # parent id: relations found before the chunk owning the parent
+        waiting = ddict(list)
+        for peakels, core in chunks:
+            cls(peakels, exp_settings).annotate(**kwargs)
+            core_ids = {p.id for p in core}
+            relations = [(name, parent.id, child.id) for parent in peakels for name in ('isotopes', 'adducts')
+                         for child in getattr(parent, name) if child.id in core_ids]
+            for p in core:
+                p.isotopes, p.adducts = set(), set()
+                peakel_by_id[p.id] = p
+                for name, child in waiting.pop(p.id, ()):
+                    getattr(p, name).add(child)
+            for name, parent_id, child_id in relations:
+                if parent_id in peakel_by_id:
+                    getattr(peakel_by_id[parent_id], name).add(peakel_by_id[child_id])
+                else:
+                    waiting[parent_id].append((name, peakel_by_id[child_id]))
+
+            # chunks hold contiguous ranges of sorted peakels
+            ids = {p.id for p in peakels}
+            while pending and not any(p.id in ids for p in pending[0]):
+                done = pending.popleft()
+                for p in done:
+                    del peakel_by_id[p.id]
+                yield done
+            pending.append(core)
+        for done in pending:
+            yield done
+
     def set_peakels(self, peakels):
         """
         :param peakels:
         :return:
         """
         self.peakels = peakels
+        self.index = PeakelIndex2D(peakels)
 
     def get_nearest_peakel(self, moz, mz_tol_ppm):
         """
@@ -51,21 +116,48 @@ class PeakelsAnnotator(object):
         """
         return self.index.get_nearest_peakel(moz, mz_tol_ppm)
 
-    @staticmethod
-    def _get_theoritical_isotope_mass(idx, mz, charge):
+    def get_isotopes_table(self, max_charge, max_isotopes_nb):
+        """
+        theoritical isotopes offsets, computed once for each charge and isotopes number
+        :param max_charge:
+        :param max_isotopes_nb:
+        :return: IsotopesTable
         """
-        mean_theo = 1.000857 * j + 0.001091, sigma_theo = 0.0016633 * j - 0.0004571
+        key = (max_charge, max_isotopes_nb)
+        if key not in self._isotopes_tables:
+            self._isotopes_tables[key] = IsotopesTable(self.isotopes, max_charge, max_isotopes_nb)
+        return self._isotopes_tables[key]
 
-        taken form the model FeatureFinderMetabo openms
+    def _get_isotopes_candidates(self, rt_cluster, max_charge, max_isotopes_nb, error_rt):
+        """
+        nearest peakel of all theoritical isotopes masses of a rt cluster,
+        computed for all charges, isotopes indexes and series of offsets
+        (see `IsotopesTable`) in one index lookup
 
-        :param idx:
-        :param mz:
-        :param charge:
-        :return:
+        :param rt_cluster: list of peakels
+        :param max_charge: int
+        :param max_isotopes_nb: int
+        :param error_rt: float
+        :return: array of indexes in the index `sorted_peaks` (-1 if no peakel found),
+        shape (nb peakels, max_charge, max_isotopes_nb)
         """
-        theo_mass = mz + ((1.000857 * idx + 0.001091) / charge)
-        d = {x[1]: abs(theo_mass - (mz + x[0])) for x in list(PeakelsAnnotator.ISOTOPES.items())}
-        return theo_mass, min(d)
+        mozs = np.array([p.moz for p in rt_cluster], dtype=np.float64)
+        rts = np.array([p.rt for p in rt_cluster], dtype=np.float64)
+
+        offsets = self.get_isotopes_table(max_charge, max_isotopes_nb).offsets
+        # shape (nb peakels, max_charge, max_isotopes_nb, nb series), nan where a series has no isotope
+        masses = mozs[:, np.newaxis, np.newaxis, np.newaxis] + offsets[np.newaxis]
+
+        targets, target_rts = masses.ravel(), np.repeat(rts, offsets.size)
+        defined = ~np.isnan(targets)
+        indexes = np.full(len(targets), -1, dtype=np.intp)
+        indexes[defined] = self.index.query_many_in_window(targets[defined], target_rts[defined],
+                                                           self.exp_settings.mz_tol_ppm, error_rt * 0.5)[0]
+        indexes = indexes.reshape(masses.shape)
+        # nearest peakel over the series, the model first on a draw
+        distances = np.where(indexes >= 0, np.abs(self.index.mozs[indexes] - masses), np.inf)
+        best = distances.argmin(axis=-1)
+        return np.take_along_axis(indexes, best[..., np.newaxis], axis=-1)[..., 0]
 
     def _look_for_isotopes(self,
                            peakel,
@@ -73,17 +165,22 @@ class PeakelsAnnotator(object):
                            max_charge,
                            max_gap,
                            max_isotopes_nb,
-                           error_rt):
+                           error_rt,
+                           candidates=None):
         """
         :param peakel: Peakel object peakel to consider
         :param mos_by_iso: dict key:iso, value:set
         :param max_charge: int max charge to check
         :param max_isotopes_nb: int
         :param error_rt: float
+        :param candidates: precomputed indexes of the nearest peakels of this peakel theoritical
+        isotopes, shape (max_charge, max_isotopes_nb), see `_get_isotopes_candidates`
         :return: dict
         """
         moz_tol_ppm = self.exp_settings.mz_tol_ppm
 
+        isotopes_table = self.get_isotopes_table(max_charge, max_isotopes_nb)
+
         half_error_rt = error_rt * 0.5
 
         # will hold set of isotopes
@@ -108,14 +205,25 @@ class PeakelsAnnotator(object):
 
             # iterate over  number of isotopes
             for j in range(1, max_isotopes_nb + 1):
-                # generate all possible masses for this isotopes index
-                mass_to_check, isotope_tag = PeakelsAnnotator._get_theoritical_isotope_mass(j, ref_moz, charge)
+                if candidates is not None and not desc_iso_intensity:
+                    # ref_moz is still the peakel moz, use the precomputed lookup
+                    i = candidates[charge - 1][j - 1]
+                    peak = self.index.sorted_peaks[i] if i >= 0 else None
+                else:
+                    # theoritical masses for this isotopes index, nearest one kept
+                    peak, distance = None, None
+                    for offset, _ in isotopes_table.get_targets(charge, j):
+                        mass_to_check = ref_moz + offset
 
-                # iterate over those generated masses
-                peak = self.get_nearest_peakel(mass_to_check, moz_tol_ppm)
+                        # nearest peakel in moz among those eluting in the rt window, a closer
+                        # peakel in moz but with a wrong rt does not hide a valid isotope
+                        p = self.index.get_nearest_peakel_in_window(mass_to_check, moz_tol_ppm,
+                                                                    peakel.rt, half_error_rt)
+                        if p is not None and (peak is None or abs(p.moz - mass_to_check) < distance):
+                            peak, distance = p, abs(p.moz - mass_to_check)
 
-                # error rt check even we are inside a rt cluster ? pass it into a flag
-                if peak is not None and abs(peak.rt - peakel.rt) < half_error_rt:
+                if peak is not None:
+                    isotope_tag = isotopes_table.get_tag(charge, j, peak.moz - ref_moz)
 
                     if desc_iso_intensity and peak.area > last_iso.area:
                         break
@@ -227,17 +335,20 @@ class PeakelsAnnotator(object):
         # link to a direct parent
         mos_by_iso = ddict(set)
 
-        for peakel in rt_cluster:
+        candidates_by_peakel = self._get_isotopes_candidates(rt_cluster, max_charge, max_isotopes_nb, error_rt)
+
+        for peakel, candidates in zip(rt_cluster, candidates_by_peakel.tolist()):
 
             # if this considered peakel is a previously detected isotope
-            detected_as_iso = True if peakel in list(mos_by_iso.keys()) else False
+            detected_as_iso = peakel in mos_by_iso
 
             result_by_charge = self._look_for_isotopes(peakel,
                                                        mos_by_iso,
                                                        max_charge,
                                                        max_gap,
                                                        max_isotopes_nb,
-                                                       error_rt)
+                                                       error_rt,
+                                                       candidates)
 
             # nothing found
             if not result_by_charge:
@@ -252,7 +363,7 @@ class PeakelsAnnotator(object):
 
             # add annoations to selected isos
             for iso in selected_isos:
-                iso.main_attribution = iso.get_attributions_by_charge()[best_charge_result][0]
+                iso.main_attribution = iso.get_attributions_with_charge(best_charge_result)[0]
 
             if detected_as_iso:
                 # if this considered peakel is a previously detected isotope
@@ -315,8 +426,10 @@ class PeakelsAnnotator(object):
                                                                        parents.difference(best_parents),
                                                                        mos_by_iso,
                                                                        isotopes_clustered)
-                    if i is None:
-                        peakel.set_main_attribution(peakel.get_attributions_by_parent_id()[best_parent.id][0])
+                    # the attribution to the best parent may have been removed by a previous conflict
+                    best_parent_attributions = peakel.get_attributions_with_parent(best_parent.id)
+                    if i is None and best_parent_attributions:
+                        peakel.set_main_attribution(best_parent_attributions[0])
 
             # end if detected as iso
 
@@ -326,11 +439,129 @@ class PeakelsAnnotator(object):
 
         return list(set(rt_cluster).difference(isotopes_clustered)), isotopes_clustered
 
-    def _find_adducts_and_fragments_in_cluster(self, cluster, mz_tol_ppm=10, max_charge=2):
+    def _find_isotopes_by_graph(self, rt_cluster, error_rt=6.0, moz_tol_ppm=10, max_charge=2, max_isotopes_nb=5,
+                                max_gap=0):
+        """
+        same purpose than `_find_isotopes`, conflicts between parents are resolved
+        on the whole graph of the isotopes candidates of the cluster.
+
+        Each peakel gets a chain of isotopes, the longest found over all charges.
+        Chains are accepted from the heaviest (number of isotopes, then area of the
+        monoisotopic peakel), a chain containing a peakel already used by an accepted
+        chain is truncated before this peakel and pushed back with its new weight.
+
+        :param rt_cluster
+        :param error_rt
+        :param moz_tol_ppm
+        :param max_charge
+        :param max_isotopes_nb
+        :param max_gap
+        :return two sets: mos, and isotopes
+        """
+        mos_by_iso = ddict(set)
+        candidates_by_peakel = self._get_isotopes_candidates(rt_cluster, max_charge, max_isotopes_nb, error_rt)
+
+        # heap of (- nb isotopes, - area, position in the cluster, charge, isotopes sorted by moz)
+        chains = []
+        for position, (peakel, candidates) in enumerate(zip(rt_cluster, candidates_by_peakel.tolist())):
+            # add all possible attributions
+            result_by_charge = self._look_for_isotopes(peakel, mos_by_iso, max_charge, max_gap,
+                                                       max_isotopes_nb, error_rt, candidates)
+            if not result_by_charge:
+                continue
+            charge = max(sorted(result_by_charge), key=lambda y: len(result_by_charge[y]))
+            isotopes = sorted(result_by_charge[charge], key=lambda x: x.moz)
+            area = peakel.area if peakel.area == peakel.area else 0.0
+            heappush(chains, (-len(isotopes), -area, position, charge, isotopes))
+
+        mos, isotopes_clustered = set(), set()
+        while chains:
+            nb_isotopes, area, position, charge, isotopes = heappop(chains)
+            peakel = rt_cluster[position]
+            if peakel in isotopes_clustered:
+                continue
+            free = list(takewhile(lambda x: x not in isotopes_clustered and x not in mos, isotopes))
+            if len(free) < len(isotopes):
+                if free:
+                    heappush(chains, (-len(free), area, position, charge, free))
+                continue
+
+            mos.add(peakel)
+            isotopes_clustered.update(isotopes)
+            peakel.isotopes = set(isotopes)
+            peakel.charge = charge
+            for iso in isotopes:
+                for attribution in iso.get_attributions_with_parent(peakel.id):
+                    if attribution.charge == charge:
+                        iso.main_attribution = attribution
+                        break
+
+        return list(set(rt_cluster).difference(isotopes_clustered)), isotopes_clustered
+
+    def _get_isotopes_resolver(self, name):
+        """
+        :param name: key of `ISOTOPES_RESOLVERS`
+        :return: bound method
+        """
+        if name not in PeakelsAnnotator.ISOTOPES_RESOLVERS:
+            raise ValueError("isotopes resolver must be one of {0}, got {1}".format(
+                sorted(PeakelsAnnotator.ISOTOPES_RESOLVERS), name))
+        return getattr(self, PeakelsAnnotator.ISOTOPES_RESOLVERS[name])
+
+    def _get_parents_candidates(self, clusters, mz_tol_ppm=10):
+        """
+        nearest peakel of the parent m/z of each peakel of the clusters for each adduct
+        or fragment, for all clusters in one index lookup. Parents are looked for among
+        the peakels of the same cluster only. The parent m/z of a son of m/z `moz` for an
+        adduct of `nmol` molecules, charge `z` and mass `mass` is (moz * |z| + mass) / nmol
+
+        :param clusters: list of list of peakels
+        :param mz_tol_ppm:
+        :return: list of arrays of indexes in the index `sorted_peaks` (-1 if no peakel found),
+        one per cluster, shape (nb peakels, nb adducts and fragments)
+        """
+        sizes = [len(c) for c in clusters]
+        sons = [p for c in clusters for p in c]
+        if not sons:
+            return [np.full((0, len(self.adducts_names)), -1, dtype=np.intp) for _ in clusters]
+        nb_adducts = len(self.adducts_names)
+        mozs = np.array([p.moz for p in sons], dtype=np.float64)
+        charges = np.array(self.adducts_charges, dtype=np.float64)
+        parent_mozs = (mozs[:, np.newaxis] * charges[np.newaxis, :] + self.adducts_masses) / self.adducts_nmols
+        targets = parent_mozs.ravel()
+        target_clusters = np.repeat(np.repeat(np.arange(len(clusters)), sizes), nb_adducts)
+
+        # a candidate is kept if it belongs to the cluster of the son
+        nb_peakels = len(self.index)
+        members = np.repeat(np.arange(len(clusters)), sizes) * nb_peakels + \
+            np.array(self.index.get_positions(sons), dtype=np.int64)
+        members.sort()
+        queries, indexes, errors = self.index.get_indexes_in_ranges(targets, mz_tol_ppm)
+        keys = target_clusters[queries] * nb_peakels + indexes
+        found = np.searchsorted(members, keys).clip(0, max(len(members) - 1, 0))
+        selected = members[found] == keys if len(members) else np.zeros(len(keys), dtype=bool)
+        queries, indexes, errors = _nearest_by_query(queries[selected], indexes[selected], errors[selected])
+
+        # parent m/z out of the m/z range of the cluster are not looked for
+        min_mozs = np.array([min(p.moz for p in c) if c else np.inf for c in clusters])
+        max_mozs = np.array([max(p.moz for p in c) if c else -np.inf for c in clusters])
+        in_bounds = (targets[queries] >= min_mozs[target_clusters[queries]]) & \
+                    (targets[queries] <= max_mozs[target_clusters[queries]])
+        result = np.full(len(targets), -1, dtype=np.intp)
+        result[queries[in_bounds]] = indexes[in_bounds]
+        return np.split(result.reshape(len(sons), nb_adducts), np.cumsum(sizes)[:-1])
+
+    def _find_adducts_and_fragments_in_cluster(self, cluster, mz_tol_ppm=10, max_charge=2, candidates=None,
+                                               correlations=None, min_corr_intensity=None):
         """
         :param cluster : set of peakels grouped by retention time
         :param mz_tol_ppm: float, mass tolerance
-        :param max_charge: int maximum charge to consider
+        :param max_charge: not used, charges of adducts are given by the adducts table
+        :param candidates: precomputed parents of the cluster peakels, see `_get_parents_candidates`
+        :param correlations: intensity correlations of the cluster peakels, computed
+        if None and needed, see `PeakelClusterer.get_intensity_correlations`
+        :param min_corr_intensity: if not None, minimum intensity correlation between
+        an adduct or fragment and its parent
 
         could return in case mo not found ?
         """
@@ -338,22 +569,27 @@ class PeakelsAnnotator(object):
         # avoid to modify the model using a reference to the parent
         parents_by_son = ddict(list)
 
-        # indexing of the cluster
-        index = PeakelIndex(cluster)
-
-        for peakel in cluster:
-            for charge in range(1, max_charge + 1):
-                #
-                for adds, attr in self.adducts_or_fragments:
-                    mz = peakel.moz / 1 + adds[0]
-                    master_peak = index.get_nearest_peakel(mz, mz_tol_ppm)
-                    # master peak not found
-                    if master_peak is None:
-                        pass
-                    else:
-                        # add possible match son lead to parents
-                        attribution = Attribution(attr, master_peak.id, 1)
-                        parents_by_son[peakel].append((master_peak, attribution))
+        if candidates is None:
+            candidates = self._get_parents_candidates([cluster], mz_tol_ppm)[0]
+
+        position_by_peakel = None
+        if min_corr_intensity is not None:
+            if correlations is None:
+                correlations = PeakelClusterer.get_intensity_correlations(cluster)
+            position_by_peakel = {p: i for i, p in enumerate(cluster)}
+
+        for j, (peakel, row) in enumerate(zip(cluster, candidates.tolist())):
+            for i, parent in enumerate(row):
+                if parent < 0:
+                    continue
+                master_peak = self.index.sorted_peaks[parent]
+                # adduct or fragment not co-varying with its parent across samples
+                if position_by_peakel is not None and \
+                        not correlations[j, position_by_peakel[master_peak]] >= min_corr_intensity:
+                    continue
+                # add possible match son lead to parents
+                attribution = Attribution(self.adducts_names[i], master_peak.id, self.adducts_charges[i])
+                parents_by_son[peakel].append((master_peak, attribution))
 
         # reverse the dictionary
         adducts_by_mo = ddict(list)
@@ -396,21 +632,217 @@ class PeakelsAnnotator(object):
             # for the moment will return the entire list
             return list(cluster)
 
-    def find_adducts_and_fragments(self, clusters):
+    def find_adducts_and_fragments(self, clusters, pool=None, n_jobs=None, correlations=None,
+                                   min_corr_intensity=None):
         """
-        todo could be done using multiprocessing or executor
         wrapper for each clusters
         :param clusters:
+        :param pool: pool of workers built by `_get_pool`, see `_map_payloads`
+        :param n_jobs: None to modify peakels of the clusters in place, otherwise
+        clusters are shipped as payloads to `pool` (or annotated in this process if `pool` is None)
+        :param correlations: list of intensity correlations matrices, one per cluster
+        :param min_corr_intensity: see `_find_adducts_and_fragments_in_cluster`
+        """
+        if min_corr_intensity is not None and correlations is None:
+            correlations = [PeakelClusterer.get_intensity_correlations(x) for x in clusters]
+        if correlations is None:
+            correlations = [None] * len(clusters)
+
+        if n_jobs is None:
+            candidates = self._get_parents_candidates(clusters)
+            return list(chain.from_iterable([self._find_adducts_and_fragments_in_cluster(
+                x, candidates=c, correlations=corr, min_corr_intensity=min_corr_intensity)
+                for x, c, corr in zip(clusters, candidates, correlations)]))
+
+        peakel_by_id = {p.id: p for cluster in clusters for p in cluster}
+        payloads = [PeakelsAnnotator._get_payload(cluster, correlations=corr)
+                    for cluster, corr in zip(clusters, correlations)]
+        best_mos = []
+        for best_mo_ids, relations in self._map_payloads('_find_adducts_and_fragments_in_payload', payloads, pool,
+                                                         {'min_corr_intensity': min_corr_intensity}):
+            for mo_id, frag_id, attrib in relations:
+                frag = peakel_by_id[frag_id]
+                frag.set_main_attribution(Attribution(*attrib))
+                peakel_by_id[mo_id].adducts.add(frag)
+            best_mos.extend(peakel_by_id[i] for i in best_mo_ids)
+        return best_mos
+
+    @staticmethod
+    def _get_payload(cluster, context=(), correlations=None):
+        """
+        compact representation of a cluster sent to the workers
+
+        :param cluster: list of peakels to annotate
+        :param context: list of peakels only used to look for isotopes
+        :param correlations: intensity correlations of the cluster peakels or None
+        :return: tuple ids, mozs, rts, areas, number of peakels of the cluster, correlations
+        """
+        peakels = list(cluster) + list(context)
+        return (np.array([p.id for p in peakels], dtype=np.int64),
+                np.array([p.moz for p in peakels], dtype=np.float64),
+                np.array([p.rt for p in peakels], dtype=np.float64),
+                np.array([p.area for p in peakels], dtype=np.float64),
+                len(cluster),
+                correlations)
+
+    @staticmethod
+    def _get_peakels_from_payload(payload):
+        """
+        :param payload: see `_get_payload`
+        :return: list of CompactPeakel, number of peakels of the cluster
+        """
+        ids, mozs, rts, areas, nb_peakels, _ = payload
+        peakels = []
+        for id_, moz, rt, area in zip(ids.tolist(), mozs.tolist(), rts.tolist(), areas.tolist()):
+            p = CompactPeakel(moz, moz, moz, rt)
+            p.id = id_
+            p.area = area
+            peakels.append(p)
+        return peakels, nb_peakels
+
+    @staticmethod
+    def _get_attribution_state(attrib):
+        """
+        :param attrib: Attribution or None
+        :return: tuple or None
+        """
+        return None if attrib is None else (attrib.attribution, attrib.parent_id, attrib.charge)
+
+    def _find_isotopes_in_payload(self, payload, error_rt=6.0, max_charge=2, max_isotopes_nb=5, max_gap=0,
+                                  isotopes_resolver='legacy'):
+        """
+        run `_find_isotopes` on the cluster of a payload, context peakels are
+        only indexed
+
+        :param payload: see `_get_payload`
+        :param isotopes_resolver: key of `ISOTOPES_RESOLVERS`
+        :return: ids of the peakels that are not isotopes and list
+        of (id, charge, isotopes ids, attributions, main attribution) of the modified peakels,
+        isotopes ids and charge are None for context peakels
+        """
+        peakels, nb_peakels = PeakelsAnnotator._get_peakels_from_payload(payload)
+        self.set_peakels(peakels)
+        cluster = peakels[:nb_peakels]
+        find_isotopes = self._get_isotopes_resolver(isotopes_resolver)
+        less_isotopes = find_isotopes(cluster, error_rt, self.exp_settings.mz_tol_ppm,
+                                      max_charge, max_isotopes_nb, max_gap)[0]
+        states = []
+        for i, p in enumerate(peakels):
+            in_cluster = i < nb_peakels
+            if not in_cluster and not p.attributions and p.main_attribution is None:
+                continue
+            states.append((p.id,
+                           p.charge if in_cluster else None,
+                           sorted(iso.id for iso in p.isotopes) if in_cluster else None,
+                           [PeakelsAnnotator._get_attribution_state(a) for a in p.attributions],
+                           PeakelsAnnotator._get_attribution_state(p.main_attribution)))
+        return [p.id for p in less_isotopes], states
+
+    def _find_adducts_and_fragments_in_payload(self, payload, min_corr_intensity=None):
+        """
+        run `_find_adducts_and_fragments_in_cluster` on the cluster of a payload
+
+        :param payload: see `_get_payload`
+        :param min_corr_intensity: see `_find_adducts_and_fragments_in_cluster`, the
+        correlations of the payload are used
+        :return: ids of the best monoisotopic peakels and list
+        of (parent id, adduct or fragment id, main attribution of the adduct or fragment)
+        """
+        peakels, _ = PeakelsAnnotator._get_peakels_from_payload(payload)
+        self.set_peakels(peakels)
+        best_mos = self._find_adducts_and_fragments_in_cluster(peakels, correlations=payload[5],
+                                                               min_corr_intensity=min_corr_intensity)
+        relations = [(mo.id, frag.id, PeakelsAnnotator._get_attribution_state(frag.main_attribution))
+                     for mo in peakels for frag in sorted(mo.adducts, key=lambda x: x.id)]
+        return [p.id for p in best_mos], relations
+
+    def _get_rt_contexts(self, rt_clusters, error_rt):
+        """
+        peakels of the other clusters eluting in the isotopes rt window of each cluster
+
+        :param rt_clusters:
+        :param error_rt:
+        :return: list of list of peakels
         """
+        half_error_rt = error_rt * 0.5
+        order = np.argsort(self.index.rts, kind='mergesort')
+        rts = self.index.rts[order]
+        contexts = []
+        for rt_cluster in rt_clusters:
+            cluster_rts = [p.rt for p in rt_cluster]
+            start = np.searchsorted(rts, min(cluster_rts) - half_error_rt, side='left')
+            stop = np.searchsorted(rts, max(cluster_rts) + half_error_rt, side='right')
+            members = set(rt_cluster)
+            contexts.append([p for p in (self.index.sorted_peaks[i] for i in order[start:stop].tolist())
+                             if p not in members])
+        return contexts
+
+    def _find_isotopes_by_payloads(self, rt_clusters, pool=None, **kwargs):
+        """
+        `_find_isotopes` of each rt cluster computed on payloads, modifications
+        are merged back in the clusters order
+
+        :param rt_clusters:
+        :param pool: see `_map_payloads`
+        :param kwargs: passed to `_find_isotopes_in_payload`
+        :return: list of list of peakels which are not isotopes
+        """
+        contexts = self._get_rt_contexts(rt_clusters, kwargs.get('error_rt', 6.0))
+        payloads = [PeakelsAnnotator._get_payload(c, ctx) for c, ctx in zip(rt_clusters, contexts)]
+        peakel_by_id = {p.id: p for p in self.peakels}
+
+        less_isotopes = []
+        for less_isotope_ids, states in self._map_payloads('_find_isotopes_in_payload', payloads, pool, kwargs):
+            for id_, charge, isotopes, attributions, main_attribution in states:
+                p = peakel_by_id[id_]
+                for attrib in attributions:
+                    p.attributions.add(Attribution(*attrib))
+                if main_attribution is not None:
+                    p.main_attribution = Attribution(*main_attribution)
+                if isotopes is not None:
+                    p.charge = charge
+                    p.isotopes = {peakel_by_id[i] for i in isotopes}
+            less_isotopes.append([peakel_by_id[i] for i in less_isotope_ids])
+        return less_isotopes
+
+    def _get_pool(self, n_jobs):
+        """
+        :param n_jobs: number of processes, -1 to use all cpus
+        :return: multiprocessing.Pool or None if n_jobs is 1
+        """
+        processes = get_nb_jobs(n_jobs)
+        if n_jobs == 1:
+            return None
+        return multiprocessing.Pool(processes=processes, initializer=_init_worker,
+                                    initargs=(self.exp_settings, self.isotopes))
+
+    def _map_payloads(self, method_name, payloads, pool=None, kwargs=None):
+        """
+        call a payload method of an annotator on each payload, results are in the payloads order
 
-        return list(chain.from_iterable([self._find_adducts_and_fragments_in_cluster(x) for x in clusters]))
+        :param method_name: name of the PeakelsAnnotator method
+        :param payloads: list of payloads, see `_get_payload`
+        :param pool: multiprocessing.Pool initialized with `_init_worker`, None to run in this process
+        :param kwargs: passed to the method
+        :return: list of results
+        """
+        tasks = [(method_name, payload, kwargs or {}) for payload in payloads]
+        if pool is None:
+            annotator = PeakelsAnnotator([], self.exp_settings, self.isotopes)
+            return [_run_payload_task(task, annotator) for task in tasks]
+        return pool.map(_run_payload_task, tasks)
 
     def annotate(self, error_rt=6.0,
                  max_charge=2,
                  max_isotopes_nb=3,
                  max_gap=0,
                  distance_corr_shape=PeakelClusterer.DEFAULT_SHAPE_CORR,
-                 distance_corr_intensity=PeakelClusterer.DEFAULT_INT_CORR):
+                 distance_corr_intensity=PeakelClusterer.DEFAULT_INT_CORR,
+                 n_jobs=None,
+                 isotopes_resolver='legacy',
+                 min_corr_intensity=None,
+                 rt_clust_method=PeakelClusterer.CLUST_METHOD['dbscan'],
+                 dbscan_eps=None):
         """
         Wrapper function around clustering and fragments/adducts
         @param error_rt:
@@ -419,20 +851,78 @@ class PeakelsAnnotator(object):
         @param max_gap:
         @param distance_corr_shape:
         @param distance_corr_intensity:
+        @param n_jobs: number of processes (-1 for all cpus) annotating compact copies of the
+        rt clusters, None or 1 to annotate them in this process. Results are merged back in the
+        clusters order and do not depend on n_jobs. Also the number of threads of the correlation
+        clustering
+        @param isotopes_resolver: 'legacy' resolves conflicts between parents peakel after
+        peakel, 'graph' on the graph of all isotopes candidates of a rt cluster
+        @param min_corr_intensity: if not None, adducts and fragments whose areas correlation
+        with their parent is lower are discarded. Correlations are the ones computed for
+        the intensity clustering
+        @param rt_clust_method: retention time clustering method, see `PeakelClusterer.CLUST_METHOD`
+        @param dbscan_eps: eps of the dbscan rt clustering, defaults to error_rt / 2
         @return:
         """
-        self.peakel_clusterer = PeakelClusterer(self.peakels)
+        # fails before the clustering on a wrong resolver name
+        self._get_isotopes_resolver(isotopes_resolver)
+
+        self.peakel_clusterer = PeakelClusterer(self.peakels, rt_clust_method=rt_clust_method,
+                                                dbscan_eps=dbscan_eps)
         rt_clusters = self.peakel_clusterer.clusterize_by_rt(error_rt=error_rt)
         logging.info('{0} rt clusters found'.format(len(rt_clusters)))
 
-        less_isotopes = []  # will be list of list
-        for rt_cluster in rt_clusters:
-            less_isotopes.append(self._find_isotopes(rt_cluster, error_rt,
-                                                     self.exp_settings.mz_tol_ppm,
-                                                     max_charge, max_isotopes_nb, max_gap)[0])
-
-        curated_clusters = self.peakel_clusterer._check_update_corrs(less_isotopes,
-                                                                     distance_corr_shape,
-                                                                     distance_corr_intensity)
-        best_mos = self.find_adducts_and_fragments(curated_clusters)
+        # rt clusters are annotated on payloads whatever n_jobs, a cluster does
+        # not see the modifications made by the other ones before the merge
+        pool = None if n_jobs is None else self._get_pool(n_jobs)
+        try:
+            less_isotopes = self._find_isotopes_by_payloads(rt_clusters, pool,
+                                                            error_rt=error_rt,
+                                                            max_charge=max_charge,
+                                                            max_isotopes_nb=max_isotopes_nb,
+                                                            max_gap=max_gap,
+                                                            isotopes_resolver=isotopes_resolver)
+
+            correlations = None
+            if min_corr_intensity is None:
+                curated_clusters = self.peakel_clusterer._check_update_corrs(less_isotopes,
+                                                                             distance_corr_shape,
+                                                                             distance_corr_intensity,
+                                                                             n_jobs=n_jobs)
+            else:
+                curated_clusters, correlations = self.peakel_clusterer._check_update_corrs(
+                    less_isotopes, distance_corr_shape, distance_corr_intensity, with_correlations=True,
+                    n_jobs=n_jobs)
+            best_mos = self.find_adducts_and_fragments(curated_clusters, pool, 1 if n_jobs is None else n_jobs,
+                                                       correlations, min_corr_intensity)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         return best_mos
+
+
+# annotator of a worker process, see `_init_worker`
+_worker_annotator = None
+
+
+def _init_worker(exp_settings, isotopes):
+    """
+    initializer of the processes of `PeakelsAnnotator._get_pool`
+    :param exp_settings:
+    :param isotopes:
+    """
+    global _worker_annotator
+    _worker_annotator = PeakelsAnnotator([], exp_settings, isotopes)
+
+
+def _run_payload_task(task, annotator=None):
+    """
+    :param task: tuple method name, payload, kwargs
+    :param annotator: defaults to the annotator of the worker process
+    :return: result of the method
+    """
+    method_name, payload, kwargs = task
+    if annotator is None:
+        annotator = _worker_annotator
+    return getattr(annotator, method_name)(payload, **kwargs)
@@ -1,39 +1,39 @@
 from __future__ import absolute_import
 from collections import defaultdict as ddict
+from heapq import heapify, heappush, heappop
 
 from sklearn.cluster import DBSCAN
 from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import pdist
 import numpy as np
+from six.moves import range
 
 
 def clusterize_basic(peakels, dist_func, *args):
     """
     Provide a basic clustering based on provided functions, kind of agglomerative
-    clustering with mean retention time values for each cluster
+    clustering with mean retention time values for each cluster.
+    Peakels are swept by increasing retention time, a peakel joins the current
+    cluster if its retention time is closer than args[0] / 2 of the running mean
+    of the cluster, otherwise it starts a new cluster. O(n log n)
     :param peakels:
-    :param dist_func: for distance function is a callable
-    :param args:
-    return: list of clusters (as set)
+    :param dist_func: for distance function is a callable, not used
+    :param args: args[0] width of the clusters
+    return: list of clusters (as list), sorted by retention time
     """
     half_width = args[0] * 0.5
     rt_clusters = []
-    peakels_clustered = set()
-    for i, peakel in enumerate(peakels):
-        if peakel in peakels_clustered:
-            continue
-        l = set()
-        l.add(peakel)
-        peakels_clustered.add(peakel)
-
-        for j, peakel_ in enumerate(peakels):
-            if peakel_ not in peakels_clustered and i != j:
-                if abs(np.mean([p.rt for p in l]) - peakel_.rt) < half_width:
-                    l.add(peakel_)
-                    peakels_clustered.add(peakel_)
-
-        rt_clusters.append(list(l))
+    cluster, rt_sum = [], 0.0
+    for peakel in sorted(peakels, key=lambda x: x.rt):
+        if cluster and abs(rt_sum / len(cluster) - peakel.rt) >= half_width:
+            rt_clusters.append(cluster)
+            cluster, rt_sum = [], 0.0
+        cluster.append(peakel)
+        rt_sum += peakel.rt
+    if cluster:
+        rt_clusters.append(cluster)
     return rt_clusters
-    
+
 
 def clusterize_hierarchical(peakels, matrix_dist, cut, clip=False):
     """
@@ -62,17 +62,113 @@ def clusterize_hierarchical(peakels, matrix_dist, cut, clip=False):
     return list(clust_by_id.values())
 
 
+def clusterize_hierarchical_1d(peakels, values, cut, method='complete'):
+    """
+    exact hierarchical clustering of 1-D values with the euclidean distance,
+    same clusters than `clusterize_hierarchical` (but for ties) in O(n log n)
+    time and O(n) memory.
+
+    Clusters of 1-D values are intervals of the sorted values: single linkage
+    splits the sorted values at gaps greater than `cut`, complete linkage merges
+    the two neighbouring intervals with the smallest span while it is not greater than `cut`
+
+    :param peakels:
+    :param values: one value per peakel, e.g. retention times
+    :param cut: distance cut of the dendrogram
+    :param method: 'single' or 'complete'
+    :return: list of clusters (as list), sorted by value
+    """
+    if method not in ('single', 'complete'):
+        raise ValueError("unsupported linkage method: {0}".format(method))
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(values, kind='mergesort')
+    sorted_values = values[order]
+    n = len(values)
+
+    if method == 'single':
+        breaks = np.flatnonzero(np.diff(sorted_values) > cut) + 1
+        return [[peakels[i] for i in group] for group in np.split(order, breaks) if len(group)]
+
+    v = sorted_values.tolist()
+    # intervals of the sorted values, identified by their first index
+    last = list(range(n))
+    next_ = list(range(1, n + 1))
+    prev = list(range(-1, n - 1))
+    alive = [True] * n
+    # span of the union of 2 neighbouring intervals, left, right, last index of right
+    heap = [(v[i + 1] - v[i], i, i + 1, i + 1) for i in range(n - 1)]
+    heapify(heap)
+    while heap:
+        span, left, right, right_last = heappop(heap)
+        if span > cut:
+            break
+        if not (alive[left] and alive[right] and next_[left] == right and last[right] == right_last):
+            # outdated
+            continue
+        last[left] = last[right]
+        alive[right] = False
+        next_[left] = next_[right]
+        if next_[left] < n:
+            prev[next_[left]] = left
+            heappush(heap, (v[last[next_[left]]] - v[left], left, next_[left], last[next_[left]]))
+        if prev[left] >= 0:
+            heappush(heap, (v[last[left]] - v[prev[left]], prev[left], left, last[left]))
+
+    return [[peakels[i] for i in order[first:last[first] + 1].tolist()] for first in range(n) if alive[first]]
+
+
+def get_correlation_distances(values):
+    """
+    condensed correlation distances between the rows of `values`, as
+    expected by `clusterize_hierarchical`. Undefined correlations (constant
+    rows) are given a distance of 1
+    :param values: 2-D array, one row per peakel
+    :return: 1-D array of size n * (n - 1) / 2
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matrix_dist = pdist(np.asarray(values, dtype=np.float64), metric='correlation')
+    matrix_dist[np.isnan(matrix_dist)] = 1.0
+    return matrix_dist
+
+
 def clusterize_dbscan(values, peakels, eps=0.2, min_samples=1):
     """
+    1-D values with min_samples=1 are clustered by `clusterize_dbscan_1d`
     :param values:
     :param peakels:
     :param eps:
     :param min_samples:
     :return:
     """
-    db = DBSCAN(eps=eps, min_samples=min_samples).fit(np.array(values))
+    values = np.array(values)
+    if min_samples == 1 and values.ndim == 2 and values.shape[1] == 1:
+        return clusterize_dbscan_1d(values[:, 0], peakels, eps)
+    db = DBSCAN(eps=eps, min_samples=min_samples).fit(values)
     labels = db.labels_
     clust_by_id = ddict(list)
     for i, label in enumerate(labels):
         clust_by_id[label].append(peakels[i])
-    return list(clust_by_id.values())
\ No newline at end of file
+    return list(clust_by_id.values())
+
+
+def clusterize_dbscan_1d(values, peakels, eps=0.2):
+    """
+    DBSCAN of 1-D values with min_samples=1: every value is a core point, clusters
+    are obtained by splitting the sorted values at gaps greater than `eps`.
+    O(n log n), no neighbours graph. Same clusters, in the same order, than the
+    scikit-learn implementation
+    :param values: 1-D values, e.g. retention times
+    :param peakels:
+    :param eps:
+    :return: list of clusters (as list)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return []
+    order = np.argsort(values, kind='mergesort')
+    labels = np.empty(len(values), dtype=np.int64)
+    labels[order] = np.concatenate([[0], np.cumsum(np.diff(values[order]) > eps)])
+    clust_by_id = ddict(list)
+    for i, label in enumerate(labels.tolist()):
+        clust_by_id[label].append(peakels[i])
+    return list(clust_by_id.values())
@@ -1,12 +1,20 @@
 from __future__ import absolute_import
+import json
 import logging
+import os
 import sqlite3
+from itertools import groupby
+from operator import itemgetter
 import os.path as op
-from itertools import izip
+from six.moves import zip as izip, range
+from six.moves.urllib.request import pathname2url
 import multiprocessing
 
+import numpy as np
+
 from mzos.feature import Annotation
 from mzos.formula import Formula
+from mzos.peak_table import _replace
 import six
 
 
@@ -14,6 +22,8 @@ class MolecularEntity(object):
     """
     Molecular entity
     """
+    __slots__ = ()
+
     def __init__(self):
         self.name = None
 
@@ -42,11 +52,31 @@ class Metabolite(MolecularEntity):
 
     def __init__(self, *args):
         MolecularEntity.__init__(self)
-        for name, value in six.iteritems(dict(izip(Metabolite.COLUMNS, args))):
+        Metabolite.set_columns(self, args)
+
+    @staticmethod
+    def set_columns(entity, values):
+        """
+        :param entity: Metabolite or CompactMetabolite
+        :param values: values of a row of the metabolite table
+        """
+        for name, value in six.iteritems(dict(izip(Metabolite.COLUMNS, values))):
             if name in Metabolite.MAPPING:
-                setattr(self, Metabolite.MAPPING[name], value)
+                setattr(entity, Metabolite.MAPPING[name], value)
             else:
-                setattr(self, name, value)
+                setattr(entity, name, value)
+
+
+class CompactMetabolite(MolecularEntity):
+    """
+    Metabolite entity without instance dictionary
+    """
+    __slots__ = ('name', 'kegg_id', 'hmdb_id', 'lm_id', 'description', 'formula', 'inchi_key', 'mono_mass',
+                 'isotopic_pattern_neg', 'isotopic_pattern_pos', 'average_mass', 'status', 'origin')
+
+    def __init__(self, *args):
+        MolecularEntity.__init__(self)
+        Metabolite.set_columns(self, args)
 
 
 class Lipid(MolecularEntity):
@@ -73,114 +103,726 @@ def get_moz_bounds(feature, for_adduct, mz_tol_ppm):
     return mass, mass - tol_da, mass + tol_da
 
 
+def _select_metabolites(conn, mass, min_mass, max_mass, metabolite_class=Metabolite):
+    """
+    :param conn: sqlite connection to hmdb
+    :return: metabolites having a kegg id in the mass range, nearest first
+    """
+    metabolites = []
+    for row in conn.execute('select * from metabolite where mono_mass >=  ? and mono_mass <= ?', (min_mass, max_mass)):
+        m = metabolite_class(*row)  # Metabolite._make(row)  got warning du to the underscore
+        if m.kegg_id is not None:
+            metabolites.append(m)
+    metabolites.sort(key=lambda _: abs(_.mono_mass - mass))
+    return metabolites
+
+
+def _select_lipids(conn, mass, min_mass, max_mass):
+    """
+    :param conn: sqlite connection to lmsd
+    :return: lipids in the mass range, nearest first
+    """
+    lipids = []
+    for row in conn.execute('select {0} from lipids where EXACT_MASS >= ? and EXACT_MASS <= ?'.format(LIPID_COLUMNS),
+                            (min_mass, max_mass)):
+        lipids.append(make_lipid(row))
+    # todo order by in request
+    lipids.sort(key=lambda _: abs(_.mono_mass - mass))
+    return lipids
+
+
+def get_adducts_masses(features, adducts):
+    """
+    neutral masses searched for each feature and adduct.
+
+    For a Formula, same as `get_moz_bounds`: the formula mass is added to (negative
+    polarity) or removed from (positive polarity) the feature mass.
+    For an adducts table tuple (name, nmol, charge, mass), as in the annotator, the
+    m/z of the [M+H]+ (positive charge) or [M-H]- (negative charge) ion is
+    (moz * |charge| + mass) / nmol, the H1 mass is then removed or added as for
+    the 'H1' formula. Both adducts files follow this convention, e.g. the mass of
+    [M+Na]+ is H - Na and the mass of [M+Cl]- is -(H + Cl). A table adduct is only
+    searched for the features of the polarity of its charge.
+
+    :param features:
+    :param adducts: list of Formula or adducts table tuples
+    :return: 2-D array shape (nb adducts, nb features), nan where an
+    adduct is not searched for a feature
+    """
+    mozs = np.array([f.moz for f in features], dtype=np.float64)
+    feature_masses = mozs * np.array([f.charge for f in features], dtype=np.float64)
+    signs = np.array([1.0 if f.polarity < 0 else -1.0 for f in features])
+    h_mass = Formula.from_str('H1').mono_mass()
+    masses = np.empty((len(adducts), len(features)), dtype=np.float64)
+    for i, adduct in enumerate(adducts):
+        if isinstance(adduct, Formula):
+            masses[i] = feature_masses + signs * adduct.mono_mass()
+        else:
+            _, nmol, charge, mass = adduct
+            masses[i] = (mozs * max(abs(charge), 1) + mass) / nmol + signs * h_mass
+            if charge:
+                # signs are 1.0 for negative features
+                masses[i][signs == (1.0 if charge > 0 else -1.0)] = np.nan
+    return masses
+
+
 def search_metabolites_for(args):
     """
     pickling problem if use inside class
-    :param args: database, feature, with_tol_ppm
+    :param args: database, feature, with_tol_ppm, optionally the metabolite class
     """
     database, feature, formula, with_tol_ppm = args[0], args[1], args[2], args[3]
+    metabolite_class = args[4] if len(args) > 4 else Metabolite
     mass, min_mass, max_mass = get_moz_bounds(feature, formula, with_tol_ppm)
 
     conn = sqlite3.connect(database)
-    c = conn.cursor()
-    metabolites = []
-    for row in c.execute('select * from metabolite where mono_mass >=  ? and mono_mass <= ?', (min_mass, max_mass)):
-        m = Metabolite(*row)  # Metabolite._make(row)  got warning du to the underscore
-        if m.kegg_id is not None:
-            metabolites.append(m)
+    metabolites = _select_metabolites(conn, mass, min_mass, max_mass, metabolite_class)
     conn.close()
-    metabolites.sort(key=lambda _: abs(_.mono_mass - mass))
     return metabolites
 
 
+LIPID_COLUMNS = 'SYSTEMATIC_NAME, FORMULA, EXACT_MASS, LM_ID, KEGG_ID, HMDBID, INCHI_KEY'
+
+
+def make_lipid(row):
+    """
+    :param row: values of the `LIPID_COLUMNS` of a row of the lipids table
+    :return: Lipid
+    """
+    name, chem_formula, exact_mass, lm_id, kegg_id, hmdb_id, inchi = row
+    l = Lipid(lm_id)
+    # warning lmsd names can be empty
+    l.name = name or ''
+    l.mono_mass = exact_mass or ''
+    l.formula = chem_formula or ''
+    l.kegg_id = kegg_id or ''
+    l.hmdb_id = hmdb_id or ''
+    l.inchi_key = inchi or ''
+    return l
+
+
 def search_lipids_for(args):
     database, feature, formula, with_tol_ppm = args  # args[0], args[1], args[2], args[3]
     mass, min_mass, max_mass = get_moz_bounds(feature, formula, with_tol_ppm)
 
     conn = sqlite3.connect(database)
-    c = conn.cursor()
-    lipids = []
-    for row in c.execute('select SYSTEMATIC_NAME, FORMULA, EXACT_MASS, LM_ID, KEGG_ID, HMDBID, INCHI_KEY '
-                         'from lipids where EXACT_MASS >= ? and EXACT_MASS <= ?', (min_mass, max_mass)):
-        name, chem_formula, exact_mass, lm_id, kegg_id, hmdb_id, inchi = row
-        l = Lipid(lm_id)
-        # warning lmsd names can be empty
-        l.name = name or ''
-        l.mono_mass = exact_mass or ''
-        l.formula = chem_formula or ''
-        l.kegg_id = kegg_id or ''
-        l.hmdb_id = hmdb_id or ''
-        l.inchi_key = inchi or ''
-        lipids.append(l)
+    lipids = _select_lipids(conn, mass, min_mass, max_mass)
     conn.close()
-    # todo order by in request
-    lipids.sort(key=lambda _: abs(_.mono_mass - mass))
     return lipids
 
 
+def get_metabolite_maker(metabolite_class=Metabolite):
+    """
+    :param metabolite_class: Metabolite or CompactMetabolite
+    :return: callable building a metabolite from a row of the metabolite
+    table, None for metabolites without kegg id
+    """
+    def make_metabolite(row):
+        m = metabolite_class(*row)
+        return m if m.kegg_id is not None else None
+    return make_metabolite
+
+
+def get_table_description(kind, metabolite_class=Metabolite):
+    """
+    :param kind: 'hmdb' or 'lmsd'
+    :param metabolite_class: Metabolite or CompactMetabolite
+    :return: table, mass column, columns and callable building an entity from the values of the columns
+    """
+    if kind == 'lmsd':
+        return 'lipids', 'EXACT_MASS', LIPID_COLUMNS, make_lipid
+    return 'metabolite', 'mono_mass', '*', get_metabolite_maker(metabolite_class)
+
+
+def has_index_on(conn, table, column):
+    """
+    :param conn: sqlite connection
+    :param table:
+    :param column:
+    :return: True if an index of the table starts with the column
+    """
+    indexes = conn.execute("select name from sqlite_master where type = 'index' and tbl_name = ?",
+                           (table,)).fetchall()
+    for (name,) in indexes:
+        # rows seqno, cid, name, the first one is the leading column
+        info = conn.execute('pragma index_info("{0}")'.format(name)).fetchall()
+        if info and info[0][2] == column:
+            return True
+    return False
+
+
+def bulk_search(database, kind, masses, min_masses, max_masses, metabolite_class=Metabolite):
+    """
+    all the mass ranges are searched in one query: ranges are inserted in a
+    temporary table joined to the table of the database when its masses are
+    indexed (hmdb), to an indexed temporary copy of its masses otherwise (lmsd).
+    Same results than `search_metabolites_for` and `search_lipids_for`
+
+    :param database: sqlite file
+    :param kind: 'hmdb' or 'lmsd'
+    :param masses: searched masses
+    :param min_masses: lower bounds, included
+    :param max_masses: upper bounds, included
+    :param metabolite_class:
+    :return: list of list of entities, one per searched mass, nearest first
+    """
+    table, mass_column, columns, make_entity = get_table_description(kind, metabolite_class)
+    columns = 'e.*' if columns == '*' else columns
+
+    results = [[] for _ in range(len(masses))]
+    conn = connect_read_only(database)
+    try:
+        conn.execute('create temp table bounds (query integer primary key, mass real, min_mass real, max_mass real)')
+        conn.executemany('insert into bounds values (?, ?, ?, ?)',
+                         izip(range(len(masses)), list(masses), list(min_masses), list(max_masses)))
+        # cross joins force the ranges to be the outer loop, using the index on the masses
+        if has_index_on(conn, table, mass_column):
+            query = 'select b.query, {0} from bounds b cross join {1} e ' \
+                    'where e.{2} >= b.min_mass and e.{2} <= b.max_mass ' \
+                    'order by b.query, abs(e.{2} - b.mass), e.rowid'.format(columns, table, mass_column)
+        else:
+            conn.execute('create temp table masses (id integer primary key, mass real)')
+            conn.execute('insert into masses select rowid, {0} from {1} where {0} is not null'.format(mass_column,
+                                                                                                     table))
+            conn.execute('create index temp.masses_mass on masses (mass)')
+            query = 'select b.query, {0} from bounds b cross join masses t cross join {1} e ' \
+                    'where t.mass >= b.min_mass and t.mass <= b.max_mass and e.rowid = t.id ' \
+                    'order by b.query, abs(t.mass - b.mass), t.id'.format(columns, table)
+        for query_id, rows in groupby(conn.execute(query), key=itemgetter(0)):
+            results[query_id] = [e for e in (make_entity(row[1:]) for row in rows) if e is not None]
+    finally:
+        conn.close()
+    return results
+
+
+def connect_read_only(database):
+    """
+    :param database: sqlite file
+    :return: read only sqlite connection, read write on python 2
+    """
+    try:
+        return sqlite3.connect('file:{0}?mode=ro'.format(pathname2url(database)), uri=True)
+    except TypeError:
+        # python 2, no uri argument
+        return sqlite3.connect(database)
+
+
+# sqlite connections of a search worker process by database file, see `_init_search_worker`
+_worker_connections = {}
+
+
+def _init_search_worker(databases):
+    """
+    initializer of the processes of `DatabaseSearch.assign_formula`, opens
+    one read only connection per database
+    :param databases: list of sqlite files
+    """
+    global _worker_connections
+    _worker_connections = {database: connect_read_only(database) for database in databases}
+
+
+def search_in_worker(args):
+    """
+    :param args: kind ('hmdb' or 'lmsd'), database, (mass, min mass, max mass), metabolite class
+    :return: list of Metabolite or Lipid
+    """
+    kind, database, (mass, min_mass, max_mass), metabolite_class = args
+    conn = _worker_connections.get(database)
+    if conn is None:
+        conn = _worker_connections[database] = connect_read_only(database)
+    if kind == 'lmsd':
+        return _select_lipids(conn, mass, min_mass, max_mass)
+    return _select_metabolites(conn, mass, min_mass, max_mass, metabolite_class)
+
+
+class MassIndex(object):
+    """
+    In memory mass index of a database table
+    ========================================
+
+    Masses of a table are loaded once in a sorted array with their row ids, the
+    rows in a mass range are found by a binary search. Entities are only built
+    for the rows hit by a search, each one once.
+
+    :param database: sqlite file
+    :param table:
+    :param mass_column:
+    :param columns: columns passed to `make_entity`, `*` for all columns
+    :param make_entity: callable building an entity from the values of `columns`, None to skip the row
+    :param masses: sorted masses, read from the table if None
+    :param rowids: row ids of the masses
+    """
+    # maximum number of variables of a sqlite query
+    MAX_VARIABLES = 900
+
+    def __init__(self, database, table, mass_column, columns, make_entity, masses=None, rowids=None):
+        self.database = database
+        self.table = table
+        self.mass_column = mass_column
+        self.columns = columns
+        self.make_entity = make_entity
+        # 'hmdb' or 'lmsd', see `for_kind`
+        self.kind = None
+
+        if masses is None:
+            conn = connect_read_only(database)
+            rows = conn.execute('select rowid, {0} from {1} where {0} is not null'.format(mass_column,
+                                                                                       table)).fetchall()
+            conn.close()
+            rowids = np.array([r[0] for r in rows], dtype=np.int64)
+            masses = np.array([r[1] for r in rows], dtype=np.float64)
+            # stable, rows of same mass stay in the table order
+            order = np.lexsort((rowids, masses))
+            masses, rowids = masses[order], rowids[order]
+        self.masses = masses
+        self.rowids = rowids
+        self._entity_by_rowid = {}
+
+    @classmethod
+    def for_kind(cls, kind, database, metabolite_class=Metabolite):
+        """
+        :param kind: 'hmdb' or 'lmsd'
+        :param database: sqlite file
+        :param metabolite_class: Metabolite or CompactMetabolite
+        :return: MassIndex
+        """
+        index = cls(database, *get_table_description(kind, metabolite_class))
+        index.kind = kind
+        return index
+
+    @classmethod
+    def for_hmdb(cls, database, metabolite_class=Metabolite):
+        """
+        :param database: hmdb sqlite file
+        :param metabolite_class: Metabolite or CompactMetabolite
+        :return: MassIndex of the metabolites having a kegg id
+        """
+        return cls.for_kind('hmdb', database, metabolite_class)
+
+    @classmethod
+    def for_lmsd(cls, database):
+        """
+        :param database: lmsd sqlite file
+        :return: MassIndex of the lipids
+        """
+        return cls.for_kind('lmsd', database)
+
+    def __len__(self):
+        return len(self.masses)
+
+    def get_ranges(self, min_masses, max_masses):
+        """
+        :param min_masses: array of lower bounds, included
+        :param max_masses: array of upper bounds, included
+        :return: arrays start, stop of the indexes in `masses` of each range, subclasses
+        may return larger ranges, see `search`
+        """
+        min_masses = np.asarray(min_masses, dtype=np.float64)
+        max_masses = np.asarray(max_masses, dtype=np.float64)
+        # the bounds are sorted once and swept against the masses, much faster
+        # than the binary searches of unordered bounds
+        order = np.argsort(min_masses, kind='mergesort')
+        starts = np.empty(len(order), dtype=np.intp)
+        stops = np.empty(len(order), dtype=np.intp)
+        starts[order] = np.searchsorted(self.masses, min_masses[order], side='left')
+        stops[order] = np.searchsorted(self.masses, max_masses[order], side='right')
+        return starts, np.maximum(starts, stops)
+
+    def get_entities(self, rowids):
+        """
+        :param rowids: list of row ids
+        :return: list of entities (None for skipped rows), built once for each row
+        """
+        missing = sorted(set(rowids).difference(self._entity_by_rowid))
+        if missing:
+            conn = connect_read_only(self.database)
+            for i in range(0, len(missing), self.MAX_VARIABLES):
+                chunk = missing[i:i + self.MAX_VARIABLES]
+                query = 'select rowid, {0} from {1} where rowid in ({2})'.format(self.columns, self.table,
+                                                                                 ','.join('?' * len(chunk)))
+                for row in conn.execute(query, chunk):
+                    self._entity_by_rowid[row[0]] = self.make_entity(row[1:])
+            conn.close()
+        return [self._entity_by_rowid.get(r) for r in rowids]
+
+    def search(self, masses, min_masses, max_masses):
+        """
+        entities of all the mass ranges in one pass, sorted by distance to the
+        searched mass, same results than `search_metabolites_for` and `search_lipids_for`
+
+        :param masses: array of searched masses
+        :param min_masses: array
+        :param max_masses: array
+        :return: list of list of entities, one per searched mass
+        """
+        masses = np.asarray(masses, dtype=np.float64)
+        min_masses = np.asarray(min_masses, dtype=np.float64)
+        max_masses = np.asarray(max_masses, dtype=np.float64)
+        starts, stops = self.get_ranges(min_masses, max_masses)
+        counts = stops - starts
+        queries = np.repeat(np.arange(len(masses)), counts)
+        # indexes in self.masses of all the hits
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        hits = np.repeat(starts, counts) + offsets
+        inside = (self.masses[hits] >= min_masses[queries]) & (self.masses[hits] <= max_masses[queries])
+        if not inside.all():
+            hits, queries = hits[inside], queries[inside]
+            counts = np.bincount(queries, minlength=len(masses))
+        rowids = self.rowids[hits]
+        order = np.lexsort((rowids, np.abs(self.masses[hits] - masses[queries]), queries))
+        entities = self.get_entities(rowids[order].tolist())
+        results = [[] for _ in range(len(masses))]
+        stops = np.cumsum(counts)
+        hit_queries = np.flatnonzero(counts)
+        for query, stop, count in izip(hit_queries.tolist(), stops[hit_queries].tolist(),
+                                       counts[hit_queries].tolist()):
+            results[query] = [e for e in entities[stop - count:stop] if e is not None]
+        return results
+
+
+class BucketMassIndex(MassIndex):
+    """
+    Bucketed mass index
+    ===================
+
+    MassIndex whose masses are also indexed by integer mDa buckets: the offsets
+    of the first mass of each bucket give the candidates of a mass range in
+    O(1), from the buckets of its bounds, without binary search nor sqlite. It is
+    written by `save` (see scripts/mass_index_creator.py) and memory-mapped by `load`.
+
+    :param offsets: index in `masses` of the first mass of each bucket, computed if None
+    :param first_bucket: bucket of the first mass
+    """
+    BUCKETS_PER_DA = 1000
+
+    # suffixes of the files of a saved index
+    PREFIX_SUFFIX = ".buckets"
+    MASSES_SUFFIX = ".masses.npy"
+    ROWIDS_SUFFIX = ".rowids.npy"
+    OFFSETS_SUFFIX = ".offsets.npy"
+    HEADER_SUFFIX = ".header.json"
+
+    def __init__(self, database, table, mass_column, columns, make_entity, masses=None, rowids=None,
+                 offsets=None, first_bucket=0):
+        MassIndex.__init__(self, database, table, mass_column, columns, make_entity, masses, rowids)
+        if offsets is None:
+            buckets = self._get_buckets(self.masses)
+            first_bucket = int(buckets[0]) if len(buckets) else 0
+            last_bucket = int(buckets[-1]) if len(buckets) else -1
+            offsets = np.searchsorted(buckets, np.arange(first_bucket, last_bucket + 2), side='left')
+        self.offsets = offsets
+        self.first_bucket = first_bucket
+
+    @classmethod
+    def _get_buckets(cls, masses):
+        """
+        :param masses: array
+        :return: array of the buckets of the masses
+        """
+        return np.floor(np.asarray(masses, dtype=np.float64) * cls.BUCKETS_PER_DA).astype(np.int64)
+
+    def get_ranges(self, min_masses, max_masses):
+        """
+        :param min_masses: array of lower bounds, included
+        :param max_masses: array of upper bounds, included
+        :return: arrays start, stop of the indexes in `masses` of the buckets
+        of each range, masses out of the bounds are removed by `search`
+        """
+        nb_buckets = len(self.offsets) - 1
+        first = np.clip(self._get_buckets(min_masses) - self.first_bucket, 0, nb_buckets)
+        last = np.clip(self._get_buckets(max_masses) - self.first_bucket + 1, 0, nb_buckets)
+        starts = self.offsets[first]
+        return starts, np.maximum(starts, self.offsets[last])
+
+    @classmethod
+    def get_prefix(cls, database):
+        """
+        :param database: sqlite file
+        :return: default path prefix of the index of the database
+        """
+        return database + cls.PREFIX_SUFFIX
+
+    @staticmethod
+    def get_database_key(database):
+        """
+        :param database: sqlite file
+        :return: dict identifying the version of the database
+        """
+        stat = os.stat(database)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def save(self, prefix):
+        """
+        save the index as raw arrays that can be memory-mapped by `load`. The
+        header is written last, an index without header is considered invalid.
+        :param prefix: path prefix of the written files
+        """
+        for suffix, array in ((self.MASSES_SUFFIX, self.masses), (self.ROWIDS_SUFFIX, self.rowids),
+                              (self.OFFSETS_SUFFIX, self.offsets)):
+            with open(prefix + suffix + ".tmp", 'wb') as f:
+                np.save(f, np.asarray(array))
+            _replace(prefix + suffix + ".tmp", prefix + suffix)
+
+        header = {'database': op.abspath(self.database),
+                  'key': self.get_database_key(self.database),
+                  'kind': self.kind,
+                  'table': self.table,
+                  'mass_column': self.mass_column,
+                  'columns': self.columns,
+                  'first_bucket': self.first_bucket,
+                  'buckets_per_da': self.BUCKETS_PER_DA}
+        with open(prefix + self.HEADER_SUFFIX + ".tmp", 'w') as f:
+            json.dump(header, f)
+        _replace(prefix + self.HEADER_SUFFIX + ".tmp", prefix + self.HEADER_SUFFIX)
+
+    @classmethod
+    def read_header(cls, prefix):
+        """
+        :param prefix: path prefix used in `save`
+        :return: header dict or None if the index does not exist
+        """
+        try:
+            with open(prefix + cls.HEADER_SUFFIX) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @classmethod
+    def load(cls, prefix, database=None, metabolite_class=Metabolite, mmap_mode='r'):
+        """
+        load an index written by `save`, arrays are memory-mapped
+        :param prefix: path prefix used in `save`
+        :param database: sqlite file the entities are read from, defaults to the indexed one
+        :param metabolite_class: Metabolite or CompactMetabolite
+        :param mmap_mode: see numpy.load, None to read arrays in memory
+        :return: BucketMassIndex
+        """
+        header = cls.read_header(prefix)
+        if header is None:
+            raise IOError("no mass index saved at {0}".format(prefix))
+        if header['buckets_per_da'] != cls.BUCKETS_PER_DA:
+            raise ValueError("mass index {0} has {1} buckets per Da, expected {2}".format(
+                prefix, header['buckets_per_da'], cls.BUCKETS_PER_DA))
+        table, mass_column, columns, make_entity = get_table_description(header['kind'], metabolite_class)
+        index = cls(database or header['database'], table, mass_column, columns, make_entity,
+                    masses=np.load(prefix + cls.MASSES_SUFFIX, mmap_mode=mmap_mode),
+                    rowids=np.load(prefix + cls.ROWIDS_SUFFIX, mmap_mode=mmap_mode),
+                    offsets=np.load(prefix + cls.OFFSETS_SUFFIX, mmap_mode=mmap_mode),
+                    first_bucket=header['first_bucket'])
+        index.kind = header['kind']
+        return index
+
+    @classmethod
+    def load_if_up_to_date(cls, database, metabolite_class=Metabolite):
+        """
+        :param database: sqlite file
+        :param metabolite_class: Metabolite or CompactMetabolite
+        :return: BucketMassIndex saved at the default prefix of the database,
+        None if there is none or if the database changed since
+        """
+        prefix = cls.get_prefix(database)
+        header = cls.read_header(prefix)
+        if header is None or header['key'] != cls.get_database_key(database):
+            return None
+        logging.info("Loading mass index {0}".format(prefix))
+        return cls.load(prefix, database, metabolite_class)
+
+
 class DatabaseSearch(object):
     """
     :param bank:
     :param exp_design:
+    :param compact: use CompactMetabolite
+    :param engine: 'sqlite' runs a query per feature and adduct in a pool of processes,
+    'memory' searches all features and adducts in `MassIndex` of the databases,
+    'bulk' runs one query per database for all features and adducts, see `bulk_search`
     """
     HMDB_FILE = op.abspath("mzos/ressources/hmdb.sqlite")
     LMSD_FILE = op.abspath("mzos/ressources/lmsd.sqlite")
 
-    def __init__(self, bank, exp_design):
+    ENGINES = ('sqlite', 'memory', 'bulk')
+
+    def __init__(self, bank, exp_design, compact=False, engine='sqlite'):
+        if engine not in self.ENGINES:
+            raise ValueError("unknown search engine {0}, expected one of {1}".format(engine, self.ENGINES))
+        if bank == 'kegg':
+            # no kegg database is shipped, features would silently not be searched
+            raise ValueError("no kegg database, bank must be 'hmdb', 'lmsd' or 'hmdb + lmsd'")
         self.exp_design = exp_design
+        self.metabolite_class = CompactMetabolite if compact else Metabolite
+        self.engine = engine
+        self._mass_indexes = None
         self.metabolites_by_feature = {}
-        self.bank = 'hmdb' if bank not in {'hmdb', 'kegg', 'lmsd', 'hmdb + lmsd', 'lmsd + hmdb'} else bank  # self.exp_design.databases
+        self.bank = 'hmdb' if bank not in {'hmdb', 'lmsd', 'hmdb + lmsd', 'lmsd + hmdb'} else bank  # self.exp_design.databases
         logging.info("Performing database search in {0} {1}".format(self.bank, 'v3.5'))
 
     def assign_formula(self, features, for_adducts, with_tol_ppm=10.0):
         """
-        assign molecular formula to features using multiprocessing module
+        assign molecular formula to features using multiprocessing module, all
+        features and adducts are searched in one pass
 
-        :param for_adducts: string adducts list
+        :param for_adducts: adducts list, formula strings (e.g. 'H1') or tuples (name, nmol,
+        charge, mass) of an adducts table, see `get_adducts_masses`
         :param features: list or set ? of features
         :param with_tol_ppm: mz tolerance in order to perform the look up
-        :return: dictionary with key: feature, value: list of metabolites
+        :return: number of metabolites found, number of (adduct, feature) without metabolite
         """
-        m_count, not_found = 0, 0
-        for for_adduct in for_adducts:
-            formula = Formula.from_str(for_adduct)
-            logging.info("searching for adducts: {0}".format(str(formula)))
-
-            pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-
-            metabolites = []
-            if self.bank == 'hmdb':
-                args = [(self.HMDB_FILE, f, formula, with_tol_ppm) for f in features]
-                metabolites = pool.map(search_metabolites_for, args, chunksize=20)
-            elif self.bank == 'lmsd':
-                args = [(self.LMSD_FILE, f, formula, with_tol_ppm) for f in features]
-                metabolites = pool.map(search_lipids_for, args, chunksize=20)
-            elif self.bank in {'lmsd + hmdb', 'hmdb + lmsd'}:
-                logging.info('Searching in LMSD...')
-                args_lmsd = [(self.LMSD_FILE, f, formula, with_tol_ppm) for f in features]
-                metabs_lmsd = pool.map(search_lipids_for, args_lmsd, chunksize=20)
-
-                logging.info('Searching in HMDB...')
-                args_hmdb = [(self.HMDB_FILE, f, formula, with_tol_ppm) for f in features]
-                metabs_hmdb = pool.map(search_metabolites_for, args_hmdb, chunksize=20)
-
-                # merge the 2 results set
-                for lmsd_met, hmdb_met in izip(metabs_lmsd, metabs_hmdb):
-                    metabolites.append(lmsd_met + hmdb_met)
-
-            # create Annotation objects
-            for f, metabs in izip(features, metabolites):
-                if not metabs:
-                    not_found += 1
-                else:
-                    m_count += len(metabs)
-                for_adducts_str = '[M{0}{1}]='.format('-' if f.polarity > 0 else '+', formula)
-                f.annotations += [Annotation(m, for_adducts_str) for m in metabs]
-
+        adducts = self._parse_adducts(for_adducts)
+        if self.engine == 'memory':
+            return self._assign_formula_in_memory(features, adducts, with_tol_ppm)
+        if self.engine == 'bulk':
+            return self._assign_formula_bulk(features, adducts, with_tol_ppm)
+
+        databases = self.get_databases()
+        if not databases or not features:
+            return 0, 0
+
+        searched, masses, min_masses, max_masses = self._get_bounds(features, adducts, with_tol_ppm)
+        # only the mass bounds are sent to the workers, results come back in the same order
+        bounds = list(izip(masses.tolist(), min_masses.tolist(), max_masses.tolist()))
+        # one pool for all adducts and databases, workers keep their connections
+        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count(), initializer=_init_search_worker,
+                                    initargs=([database for _, database in databases],))
+        try:
+            results = []
+            for kind, database in databases:
+                logging.info('Searching in {0}...'.format(kind.upper()))
+                args = [(kind, database, b, self.metabolite_class) for b in bounds]
+                results.append(pool.map(search_in_worker, args, chunksize=20))
+        finally:
             pool.close()
-            try:
-                pool.terminate()
-            except OSError:
-                # seen error on windows OS
-                pass
+            pool.join()
+        return self._add_annotations(features, adducts, searched, results)
+
+    def assign_formula_by_chunks(self, chunks, for_adducts, with_tol_ppm=10.0):
+        """
+        `assign_formula` on a peaklist read by chunks, e.g. the chunks yielded by
+        `PeakelsAnnotator.annotate_by_chunks`, only one chunk is searched at once
+
+        :param chunks: iterable of lists of features, each feature in one chunk
+        :param for_adducts: see `assign_formula`
+        :param with_tol_ppm:
+        :return: generator of (features, number of metabolites found, number of
+        (adduct, feature) without metabolite), one per chunk
+        """
+        for features in chunks:
+            m_count, not_found = self.assign_formula(features, for_adducts, with_tol_ppm)
+            yield features, m_count, not_found
+
+    def get_databases(self):
+        """
+        :return: list of (kind, sqlite file) of the bank databases, in the order
+        their results are merged
+        """
+        if self.bank == 'hmdb':
+            return [('hmdb', self.HMDB_FILE)]
+        elif self.bank == 'lmsd':
+            return [('lmsd', self.LMSD_FILE)]
+        return [('lmsd', self.LMSD_FILE), ('hmdb', self.HMDB_FILE)]
+
+    def get_mass_indexes(self):
+        """
+        :return: list of MassIndex of the bank databases, in the order
+        their results are merged, loaded once. Bucket indexes are used when up to date
+        """
+        if self._mass_indexes is None:
+            self._mass_indexes = []
+            for kind, database in self.get_databases():
+                # precomputed index written by scripts/mass_index_creator.py
+                index = BucketMassIndex.load_if_up_to_date(database, self.metabolite_class)
+                self._mass_indexes.append(index or MassIndex.for_kind(kind, database, self.metabolite_class))
+        return self._mass_indexes
+
+    @staticmethod
+    def _parse_adducts(for_adducts):
+        """
+        :param for_adducts: see `assign_formula`
+        :return: list of Formula or adducts table tuples
+        """
+        adducts = [Formula.from_str(a) if isinstance(a, six.string_types) else tuple(a) for a in for_adducts]
+        logging.info("searching for adducts: {0}".format(", ".join(DatabaseSearch._get_adduct_name(a)
+                                                                     for a in adducts)))
+        return adducts
+
+    @staticmethod
+    def _get_adduct_name(adduct, feature=None):
+        """
+        :param adduct: Formula or adducts table tuple
+        :param feature: None for the name of the adduct only
+        :return: string, annotation tag
+        """
+        if isinstance(adduct, Formula):
+            if feature is None:
+                return str(adduct)
+            return '[M{0}{1}]='.format('-' if feature.polarity > 0 else '+', adduct)
+        return adduct[0]
+
+    @staticmethod
+    def _get_bounds(features, adducts, with_tol_ppm):
+        """
+        see `get_moz_bounds` and `get_adducts_masses`
+        :param adducts: list of Formula or adducts table tuples
+        :return: indexes adduct index * nb features + feature index of the searched
+        (adduct, feature), adduct after adduct, and their arrays masses, min masses, max masses
+        """
+        masses = get_adducts_masses(features, adducts).ravel()
+        searched = np.flatnonzero(~np.isnan(masses))
+        masses = masses[searched]
+        tol_da = masses * with_tol_ppm / 1e6
+        return searched, masses, masses - tol_da, masses + tol_da
+
+    @staticmethod
+    def _add_annotations(features, adducts, searched, results):
+        """
+        create Annotation objects
+        :param features:
+        :param adducts: list of Formula or adducts table tuples
+        :param searched: indexes of the searched (adduct, feature), see `_get_bounds`
+        :param results: one list per database of lists of metabolites of the searched
+        (adduct, feature), merged in the databases order
+        :return: number of metabolites found, number of searched (adduct, feature) without metabolite
+        """
+        m_count, not_found = 0, 0
+        features = list(features)
+        n = len(features)
+        for k, index in enumerate(searched.tolist()):
+            i, j = divmod(index, n)
+            metabs = [m for result in results for m in result[k]]
+            if not metabs:
+                not_found += 1
+                continue
+            m_count += len(metabs)
+            f = features[j]
+            for_adducts_str = DatabaseSearch._get_adduct_name(adducts[i], f)
+            f.annotations += [Annotation(m, for_adducts_str) for m in metabs]
         return m_count, not_found
+
+    def _assign_formula_in_memory(self, features, adducts, with_tol_ppm=10.0):
+        """
+        same as `assign_formula`, all features and adducts are searched in one pass
+        :param adducts: list of Formula or adducts table tuples
+        :return: number of metabolites found, number of (adduct, feature) without metabolite
+        """
+        mass_indexes = self.get_mass_indexes()
+        if not mass_indexes or not features:
+            return 0, 0
+        searched, masses, min_masses, max_masses = self._get_bounds(features, adducts, with_tol_ppm)
+        results = [index.search(masses, min_masses, max_masses) for index in mass_indexes]
+        return self._add_annotations(features, adducts, searched, results)
+
+    def _assign_formula_bulk(self, features, adducts, with_tol_ppm=10.0):
+        """
+        same as `assign_formula`, one query per database, see `bulk_search`
+        :param adducts: list of Formula or adducts table tuples
+        :return: number of metabolites found, number of (adduct, feature) without metabolite
+        """
+        databases = self.get_databases()
+        if not databases or not features:
+            return 0, 0
+        searched, masses, min_masses, max_masses = self._get_bounds(features, adducts, with_tol_ppm)
+        results = []
+        for kind, database in databases:
+            logging.info('Searching in {0}...'.format(kind.upper()))
+            results.append(bulk_search(database, kind, masses.tolist(), min_masses.tolist(), max_masses.tolist(),
+                                       self.metabolite_class))
+        return self._add_annotations(features, adducts, searched, results)
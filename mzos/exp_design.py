@@ -44,8 +44,9 @@ class ExperimentalSettings(object):
 
         # setting good frags_file
         self.frags_file = frag_conf or ExperimentalSettings.FRAGMENTS
-        self.adducts_file = neg_adducts_conf or ExperimentalSettings.ADDUCTS_NEG \
-            if polarity == IONISATION_MODE.NEG else pos_adducts_conf or ExperimentalSettings.ADDUCTS_POS
+        self.neg_adducts_file = neg_adducts_conf or ExperimentalSettings.ADDUCTS_NEG
+        self.pos_adducts_file = pos_adducts_conf or ExperimentalSettings.ADDUCTS_POS
+        self.adducts_file = self.neg_adducts_file if polarity == IONISATION_MODE.NEG else self.pos_adducts_file
 
     def get_frags(self):
         """
@@ -73,6 +74,36 @@ class ExperimentalSettings(object):
             return self.get_frags()
         return self.get_adducts() + self.get_frags()
 
+    @staticmethod
+    def _read_mass_table(filepath):
+        """
+        :param filepath: csv file with name, nmol, charge, mass columns
+        :return: list of tuples (name, nmol, charge, mass)
+        """
+        with open(filepath) as f:
+            lines = [l.rstrip().split(",") for l in f.readlines()[1:] if l.strip()]
+        return [(l[0], int(l[1]), int(l[2]), float(l[3])) for l in lines]
+
+    def get_adducts_table(self, polarity=None):
+        """
+        :param polarity: IONISATION_MODE of the adducts file, default the experiment one
+        :return: list of tuples (name, nmol, charge, mass) of the adducts file
+        """
+        if polarity is None:
+            return self._read_mass_table(self.adducts_file)
+        return self._read_mass_table(self.neg_adducts_file if polarity == IONISATION_MODE.NEG
+                                     else self.pos_adducts_file)
+
+    def get_mass_to_check_table(self):
+        """
+        same entries than `get_mass_to_check`, with the number of molecules
+        and the charge of each adduct or fragment
+        :return: list of tuples (name, nmol, charge, mass)
+        """
+        if self.is_dims_exp:
+            return self._read_mass_table(self.frags_file)
+        return self.get_adducts_table() + self._read_mass_table(self.frags_file)
+
     def create_group(self, id_, samples):
         """
         :param id_:
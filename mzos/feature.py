@@ -1,9 +1,12 @@
 from __future__ import absolute_import
 from itertools import count
-from itertools import groupby
-from collections import defaultdict as ddict
+from bisect import bisect_left
+from math import floor
+import time
 import numpy as np
+import six
 from six.moves import range
+from six.moves.collections_abc import Mapping
 
 
 class Peak(object):
@@ -13,6 +16,73 @@ class Peak(object):
         self.intensity = intensity
 
 
+class SampleAreaMatrix(object):
+    """
+    Experiment-wide matrix of areas, one row per sample
+    and one column per peakel
+
+    :param values: 2-D array shape (nb samples, nb peakels), stored as float32,
+    memory-mapped arrays are wrapped without copy
+    :param sample_names: list of sample names, same order than values rows
+    """
+    def __init__(self, values, sample_names):
+        if not isinstance(values, np.memmap):
+            values = np.asarray(values, dtype=np.float32)
+        self.values = values
+        self.sample_names = list(sample_names)
+        self.index_by_sample = {s: i for i, s in enumerate(self.sample_names)}
+
+    def get_areas(self, index):
+        """
+        :param index: column of the peakel
+        :return: array, areas of all samples
+        """
+        return self.values[:, index]
+
+    def get_area(self, sample, index):
+        """
+        :param sample: sample name
+        :param index: column of the peakel
+        :return: float
+        """
+        return float(self.values[self.index_by_sample[sample], index])
+
+
+class SampleAreas(Mapping):
+    """
+    read-only dict-like view of the areas of one peakel
+    in a SampleAreaMatrix, key: sample name, value: area
+    """
+    __slots__ = ('matrix', 'index')
+
+    def __init__(self, matrix, index):
+        self.matrix = matrix
+        self.index = index
+
+    def __getitem__(self, sample):
+        return self.matrix.get_area(sample, self.index)
+
+    def __iter__(self):
+        return iter(self.matrix.sample_names)
+
+    def __len__(self):
+        return len(self.matrix.sample_names)
+
+
+def get_areas_matrix(peakels):
+    """
+    areas of several peakels, using array slices when they share
+    the same SampleAreaMatrix
+    :param peakels: list of peakels
+    :return: 2-D array, one row per peakel, one column per sample
+    """
+    matrix = peakels[0].area_matrix
+    if matrix is not None and all(p.area_matrix is matrix for p in peakels):
+        return matrix.values[:, [p.area_index for p in peakels]].T
+    samples = list(peakels[0].area_by_sample_name.keys())
+    return np.array([[p.area_by_sample_name[s] for s in samples] for p in peakels], dtype=np.float64)
+
+
 class Attribution(object):
     """
     Object corresponding to one possible attribution
@@ -20,6 +90,8 @@ class Attribution(object):
     one of the following tag: isotope, adduct, or monoisotope.
     tag corresponds to the peak kind identification
     """
+    __slots__ = ('attribution', 'parent_id', 'charge')
+
     def __init__(self, attribution, parent_id, charge):
 
         assert(isinstance(attribution, str))
@@ -30,6 +102,148 @@ class Attribution(object):
     def __str__(self):
         return "{0} of {1} for charge={2}".format(self.attribution, self.parent_id, self.charge)
 
+    def __eq__(self, other):
+        return isinstance(other, Attribution) and \
+            (self.attribution, self.parent_id, self.charge) == (other.attribution, other.parent_id, other.charge)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # ints only, the iteration order of attributions sets does not depend on the process
+        return hash((self.parent_id, self.charge))
+
+
+class AttributionSet(object):
+    """
+    Set of the attributions of a peakel, iterated in insertion order.
+    Attributions are also indexed by parent id and by charge once the
+    set holds more than `INDEX_MIN_SIZE` attributions, smaller sets are
+    scanned.
+
+    :param attributions: iterable of Attribution
+    """
+    __slots__ = ('_attributions', '_by_parent_id', '_by_charge')
+
+    # most peakels have a few attributions, not worth two dicts
+    INDEX_MIN_SIZE = 8
+
+    def __init__(self, attributions=()):
+        # insertion order
+        self._attributions = []
+        # key: parent id or charge, value: list of Attribution, None while the set is small
+        self._by_parent_id = None
+        self._by_charge = None
+        for attrib in attributions:
+            self.add(attrib)
+
+    def _index(self, attrib):
+        """
+        :param attrib: Attribution
+        """
+        self._by_parent_id.setdefault(attrib.parent_id, []).append(attrib)
+        self._by_charge.setdefault(attrib.charge, []).append(attrib)
+
+    def add(self, attrib):
+        """
+        :param attrib: Attribution
+        """
+        if attrib in self:
+            return
+        self._attributions.append(attrib)
+        if self._by_parent_id is not None:
+            self._index(attrib)
+        elif len(self._attributions) > self.INDEX_MIN_SIZE:
+            self._by_parent_id, self._by_charge = {}, {}
+            for a in self._attributions:
+                self._index(a)
+
+    def remove(self, attrib):
+        """
+        :param attrib: Attribution, raise a KeyError if not in the set
+        """
+        if attrib not in self:
+            raise KeyError(attrib)
+        self._attributions.remove(attrib)
+        if self._by_parent_id is None:
+            return
+        for index, key in ((self._by_parent_id, attrib.parent_id), (self._by_charge, attrib.charge)):
+            group = index[key]
+            group.remove(attrib)
+            if not group:
+                del index[key]
+
+    def discard(self, attrib):
+        """
+        :param attrib: Attribution
+        """
+        if attrib in self:
+            self.remove(attrib)
+
+    def with_parent_id(self, parent_id):
+        """
+        :param parent_id:
+        :return: list of attributions of this parent, in insertion order
+        """
+        if self._by_parent_id is None:
+            return [a for a in self._attributions if a.parent_id == parent_id]
+        return list(self._by_parent_id.get(parent_id, ()))
+
+    def with_charge(self, charge):
+        """
+        :param charge:
+        :return: list of attributions for this charge, in insertion order
+        """
+        if self._by_charge is None:
+            return [a for a in self._attributions if a.charge == charge]
+        return list(self._by_charge.get(charge, ()))
+
+    def by_parent_id(self):
+        """
+        :return: dict key: parent id, value: list of attributions
+        """
+        if self._by_parent_id is None:
+            return self._group_by(lambda a: a.parent_id)
+        return {k: list(v) for k, v in six.iteritems(self._by_parent_id)}
+
+    def by_charge(self):
+        """
+        :return: dict key: charge, value: list of attributions
+        """
+        if self._by_charge is None:
+            return self._group_by(lambda a: a.charge)
+        return {k: list(v) for k, v in six.iteritems(self._by_charge)}
+
+    def _group_by(self, key):
+        """
+        :param key: callable
+        :return: dict key: result of key, value: list of attributions in insertion order
+        """
+        groups = {}
+        for a in self._attributions:
+            groups.setdefault(key(a), []).append(a)
+        return groups
+
+    def __contains__(self, attrib):
+        if self._by_parent_id is None:
+            return attrib in self._attributions
+        return attrib in self._by_parent_id.get(getattr(attrib, 'parent_id', None), ())
+
+    def __iter__(self):
+        return iter(self._attributions)
+
+    def __len__(self):
+        return len(self._attributions)
+
+    def __getstate__(self):
+        return list(self._attributions)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return "AttributionSet([{0}])".format(", ".join(str(a) for a in self))
+
 
 class Annotation(object):
     """
@@ -42,6 +256,8 @@ class Annotation(object):
                '-Cl': '[M-Cl]'
                }
 
+    __slots__ = ('metabolite', 'score_isos', 'score_network', 'for_adduct')
+
     def __init__(self,
                  metabolite,
                  for_adduct,
@@ -62,15 +278,27 @@ class Annotation(object):
         return 'S' in self.metabolite.formula
 
 
-class Peakel(object):
+class BasePeakel(object):
     """
-    peakel or elution peak
+    peakel or elution peak, common implementation of
+    `Peakel` and `CompactPeakel`
     """
 
+    __slots__ = ()
+
     ADDUCTS_MASS = {'H': 1.007276}
 
     _ids = count(1)
 
+    @staticmethod
+    def skip_ids(last_id):
+        """
+        ids of the peakels created afterwards are greater than last_id,
+        used when ids are set from the peaklist row numbers
+        :param last_id:
+        """
+        BasePeakel._ids = count(max(next(BasePeakel._ids), last_id + 1))
+
     def __init__(self, moz, mozmin, mozmax, rt, rtmin=0, rtmax=0):
         """
         moz :calculated moz
@@ -80,11 +308,15 @@ class Peakel(object):
         rtmax : maxrt               
         """
         # used in __hash__
-        self.id = next(Peakel._ids)
+        self.id = next(BasePeakel._ids)
 
-        # all seen areas
-        self.area_by_sample_name = {}
-        self.area = self.get_median_area()
+        # all seen areas, either in a dict or in a
+        # column of a matrix shared by all peakels
+        self._area_by_sample_name = {}
+        self.area_matrix = None
+        self.area_index = None
+        # median of no areas
+        self.area = float('nan')
 
         # not set yet
         self.polarity = 0
@@ -99,25 +331,29 @@ class Peakel(object):
         # by default
         self.charge = 1
 
-        # could be in a feature object
-        self.isotopes = set()
-        self.adducts = set()
-
         # chemical formula
         self.main_annotation = ""
-        self.annotations = []
 
         # None here means monoisotopic
         self.main_attribution = None
-        self.attributions = set()
-
-        self.ip_score_isotopes = set()
 
         # in concordance with the main tag
         self.is_isotope = False
         self.is_adduct_or_fragment = False
 
-        ##
+        self._init_containers()
+
+    def _init_containers(self):
+        """
+        isotopes, adducts (and fragments), annotations, attributions,
+        ip_score_isotopes and peaks of a new peakel
+        """
+        # could be in a feature object
+        self.isotopes = set()
+        self.adducts = set()
+        self.annotations = []
+        self.attributions = AttributionSet()
+        self.ip_score_isotopes = set()
         self.peaks = []
 
     def get_metabolites(self):
@@ -135,13 +371,13 @@ class Peakel(object):
         if son is not self:
             attrib = ""
             try:
-                attrib += son.get_attributions_by_parent_id()[parent.id][0].attribution
-            except KeyError:  # see index error
+                attrib += son.get_attributions_with_parent(parent.id)[0].attribution
+            except IndexError:
                 attrib += son.main_attribution.attribution
 
             s += str(son.id) + "=" + attrib
 
-        isos = {si for si in son.isotopes if si.get_attributions_by_parent_id()[son.id][0].charge == charge}
+        isos = {si for si in son.isotopes if si.get_attributions_with_parent(son.id)[0].charge == charge}
         n_ = isos.union(son.adducts)
         nb_isos, nb_adducts = len(isos), len(son.adducts)
 
@@ -211,38 +447,52 @@ class Peakel(object):
     def get_attributions_by(self, callable_):
         """
         @param callable_:
-        @return:
+        @return: dict key: result of callable_, value: list of attributions
         """
-        return {k: list(v) for k, v in groupby(self.attributions, callable_)}
+        attributions_by = {}
+        for a in self.attributions:
+            attributions_by.setdefault(callable_(a), []).append(a)
+        return attributions_by
 
     def get_attributions_by_parent_id(self):
         """
         :return:
         """
-        return self.get_attributions_by(lambda x: x.parent_id)
+        return self.attributions.by_parent_id()
 
     def get_attributions_by_charge(self):
         """
         :return:
         """
-        return {k: list(v) for k, v in groupby(self.attributions, lambda x: x.charge)}
+        return self.attributions.by_charge()
+
+    def get_attributions_with_parent(self, parent_id):
+        """
+        @param parent_id:
+        @return: list, could be empty
+        """
+        return self.attributions.with_parent_id(parent_id)
+
+    def get_attributions_with_charge(self, charge):
+        """
+        @param charge:
+        @return: list, could be empty
+        """
+        return self.attributions.with_charge(charge)
 
     def remove_attribution_with_parent(self, parent_id):
         """
         @param parent_id:
         @return:
         """
-        attr = None
-        for a in self.attributions:
-            if a.parent_id == parent_id:
-                attr = a
-                break
-        if attr is not None:
+        attributions = self.attributions.with_parent_id(parent_id)
+        if attributions:
+            attr = attributions[0]
             self.attributions.remove(attr)
             if self.main_attribution == attr:
                 self.main_attribution = None
                 if self.attributions:
-                    self.main_attribution = list(self.attributions)[0]  # the next one ?
+                    self.main_attribution = next(iter(self.attributions))  # the next one ?
 
     def add_attribution(self, attrib):
         """
@@ -272,10 +522,56 @@ class Peakel(object):
         if m is not None and m not in self.attributions:
             self.attributions.add(m)
 
+    def __hash__(self):
+        # peakels sets are iterated in the same order whatever the process
+        return self.id
+
+    def __getstate__(self):
+        """
+        the shared areas matrix is not pickled, areas
+        of this peakel are copied in a dict instead
+        """
+        try:
+            state = dict(self.__dict__)
+        except AttributeError:
+            state = {k: getattr(self, k) for k in self.__slots__ if hasattr(self, k)}
+        if state.get('area_matrix') is not None:
+            state['_area_by_sample_name'] = dict(self.area_by_sample_name)
+            state['area_matrix'], state['area_index'] = None, None
+        return state
+
+    def __setstate__(self, state):
+        for k, v in six.iteritems(state):
+            setattr(self, k, v)
+
+    @property
+    def area_by_sample_name(self):
+        """
+        :return: dict-like, key: sample name, value: area
+        """
+        if self.area_matrix is not None:
+            return SampleAreas(self.area_matrix, self.area_index)
+        return self._area_by_sample_name
+
+    @area_by_sample_name.setter
+    def area_by_sample_name(self, areas):
+        self._area_by_sample_name = areas
+        self.area_matrix, self.area_index = None, None
+
+    def set_area_matrix(self, matrix, index):
+        """
+        :param matrix: SampleAreaMatrix shared by all peakels
+        :param index: column of this peakel in the matrix
+        """
+        self.area_matrix, self.area_index = matrix, index
+        self._area_by_sample_name = None
+
     def get_areas(self):
         """
         :return:
         """
+        if self.area_matrix is not None:
+            return self.area_matrix.get_areas(self.area_index)
         return list(self.area_by_sample_name.values())
 
     def get_median_area(self):
@@ -289,6 +585,8 @@ class Peakel(object):
         @param peakel:
         @return:
         """
+        if self.area_matrix is not None and self.area_matrix is peakel.area_matrix:
+            return np.corrcoef(self.get_areas(), peakel.get_areas())[1, 0]
         values = [peakel.area_by_sample_name[k] for k in list(self.area_by_sample_name.keys())]
         return np.corrcoef(list(self.area_by_sample_name.values()), values)[1, 0]
 
@@ -318,10 +616,65 @@ class Peakel(object):
 
     def get_real_mass(self, adducts=None):
         m = self.moz * self.charge
-        charge_mass = self.charge * (adducts or Peakel.ADDUCTS_MASS['H'])
+        charge_mass = self.charge * (adducts or BasePeakel.ADDUCTS_MASS['H'])
         return m + charge_mass if self.polarity < 0 else m - charge_mass
 
 
+class Peakel(BasePeakel):
+    """
+    peakel or elution peak
+    """
+
+
+class _LazyContainer(object):
+    """
+    container attribute of a `CompactPeakel` stored in a slot, None
+    until the first access which creates an empty container
+    :param slot: name of the slot
+    :param factory: callable returning an empty container
+    """
+    def __init__(self, slot, factory):
+        self.slot = slot
+        self.factory = factory
+
+    def __get__(self, peakel, owner):
+        if peakel is None:
+            return self
+        value = getattr(peakel, self.slot)
+        if value is None:
+            value = self.factory()
+            setattr(peakel, self.slot, value)
+        return value
+
+    def __set__(self, peakel, value):
+        setattr(peakel, self.slot, value)
+
+
+class CompactPeakel(BasePeakel):
+    """
+    peakel without instance dictionary, same public api than `Peakel`
+    but attributes can not be added dynamically. Containers are created
+    at their first access, most peakels of a peaklist never use some of them
+    """
+
+    __slots__ = ('id', '_area_by_sample_name', 'area_matrix', 'area_index', 'area', 'polarity',
+                 'moz', 'mozmin', 'mozmax', 'rt', 'rtmin', 'rtmax', 'charge',
+                 '_isotopes', '_adducts', 'main_annotation', '_annotations',
+                 'main_attribution', '_attributions', '_ip_score_isotopes',
+                 'is_isotope', 'is_adduct_or_fragment', '_peaks')
+
+    isotopes = _LazyContainer('_isotopes', set)
+    adducts = _LazyContainer('_adducts', set)
+    annotations = _LazyContainer('_annotations', list)
+    attributions = _LazyContainer('_attributions', AttributionSet)
+    ip_score_isotopes = _LazyContainer('_ip_score_isotopes', set)
+    peaks = _LazyContainer('_peaks', list)
+
+    def _init_containers(self):
+        self._isotopes, self._adducts, self._annotations = None, None, None
+        self._attributions, self._ip_score_isotopes, self._peaks = None, None, None
+
+
 class Feature(object):
     """
     :param mono_mz:
@@ -337,34 +690,85 @@ class Feature(object):
 
 class PeakelIndex(object):
     """
+    Index of peakels sorted by moz, nearest peakels are
+    found by binary search
+
     :param peakels:
     :param scan_ids:
-    :param bin_size:
+    :param bin_size: not used anymore, kept for compatibility
     """
     mozgetter = staticmethod(lambda x: x.moz)
 
+    # construction statistics of all indexes, see `get_profiling_summary`
+    PROFILE = {'indexes': 0, 'views': 0, 'seconds': 0.0}
+
     def __init__(self, peakels, scan_ids=None, bin_size=1):
         """
         peakels: list of peakels taken from the output of xcms
         scanid
         bin_size : size of one bin in mz dimension
         """
+        t = time.time()
         self.scan_ids = scan_ids
-        self._index = ddict(list)
-        self.inv_bin_size = 1.0 / bin_size
 
         self.sorted_peaks = sorted(peakels, key=lambda x: x.moz)
-        self.min_moz, self.max_moz = self.sorted_peaks[0].moz, self.sorted_peaks[-1].moz
+        self._mozs = [p.moz for p in self.sorted_peaks]
+        self.mozs = np.array(self._mozs, dtype=np.float64)
+        self.min_moz, self.max_moz = (self._mozs[0], self._mozs[-1]) if self._mozs else (np.inf, -np.inf)
+
+        # key: peakel, value: index in sorted_peaks, built on first view
+        self._position_by_peakel = None
+
+        PeakelIndex.record_construction(time.time() - t)
+
+    @staticmethod
+    def record_construction(seconds, view=False):
+        """
+        :param seconds: time spent building an index
+        :param view: True if an index view was built
+        """
+        PeakelIndex.PROFILE['views' if view else 'indexes'] += 1
+        PeakelIndex.PROFILE['seconds'] += seconds
+
+    @staticmethod
+    def reset_profiling():
+        PeakelIndex.PROFILE.update(indexes=0, views=0, seconds=0.0)
+
+    @staticmethod
+    def get_profiling_summary():
+        """
+        :return: str
+        """
+        return "{indexes} peakel indexes and {views} index views built in {seconds:.3f} s".format(
+            **PeakelIndex.PROFILE)
+
+    def view(self, peakels):
+        """
+        index of a subset of the peakels of this index, built
+        without sorting peakels again
 
-        for p in peakels:
-            bin_ = int(p.moz * self.inv_bin_size)
-            self._index[bin_].append(p)
+        :param peakels: peakels of this index
+        :return: PeakelIndexView
+        """
+        return PeakelIndexView(self, self.get_positions(peakels))
+
+    def get_positions(self, peakels):
+        """
+        :param peakels: peakels of this index
+        :return: list of indexes in `sorted_peaks`
+        """
+        if self._position_by_peakel is None:
+            self._position_by_peakel = {p: i for i, p in enumerate(self.sorted_peaks)}
+        return [self._position_by_peakel[p] for p in peakels]
+
+    def __len__(self):
+        return len(self.sorted_peaks)
 
     def empty(self):
         """
         check emptyness of the index        
         """
-        return len(self._index)
+        return len(self.sorted_peaks)
 
     def get_nearest_peakel(self, moz, mz_tol_ppm):
         """
@@ -375,13 +779,370 @@ class PeakelIndex(object):
         if moz < self.min_moz or moz > self.max_moz:
             return None
 
-        bin_ = int(moz * self.inv_bin_size)
         tol_da = (mz_tol_ppm * moz) / 1e6
-        peaks = []
-        for i in range(bin_ - 1, bin_ + 2):
-            peaks.extend(self._index.get(i, []))
-        if not peaks:
+        i = bisect_left(self._mozs, moz)
+        # on a draw, the lowest moz is kept
+        if i == len(self._mozs) or (i > 0 and moz - self._mozs[i - 1] <= self._mozs[i] - moz):
+            i -= 1
+
+        return self.sorted_peaks[i] if (abs(self._mozs[i] - moz) < tol_da) else None
+
+    def query_many(self, mozs, mz_tol_ppm):
+        """
+        nearest peakel of several moz in one call
+
+        :param mozs: array of moz to look for
+        :param mz_tol_ppm:
+        :return: array of indexes in `sorted_peaks` (-1 if no peakel found),
+        array of errors in ppm (nan if no peakel found)
+        """
+        mozs = np.asarray(mozs, dtype=np.float64)
+        if not len(self.sorted_peaks):
+            return np.full(mozs.shape, -1, dtype=np.intp), np.full(mozs.shape, np.nan)
+
+        right = np.searchsorted(self.mozs, mozs).clip(0, len(self.mozs) - 1)
+        left = (right - 1).clip(0, len(self.mozs) - 1)
+        left_dist, right_dist = np.abs(mozs - self.mozs[left]), np.abs(self.mozs[right] - mozs)
+        # on a draw, the lowest moz is kept
+        indexes = np.where(right_dist < left_dist, right, left)
+
+        found = (np.minimum(left_dist, right_dist) < mz_tol_ppm * mozs / 1e6) & \
+                (mozs >= self.min_moz) & (mozs <= self.max_moz)
+        indexes = np.where(found, indexes, -1)
+        errors = np.where(found, (self.mozs[indexes] - mozs) / mozs * 1e6, np.nan)
+        return indexes, errors
+
+    def get_indexes_in_range(self, moz, mz_tol_ppm):
+        """
+        all peakels within tolerance, O(log n + k)
+
+        :param moz:
+        :param mz_tol_ppm:
+        :return: array of indexes in `sorted_peaks`, array of errors in ppm, sorted by moz
+        """
+        tol_da = mz_tol_ppm * moz / 1e6
+        start, stop = bisect_left(self._mozs, moz - tol_da), bisect_left(self._mozs, moz + tol_da)
+        indexes = np.arange(start, stop)
+        errors = (self.mozs[start:stop] - moz) / moz * 1e6
+        # tolerance is exclusive
+        selected = np.abs(errors) < mz_tol_ppm
+        return indexes[selected], errors[selected]
+
+    def get_peakels_in_range(self, moz, mz_tol_ppm):
+        """
+        :param moz:
+        :param mz_tol_ppm:
+        :return: list of all peakels within tolerance, array of errors in ppm, sorted by moz
+        """
+        indexes, errors = self.get_indexes_in_range(moz, mz_tol_ppm)
+        return [self.sorted_peaks[i] for i in indexes.tolist()], errors
+
+    def get_indexes_in_ranges(self, mozs, mz_tol_ppm):
+        """
+        all peakels within tolerance of several moz in one call
+
+        :param mozs: array of moz to look for
+        :param mz_tol_ppm:
+        :return: flat arrays, one value per match: index of the queried moz,
+        index in `sorted_peaks`, error in ppm
+        """
+        mozs = np.asarray(mozs, dtype=np.float64)
+        tol_da = mz_tol_ppm * mozs / 1e6
+        starts = np.searchsorted(self.mozs, mozs - tol_da)
+        stops = np.searchsorted(self.mozs, mozs + tol_da)
+        queries, indexes = _expand_ranges(starts, stops)
+        errors = (self.mozs[indexes] - mozs[queries]) / mozs[queries] * 1e6
+        selected = np.abs(errors) < mz_tol_ppm
+        return queries[selected], indexes[selected], errors[selected]
+
+    def get_nearest_peakels(self, mozs, mz_tol_ppm):
+        """
+        :param mozs: array of moz to look for
+        :param mz_tol_ppm:
+        :return: list of peakels, None where no peakel was found
+        """
+        indexes, _ = self.query_many(mozs, mz_tol_ppm)
+        return [self.sorted_peaks[i] if i >= 0 else None for i in indexes.tolist()]
+
+
+class PeakelIndexView(object):
+    """
+    Subset of a PeakelIndex, queries are done on the arrays of the
+    whole index, results are restricted to the peakels of the subset.
+    Indexes returned refer to `sorted_peaks` of the whole index.
+
+    :param index: PeakelIndex
+    :param positions: indexes of the peakels of the subset in index.sorted_peaks
+    """
+    def __init__(self, index, positions):
+        t = time.time()
+        self.index = index
+        self.positions = np.unique(np.asarray(positions, dtype=np.intp))
+        self._members = set(self.positions.tolist())
+        self.mozs = index.mozs[self.positions]
+        if len(self.positions):
+            self.min_moz, self.max_moz = index.mozs[self.positions[0]], index.mozs[self.positions[-1]]
+        else:
+            self.min_moz, self.max_moz = np.inf, -np.inf
+        PeakelIndex.record_construction(time.time() - t, view=True)
+
+    @property
+    def sorted_peaks(self):
+        return self.index.sorted_peaks
+
+    def __len__(self):
+        return len(self.positions)
+
+    def empty(self):
+        """
+        check emptyness of the index
+        """
+        return len(self.positions)
+
+    def _is_member(self, indexes):
+        """
+        :param indexes: array of indexes in sorted_peaks
+        :return: boolean array
+        """
+        if not len(self.positions):
+            return np.zeros(len(indexes), dtype=bool)
+        positions = np.searchsorted(self.positions, indexes).clip(0, len(self.positions) - 1)
+        return self.positions[positions] == indexes
+
+    def get_indexes_in_range(self, moz, mz_tol_ppm):
+        """
+        see `PeakelIndex.get_indexes_in_range`
+        """
+        indexes, errors = self.index.get_indexes_in_range(moz, mz_tol_ppm)
+        selected = [i in self._members for i in indexes.tolist()]
+        return indexes[selected], errors[selected]
+
+    def get_peakels_in_range(self, moz, mz_tol_ppm):
+        """
+        see `PeakelIndex.get_peakels_in_range`
+        """
+        indexes, errors = self.get_indexes_in_range(moz, mz_tol_ppm)
+        return [self.sorted_peaks[i] for i in indexes.tolist()], errors
+
+    def get_indexes_in_ranges(self, mozs, mz_tol_ppm):
+        """
+        see `PeakelIndex.get_indexes_in_ranges`
+        """
+        queries, indexes, errors = self.index.get_indexes_in_ranges(mozs, mz_tol_ppm)
+        selected = self._is_member(indexes)
+        return queries[selected], indexes[selected], errors[selected]
+
+    def get_nearest_peakel(self, moz, mz_tol_ppm):
+        """
+        see `PeakelIndex.get_nearest_peakel`
+        """
+        if moz < self.min_moz or moz > self.max_moz:
             return None
-        peaks.sort(key=lambda x: abs(x.moz - moz))
+        tol_da = (mz_tol_ppm * moz) / 1e6
+        mozs = self.index._mozs
+        nearest, nearest_dist = None, tol_da
+        # few candidates, plain python is faster than numpy here
+        for i in range(bisect_left(mozs, moz - tol_da), bisect_left(mozs, moz + tol_da)):
+            # sorted by moz, on a draw the lowest moz is kept
+            dist = abs(mozs[i] - moz)
+            if dist < nearest_dist and i in self._members:
+                nearest, nearest_dist = i, dist
+        return None if nearest is None else self.sorted_peaks[nearest]
+
+    def query_many(self, mozs, mz_tol_ppm):
+        """
+        see `PeakelIndex.query_many`
+        """
+        mozs = np.asarray(mozs, dtype=np.float64)
+        if not len(self.positions):
+            return np.full(mozs.shape, -1, dtype=np.intp), np.full(mozs.shape, np.nan)
+
+        last = len(self.mozs) - 1
+        right = np.searchsorted(self.mozs, mozs).clip(0, last)
+        # first of the equal mozs, the lowest index is kept on a draw
+        left = np.searchsorted(self.mozs, self.mozs[(right - 1).clip(0, last)])
+        left_dist, right_dist = np.abs(mozs - self.mozs[left]), np.abs(self.mozs[right] - mozs)
+        nearest = np.where(right_dist < left_dist, right, left)
+
+        found = (np.minimum(left_dist, right_dist) < mz_tol_ppm * mozs / 1e6) & \
+                (mozs >= self.min_moz) & (mozs <= self.max_moz)
+        indexes = np.where(found, self.positions[nearest], -1)
+        errors = np.where(found, (self.index.mozs[indexes] - mozs) / mozs * 1e6, np.nan)
+        return indexes, errors
+
+    def get_nearest_peakels(self, mozs, mz_tol_ppm):
+        """
+        see `PeakelIndex.get_nearest_peakels`
+        """
+        indexes, _ = self.query_many(mozs, mz_tol_ppm)
+        return [self.sorted_peaks[i] if i >= 0 else None for i in indexes.tolist()]
+
+
+def _nearest_by_query(queries, indexes, errors):
+    """
+    keep only the nearest match of each query, the lowest index on a draw
+    :param queries: array of query number
+    :param indexes: array of matching indexes
+    :param errors: array of errors
+    :return: queries, indexes, errors
+    """
+    order = np.lexsort((indexes, np.abs(errors), queries))
+    queries, indexes, errors = queries[order], indexes[order], errors[order]
+    firsts = np.append(True, queries[1:] != queries[:-1]) if len(queries) else np.zeros(0, dtype=bool)
+    return queries[firsts], indexes[firsts], errors[firsts]
+
+
+def _expand_ranges(starts, stops):
+    """
+    expand several ranges [start, stop) in flat arrays
+    :param starts: array of int
+    :param stops: array of int
+    :return: array of range number, array of values
+    """
+    lengths = stops - starts
+    ranges = np.repeat(np.arange(len(starts)), lengths)
+    # position of each value inside its range
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return ranges, starts[ranges] + offsets
+
+
+class PeakelIndex2D(PeakelIndex):
+    """
+    Index of peakels in moz and rt dimensions. Peakels are
+    put in a grid of rt bins, each bin being sorted by moz.
+
+    :param peakels:
+    :param rt_bin_size: width of one rt bin
+    """
+
+    def __init__(self, peakels, rt_bin_size=6.0):
+        PeakelIndex.__init__(self, peakels)
+        t = time.time()
+        self.rts = np.array([p.rt for p in self.sorted_peaks], dtype=np.float64)
+        self.inv_rt_bin_size = 1.0 / rt_bin_size
+
+        # stable sort, inside a bin peakels remain sorted by moz
+        bins = np.floor(self.rts * self.inv_rt_bin_size).astype(np.int64)
+        order = np.argsort(bins, kind='mergesort')
+        bins, starts = np.unique(bins[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+
+        # key: rt bin, value: (indexes in sorted_peaks, mozs)
+        self._grid = {}
+        # same as lists, faster for scalar queries
+        self._grid_lists = {}
+        self._rts = self.rts.tolist()
+        for b, start, stop in zip(bins.tolist(), starts.tolist(), stops.tolist()):
+            indexes = order[start:stop]
+            self._grid[b] = (indexes, self.mozs[indexes])
+            self._grid_lists[b] = (indexes.tolist(), self._grid[b][1].tolist())
+        PeakelIndex.PROFILE['seconds'] += time.time() - t
+
+    def _get_bins(self, rt, rt_tol):
+        """
+        :return: rt bins overlapping the window
+        """
+        first, last = int(floor((rt - rt_tol) * self.inv_rt_bin_size)), \
+            int(floor((rt + rt_tol) * self.inv_rt_bin_size))
+        return [b for b in range(first, last + 1) if b in self._grid]
+
+    def get_indexes_in_window(self, moz, mz_tol_ppm, rt, rt_tol):
+        """
+        :param moz:
+        :param mz_tol_ppm:
+        :param rt:
+        :param rt_tol: half width of the rt window
+        :return: indexes in `sorted_peaks` of all peakels within tolerances, nearest in moz first
+        """
+        tol_da = mz_tol_ppm * moz / 1e6
+        candidates = []
+        for b in self._get_bins(rt, rt_tol):
+            indexes, mozs = self._grid[b]
+            start, stop = np.searchsorted(mozs, [moz - tol_da, moz + tol_da])
+            candidates.append(indexes[start:stop])
+        if not candidates:
+            return np.empty(0, dtype=np.intp)
+        candidates = np.concatenate(candidates)
+        moz_dist = np.abs(self.mozs[candidates] - moz)
+        selected = (moz_dist < tol_da) & (np.abs(self.rts[candidates] - rt) < rt_tol)
+        candidates, moz_dist = candidates[selected], moz_dist[selected]
+        return candidates[np.argsort(moz_dist, kind='mergesort')]
+
+    def get_peakels_in_window(self, moz, mz_tol_ppm, rt, rt_tol):
+        """
+        :param moz:
+        :param mz_tol_ppm:
+        :param rt:
+        :param rt_tol: half width of the rt window
+        :return: list of all peakels within tolerances, nearest in moz first
+        """
+        return [self.sorted_peaks[i] for i in self.get_indexes_in_window(moz, mz_tol_ppm, rt, rt_tol).tolist()]
+
+    def get_nearest_peakel_in_window(self, moz, mz_tol_ppm, rt, rt_tol):
+        """
+        :param moz:
+        :param mz_tol_ppm:
+        :param rt:
+        :param rt_tol: half width of the rt window
+        :return: nearest peakel in moz within the rt window, could return a None value
+        """
+        tol_da = mz_tol_ppm * moz / 1e6
+        best, best_dist = None, tol_da
+        for b in self._get_bins(rt, rt_tol):
+            indexes, mozs = self._grid_lists[b]
+            for i in range(bisect_left(mozs, moz - tol_da), len(mozs)):
+                dist = abs(mozs[i] - moz)
+                if mozs[i] >= moz + tol_da:
+                    break
+                if dist < best_dist and abs(self._rts[indexes[i]] - rt) < rt_tol:
+                    best, best_dist = indexes[i], dist
+        return None if best is None else self.sorted_peaks[best]
+
+    def query_many_in_window(self, mozs, rts, mz_tol_ppm, rt_tol):
+        """
+        nearest peakel in moz within the rt window of several targets in one call
+
+        :param mozs: array of moz to look for
+        :param rts: array of rt of the targets
+        :param mz_tol_ppm:
+        :param rt_tol: half width of the rt window
+        :return: array of indexes in `sorted_peaks` (-1 if no peakel found),
+        array of errors in ppm (nan if no peakel found)
+        """
+        mozs, rts = np.asarray(mozs, dtype=np.float64), np.asarray(rts, dtype=np.float64)
+        tol_da = mz_tol_ppm * mozs / 1e6
+        queries, candidates = [], []
+
+        first = np.floor((rts - rt_tol) * self.inv_rt_bin_size).astype(np.int64)
+        last = np.floor((rts + rt_tol) * self.inv_rt_bin_size).astype(np.int64)
+        for shift in range(int((last - first).max()) + 1 if len(mozs) else 0):
+            # group targets by rt bin
+            valid = np.flatnonzero(first + shift <= last)
+            target_bins = first[valid] + shift
+            order = np.argsort(target_bins, kind='mergesort')
+            bins, starts = np.unique(target_bins[order], return_index=True)
+            stops = np.append(starts[1:], len(order))
+            for b, start, stop in zip(bins.tolist(), starts.tolist(), stops.tolist()):
+                if b not in self._grid:
+                    continue
+                targets = valid[order[start:stop]]
+                indexes, bin_mozs = self._grid[b]
+                bin_starts = np.searchsorted(bin_mozs, mozs[targets] - tol_da[targets])
+                bin_stops = np.searchsorted(bin_mozs, mozs[targets] + tol_da[targets])
+                ranges, positions = _expand_ranges(bin_starts, bin_stops)
+                queries.append(targets[ranges])
+                candidates.append(indexes[positions])
+
+        result, errors = np.full(len(mozs), -1, dtype=np.intp), np.full(len(mozs), np.nan)
+        if not queries:
+            return result, errors
+        queries, candidates = np.concatenate(queries), np.concatenate(candidates)
+        moz_dist = np.abs(self.mozs[candidates] - mozs[queries])
+        selected = (moz_dist < tol_da[queries]) & (np.abs(self.rts[candidates] - rts[queries]) < rt_tol)
+        queries, candidates, moz_dist = queries[selected], candidates[selected], moz_dist[selected]
 
-        return peaks[0] if (abs(peaks[0].moz - moz) < tol_da) else None
+        # nearest in moz of each query, lowest moz on a draw
+        queries, candidates, moz_dist = _nearest_by_query(queries, candidates, moz_dist)
+        result[queries] = candidates
+        errors[queries] = (self.mozs[candidates] - mozs[queries]) / mozs[queries] * 1e6
+        return result, errors
@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+
+import numpy as np
+from six.moves import range
+
+
+# mass shift of the heavy isotope, tag. Isotopes of the C, N and S atoms
+# are averaged by the model of the isotopes offsets, see `IsotopesTable`
+ISOTOPES = {1.003355: "Isotope C13",
+            0.997035: "Isotope N15",
+            1.995796: "Isotope S34"}
+
+# not covered by the model, looked for at their own mass shift
+HALOGEN_ISOTOPES = {1.997953: "Isotope Br81",
+                    1.997050: "Isotope Cl37"}
+
+
+class IsotopesTable(object):
+    """
+    Theoritical isotopes offsets
+    ============================
+
+    m/z offsets of each isotope index from the monoisotopic peak, for each charge.
+    The first series of offsets is given by the model of FeatureFinderMetabo (OpenMS):
+
+    mean_theo = 1.000857 * j + 0.001091, sigma_theo = 0.0016633 * j - 0.0004571
+
+    An offset of the model is tagged with the isotope of `ISOTOPES` which explains it
+    the best, i.e. with the smallest delta between the offset and the mass shift of
+    the isotope repeated as many times as needed to reach the isotope index, if this
+    delta is within 3 sigma_theo. Isotopes not averaged by the model (e.g. Br81, Cl37)
+    get their own series: n heavy atoms at the isotope index n * nominal shift,
+    offset n * mass shift.
+
+    :param isotopes: dict key: mass shift, value: tag
+    :param max_charge:
+    :param max_isotopes_nb:
+    """
+    # tag of the model offsets not explained by any isotope
+    MODEL_TAG = "Isotope"
+
+    def __init__(self, isotopes=None, max_charge=2, max_isotopes_nb=5):
+        self.isotopes = dict(ISOTOPES if isotopes is None else isotopes)
+        self.max_charge = max_charge
+        self.max_isotopes_nb = max_isotopes_nb
+
+        model_isotopes = {s: t for s, t in self.isotopes.items() if s in ISOTOPES}
+        other_isotopes = sorted((s, t) for s, t in self.isotopes.items() if s not in ISOTOPES)
+
+        idx = np.arange(1, max_isotopes_nb + 1, dtype=np.float64)
+        # shape (nb series, max_isotopes_nb), nan where a series has no isotope
+        series = [1.000857 * idx + 0.001091]
+        tags = [[IsotopesTable._get_tag(model_isotopes, j) for j in range(1, max_isotopes_nb + 1)]]
+        for shift, tag in other_isotopes:
+            nominal = max(1, int(round(shift)))
+            offsets = np.full(max_isotopes_nb, np.nan)
+            offsets[nominal - 1::nominal] = shift * np.arange(1, max_isotopes_nb // nominal + 1)
+            series.append(offsets)
+            tags.append([tag if j % nominal == 0 else None for j in range(1, max_isotopes_nb + 1)])
+
+        charges = np.arange(1, max_charge + 1, dtype=np.float64)
+        # shape (max_charge, max_isotopes_nb, nb series)
+        self.offsets = np.array(series).T[np.newaxis, :, :] / charges[:, np.newaxis, np.newaxis]
+        # tags[charge - 1][idx - 1][series]
+        self.tags = [[[tags[s][j] for s in range(len(series))] for j in range(max_isotopes_nb)]
+                     for _ in range(max_charge)]
+
+        # python lists of the defined (offset, tag), faster to read one item at a time
+        self.targets_list = [[[(o, t) for o, t in zip(offsets, tags_) if o == o]
+                              for offsets, tags_ in zip(self.offsets[c].tolist(), self.tags[c])]
+                             for c in range(max_charge)]
+
+    @staticmethod
+    def _get_tag(isotopes, idx):
+        """
+        :param isotopes: dict key: mass shift, value: tag
+        :param idx: isotope index
+        :return: tag of the isotope with the smallest delta within 3 sigma of the model
+        """
+        offset = 1.000857 * idx + 0.001091
+        tolerance = 3 * (0.0016633 * idx - 0.0004571)
+        deltas = []
+        for shift, tag in isotopes.items():
+            # number of heavy atoms needed to reach this isotope index
+            nb_atoms = max(1, int(round(idx / round(shift))))
+            deltas.append((abs(offset - nb_atoms * shift), tag))
+        deltas = [d for d in deltas if d[0] <= tolerance]
+        return min(deltas)[1] if deltas else IsotopesTable.MODEL_TAG
+
+    def get(self, charge, idx):
+        """
+        :param charge:
+        :param idx: isotope index, starting at 1
+        :return: tuple offset, tag of the model
+        """
+        return self.targets_list[charge - 1][idx - 1][0]
+
+    def get_targets(self, charge, idx):
+        """
+        :param charge:
+        :param idx: isotope index, starting at 1
+        :return: list of (offset, tag) of all the series, the model first
+        """
+        return self.targets_list[charge - 1][idx - 1]
+
+    def get_tag(self, charge, idx, delta_moz):
+        """
+        :param charge:
+        :param idx: isotope index, starting at 1
+        :param delta_moz: m/z difference between an isotope and its monoisotopic peakel
+        :return: tag of the nearest offset of this isotope index
+        """
+        return min(self.get_targets(charge, idx), key=lambda x: abs(x[0] - delta_moz))[1]
+
+    def get_isotope_index(self, delta_moz, charge):
+        """
+        :param delta_moz: m/z difference between an isotope and its monoisotopic peakel
+        :param charge:
+        :return: index of the nearest theoritical offset, starting at 1
+        """
+        targets = self.targets_list[min(max(charge, 1), self.max_charge) - 1]
+        return min(range(len(targets)), key=lambda i: min(abs(o - delta_moz) for o, _ in targets[i])) + 1
@@ -0,0 +1,188 @@
+from __future__ import absolute_import
+import json
+import logging
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from mzos.feature import BasePeakel, Peakel, SampleAreaMatrix
+from six.moves import range
+
+
+# atomic rename, os.replace is not available on python 2
+_replace = getattr(os, 'replace', os.rename)
+
+# lightweight view over one row of a PeakTable
+PeakRow = namedtuple('PeakRow', ['index', 'moz', 'mozmin', 'mozmax', 'rt', 'rtmin', 'rtmax',
+                                 'area', 'areas', 'polarity'])
+
+
+class PeakTable(object):
+    """
+    Columnar representation of a peaklist
+    =====================================
+
+    Each column of the peaklist (mz, mzmin, mzmax, rt, rtmin, rtmax) is held
+    in a float array, areas of all samples in a 2-D matrix (one row per peak,
+    one column per sample). Median areas are computed once for the whole table.
+
+    :param moz:
+    :param mozmin:
+    :param mozmax:
+    :param rt:
+    :param rtmin:
+    :param rtmax:
+    :param areas: 2-D array shape (nb peaks, nb samples), stored as float32
+    :param sample_names: list of sample names, same order than areas columns
+    :param polarities: array of int (1 or -1) or None when not provided by the peaklist
+    :param row_ids: row number of each peak in the peaklist, None when the table holds the whole peaklist
+    :param area: precomputed median areas, computed from areas if None
+    """
+
+    # suffixes of the files of a saved table
+    COLUMNS_SUFFIX = ".columns.npy"
+    AREAS_SUFFIX = ".areas.npy"
+    HEADER_SUFFIX = ".header.json"
+
+    def __init__(self, moz, mozmin, mozmax, rt, rtmin, rtmax, areas, sample_names, polarities=None, row_ids=None,
+                 area=None):
+        self.moz = np.asarray(moz, dtype=np.float64)
+        self.mozmin = np.asarray(mozmin, dtype=np.float64)
+        self.mozmax = np.asarray(mozmax, dtype=np.float64)
+        self.rt = np.asarray(rt, dtype=np.float64)
+        self.rtmin = np.asarray(rtmin, dtype=np.float64)
+        self.rtmax = np.asarray(rtmax, dtype=np.float64)
+
+        # float32 areas, memory-mapped areas of a saved table are used without copy
+        if not isinstance(areas, np.memmap):
+            areas = np.ascontiguousarray(areas, dtype=np.float32)
+        self.areas = areas.reshape(len(self.moz), len(sample_names))
+        self.sample_names = list(sample_names)
+        self.polarities = polarities
+        self.row_ids = row_ids
+
+        self.area = self._compute_areas() if area is None else np.asarray(area, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.moz)
+
+    def _compute_areas(self):
+        """
+        median of the areas of each peak, mean is used
+        when the median equals to 0
+        :return: array
+        """
+        if not self.sample_names:
+            return np.zeros(len(self), dtype=np.float64)
+        area = np.median(self.areas, axis=1).astype(np.float64)
+        null_median = area == 0
+        if null_median.any():
+            area[null_median] = self.areas[null_median].mean(axis=1)
+            logging.debug("{0} elution peaks have the median of "
+                          "their area equals to 0 ! Using mean instead.".format(null_median.sum()))
+        return area
+
+    def save(self, prefix, **metadata):
+        """
+        save the table as raw arrays that can be memory-mapped by `load`. The
+        header is written last, a table without header is considered invalid.
+
+        :param prefix: path prefix of the written files
+        :param metadata: json serializable data stored in the header
+        """
+        polarities = np.nan if self.polarities is None else self.polarities
+        columns = np.vstack([self.moz, self.mozmin, self.mozmax, self.rt, self.rtmin, self.rtmax,
+                             self.area, np.zeros(len(self)) + polarities])
+        for suffix, array in ((self.COLUMNS_SUFFIX, columns), (self.AREAS_SUFFIX, self.areas)):
+            with open(prefix + suffix + ".tmp", 'wb') as f:
+                np.save(f, array)
+            _replace(prefix + suffix + ".tmp", prefix + suffix)
+
+        header = {'sample_names': self.sample_names,
+                  'has_polarities': self.polarities is not None,
+                  'metadata': metadata}
+        with open(prefix + self.HEADER_SUFFIX + ".tmp", 'w') as f:
+            json.dump(header, f)
+        _replace(prefix + self.HEADER_SUFFIX + ".tmp", prefix + self.HEADER_SUFFIX)
+
+    @classmethod
+    def read_header(cls, prefix):
+        """
+        :param prefix: path prefix used in `save`
+        :return: header dict or None if the table does not exist
+        """
+        try:
+            with open(prefix + cls.HEADER_SUFFIX) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        """
+        load a table written by `save`, arrays are memory-mapped
+        :param prefix: path prefix used in `save`
+        :param mmap_mode: see numpy.load, None to read arrays in memory
+        :return: PeakTable
+        """
+        header = cls.read_header(prefix)
+        if header is None:
+            raise IOError("no peak table saved at {0}".format(prefix))
+        columns = np.load(prefix + cls.COLUMNS_SUFFIX, mmap_mode=mmap_mode)
+        areas = np.load(prefix + cls.AREAS_SUFFIX, mmap_mode=mmap_mode)
+        polarities = columns[7].astype(np.int64) if header['has_polarities'] else None
+        return cls(columns[0], columns[1], columns[2], columns[3], columns[4], columns[5],
+                   areas, header['sample_names'], polarities, area=columns[6])
+
+    def row(self, i):
+        """
+        :param i: row index
+        :return: PeakRow, areas is a view on the areas matrix
+        """
+        return PeakRow(i, self.moz[i], self.mozmin[i], self.mozmax[i],
+                       self.rt[i], self.rtmin[i], self.rtmax[i],
+                       self.area[i], self.areas[i],
+                       None if self.polarities is None else self.polarities[i])
+
+    def iter_rows(self):
+        """
+        :return: generator of PeakRow
+        """
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def get_area_matrix(self):
+        """
+        :return: SampleAreaMatrix, samples x peaks, a view on the areas
+        """
+        return SampleAreaMatrix(self.areas.T, self.sample_names)
+
+    def to_peakels(self, polarity=0, peakel_class=Peakel):
+        """
+        build peakels objects used by the annotator, areas are stored in a
+        SampleAreaMatrix shared by all peakels. If the table has row ids
+        peakels ids are set accordingly, row number + 1, and peakels created
+        afterwards get greater ids. Peakels created before from another
+        peaklist may share these ids
+        :param polarity: used when polarities are not provided by the peaklist
+        :param peakel_class: Peakel or CompactPeakel
+        :return: list of Peakel
+        """
+        peakels = []
+        area_matrix = self.get_area_matrix()
+        polarities = [polarity] * len(self) if self.polarities is None else self.polarities.tolist()
+        columns = zip(self.moz.tolist(), self.mozmin.tolist(), self.mozmax.tolist(),
+                      self.rt.tolist(), self.rtmin.tolist(), self.rtmax.tolist(),
+                      self.area.tolist(), polarities)
+        for i, (moz, mozmin, mozmax, rt, rtmin, rtmax, area, pol) in enumerate(columns):
+            p = peakel_class(moz, mozmin, mozmax, rt, rtmin, rtmax)
+            if self.row_ids is not None:
+                p.id = int(self.row_ids[i]) + 1
+            p.polarity = pol
+            p.set_area_matrix(area_matrix, i)
+            p.area = area
+            peakels.append(p)
+        if self.row_ids is not None and len(self.row_ids):
+            BasePeakel.skip_ids(int(self.row_ids.max()) + 1)
+        return peakels
@@ -1,12 +1,18 @@
 from __future__ import absolute_import
 import logging
+import time
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import scipy as sp
 import numpy as np
-from sklearn.metrics.pairwise import pairwise_distances
 
-from mzos.clustering import clusterize_basic, clusterize_hierarchical, clusterize_dbscan
+from mzos.feature import get_areas_matrix
+from mzos.utils import get_nb_jobs
+from mzos.clustering import clusterize_basic, clusterize_hierarchical, clusterize_hierarchical_1d, \
+    clusterize_dbscan, get_correlation_distances
 import six
+from six.moves import range
 
 
 class PeakelClusterer(object):
@@ -30,6 +36,11 @@ class PeakelClusterer(object):
     DEFAULT_SHAPE_CORR = 0.4
     DEFAULT_INT_CORR = 0.4
 
+    # if not None, rt clusters larger than this are split at their largest
+    # retention times gaps before the correlation clustering, bounds the
+    # memory used by the distances matrix
+    MAX_CORR_CLUSTER_SIZE = None
+
     # aggregation condition
     BASIC_RT_CALLABLE = staticmethod(lambda x, y, z: True if abs(x.rt - z.rt) <= z else False)
        
@@ -47,6 +58,11 @@ class PeakelClusterer(object):
         
         self.corr_shape_method = kw.get('corr_shape_method')
         self.corr_int_method = kw.get('corr_int_method')
+        self.max_corr_cluster_size = kw.get('max_corr_cluster_size', self.MAX_CORR_CLUSTER_SIZE)
+        # half of error_rt if None
+        self.dbscan_eps = kw.get('dbscan_eps')
+        # list of (nb peakels, time in seconds) of the last correlation clustering, see `_check_update_corrs`
+        self.corr_timings = []
 
         # no correlation method provided, default intensity method hierarchical clustering
         if not self.corr_shape_method and not self.corr_int_method:
@@ -87,20 +103,15 @@ class PeakelClusterer(object):
             return clusterize_basic(self.peakels, self.BASIC_RT_CALLABLE, error_rt)
 
         elif self.rt_method == 2:
-            rts = [[x.rt] for x in self.peakels]
-            matrix_dist = sp.spatial.distance.pdist(np.array(rts))  # metric = eclidean by default
-            return list(clusterize_hierarchical(self.peakels, matrix_dist, "", error_rt).values())
+            logging.info("Hierarchical clustering with rt_error:{0}".format(error_rt))
+            # exact complete linkage on sorted rts, no distances matrix
+            return clusterize_hierarchical_1d(self.peakels, [x.rt for x in self.peakels], error_rt)
 
         elif self.rt_method == 3:
-            logging.info('DB SCAN clustering with error_rt:{0}'.format(error_rt))
+            eps = error_rt / 2.0 if self.dbscan_eps is None else self.dbscan_eps
+            logging.info('DB SCAN clustering with error_rt:{0}, eps:{1}'.format(error_rt, eps))
             rts = [[x.rt] for x in self.peakels]
-            clusters = clusterize_dbscan(rts, self.peakels, eps=0.35)
-            # with open('clusters.txt', 'w') as f:
-            #     for c in clusters:
-            #         for fe in c:
-            #             f.write(str(fe.rt) + '\n')
-            #         f.write('\n')
-            return clusters  # eps=error_rt / 2.0, min_samples=1)
+            return clusterize_dbscan(rts, self.peakels, eps=eps, min_samples=1)
 
         else:
             raise ValueError("wrong clustering technique !")
@@ -128,6 +139,15 @@ class PeakelClusterer(object):
         
         return self._split_rt_cluster(clust_list)
 
+    @staticmethod
+    def get_intensity_correlations(rt_cluster):
+        """
+        pearson correlations of the areas across samples of all pairs of peakels of a cluster
+        :param rt_cluster: list of peakels
+        :return: 2-D array shape (nb peakels, nb peakels)
+        """
+        return np.atleast_2d(np.corrcoef(get_areas_matrix(rt_cluster)))
+
     def _check_update_corr_intensity_in_rt_cluster(self, rt_cluster, distance_corr=DEFAULT_INT_CORR):
         """
         Private function
@@ -140,31 +160,110 @@ class PeakelClusterer(object):
             clust_list = clusterize_basic(rt_cluster, self.BASIC_CORR_INT_CALLABLE, distance_corr)
         
         elif self.corr_int_method == 2:
-            ints = [list(x.area_by_sample_name.values()) for x in rt_cluster]  #
-            # matrix_dist = sp.spatial.distance.pdist(np.array(ints), metric='correlation')
-            # ude by default all cores on the machine
-            matrix_dist = pairwise_distances(np.array(ints), metric='correlation')  # , n_jobs=-1)
+            matrix_dist = get_correlation_distances(get_areas_matrix(rt_cluster))
             clust_list = clusterize_hierarchical(rt_cluster, matrix_dist, distance_corr, clip=True)
         else:
             raise ValueError("dbscan not supported for intensities correlation clustering")
         
         return clust_list  # self._split_rt_cluster(clust_list)
 
-    def _check_update_corrs(self, rt_clusters, corr_shape_dist, corr_int_dist):
+    def _get_corr_chunks(self, rt_cluster):
+        """
+        :param rt_cluster:
+        :return: list of chunks of at most `max_corr_cluster_size` peakels, the rt cluster
+        is split at its largest retention times gaps first. [rt_cluster] for smaller
+        clusters or if `max_corr_cluster_size` is None
+        """
+        if self.max_corr_cluster_size is None or len(rt_cluster) <= self.max_corr_cluster_size:
+            return [rt_cluster]
+        logging.info("splitting a rt cluster of {0} peakels for correlation clustering".format(len(rt_cluster)))
+        peakels = sorted(rt_cluster, key=lambda x: x.rt)
+        gaps = np.diff([p.rt for p in peakels])
+        chunks, to_split = [], [(0, len(peakels))]
+        while to_split:
+            start, stop = to_split.pop()
+            if stop - start <= self.max_corr_cluster_size:
+                chunks.append(peakels[start:stop])
+                continue
+            # first largest gap of the chunk, stop is exclusive
+            cut = start + int(np.argmax(gaps[start:stop - 1])) + 1
+            # second half popped last, chunks stay in retention times order
+            to_split += [(cut, stop), (start, cut)]
+        return chunks
+
+    def _check_update_corrs_in_chunk(self, rt_cluster, corr_shape_dist, corr_int_dist, with_correlations=False,
+                                     is_split=False):
+        """
+        correlation clustering of one chunk of a rt cluster, see `_check_update_corrs`
+        :param is_split: True if the chunk is a part of a larger rt cluster, a chunk
+        of one peakel is then kept as a cluster
+        :return: tuple list of clusters, list of 2-D arrays (empty if not with_correlations), time in seconds
+        """
+        t = time.time()
+        if is_split and len(rt_cluster) == 1:
+            clusters = [list(rt_cluster)]
+        elif self.corr_shape_method:
+            clusters = self._check_update_corr_shape_in_rt_cluster(rt_cluster, corr_shape_dist)
+        else:
+            clusters = self._check_update_corr_intensity_in_rt_cluster(rt_cluster, corr_int_dist)
+
+        new_correlations = []
+        if with_correlations:
+            # only the correlations inside the new clusters, no matrix of the whole chunk
+            new_correlations = [self.get_intensity_correlations(cluster) for cluster in clusters]
+        return clusters, new_correlations, time.time() - t
+
+    def _check_update_corrs(self, rt_clusters, corr_shape_dist, corr_int_dist, with_correlations=False,
+                            n_jobs=None):
         """
         Private function
         :param rt_clusters:
         :param corr_shape_dist:
         :param corr_int_dist:
+        :param with_correlations: if True, intensity correlations of the peakels of each
+        new cluster are returned as well
+        :param n_jobs: None or 1 to process rt clusters one after the other, otherwise number
+        of threads (-1 for all cpus), largest clusters are processed first. Results do not
+        depend on n_jobs
+        :return: list of clusters or tuple list of clusters, list of 2-D arrays
         """
-        new_curated_rt_clusters = []
-        if self.corr_shape_method:
-            for rt_cluster in rt_clusters:  # curated_rt_clusters):
-                new_curated_rt_clusters += self._check_update_corr_shape_in_rt_cluster(rt_cluster, corr_shape_dist)
+        chunks, is_split = [], []
+        for rt_cluster in rt_clusters:
+            cluster_chunks = self._get_corr_chunks(rt_cluster)
+            chunks += cluster_chunks
+            is_split += [len(cluster_chunks) > 1] * len(cluster_chunks)
+        process = partial(self._check_update_corrs_in_chunk, corr_shape_dist=corr_shape_dist,
+                          corr_int_dist=corr_int_dist, with_correlations=with_correlations)
+        if n_jobs is None or n_jobs == 1:
+            results = [process(chunk, is_split=split) for chunk, split in zip(chunks, is_split)]
         else:
-            for rt_cluster in rt_clusters:
-                new_curated_rt_clusters += self._check_update_corr_intensity_in_rt_cluster(rt_cluster, corr_int_dist)
+            # numpy and scipy release the GIL in the distances and linkage computations
+            order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]), reverse=True)
+            pool = ThreadPool(get_nb_jobs(n_jobs))
+            try:
+                ordered_results = pool.map(lambda i: process(chunks[i], is_split=is_split[i]), order, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            results = [None] * len(chunks)
+            for i, result in zip(order, ordered_results):
+                results[i] = result
+
+        # per cluster timings, slowest first
+        self.corr_timings = sorted([(len(chunk), result[2]) for chunk, result in zip(chunks, results)],
+                                   key=lambda x: x[1], reverse=True)
+        if self.corr_timings:
+            logging.info("correlation clustering of {0} rt clusters: {1:.3f} s, slowest: {2}".format(
+                len(chunks), sum(t for _, t in self.corr_timings),
+                ", ".join("{0} peakels {1:.3f} s".format(n, t) for n, t in self.corr_timings[:5])))
+
+        new_curated_rt_clusters, new_correlations = [], []
+        for clusters, correlations, _ in results:
+            new_curated_rt_clusters += clusters
+            new_correlations += correlations
 
+        if with_correlations:
+            return new_curated_rt_clusters, new_correlations
         return new_curated_rt_clusters
 
     def clusterize(self, error_rt=10.0,
@@ -1,10 +1,15 @@
 from __future__ import absolute_import
 import csv
+import hashlib
 import logging
+import os
+from array import array
 
 import numpy as np
 
-from mzos.feature import Peakel
+from mzos.feature import Peakel, CompactPeakel
+from mzos.peak_table import PeakTable
+import six
 from six.moves import range
 
 
@@ -13,21 +18,267 @@ class PeakListReader(object):
     peaklist reader
     """
     KEYS = ['mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', 'npeaks']
-    
-    def __init__(self, filepath, exp_design):
+
+    # columns which are not samples areas
+    NOT_SAMPLE_KEYS = ["", "BIO", "mzmed", "rt.minutes", "Var", "Blc.Ext", "BLC",
+                       "Mode", "Correlation_Dilution_Log", "NOT_M.QC", "NOT_M.Blc",
+                       "NOT_QC.Blc", "NOT_CV..", "NOT_CV", "NOT_Correl", "Correl",
+                       "NOT_BIO.Blc", "NOT_nom", "rt.min", "Negatifs"]
+
+    # number of rows parsed at once in a block of the areas matrix
+    BLOCK_SIZE = 4096
+
+    # sidecar binary cache of the parsed peaklist
+    CACHE_SUFFIX = ".mzos"
+    # number of bytes hashed at the start and at the end of the peaklist
+    CACHE_HASH_SIZE = 1 << 20
+
+    def __init__(self, filepath, exp_design, use_cache=False):
         """
         @param filepath:
         @param exp_design @type ExperimentalSettings
+        @param use_cache: write a binary cache of the peaklist on first read, memory-map it on next reads
         """
         self.peaklist_filepath = filepath
         self.exp_design = exp_design
+        self.use_cache = use_cache
         self.directories = self._find_directories()  #
 
-    def get_peakels(self):
-        """return peakels objects """
-        reader = csv.DictReader(open(self.peaklist_filepath, 'rb'), delimiter="\t")
-        return [self._to_peakel_obj(row) for row in reader]
-    
+    def get_peakels(self, compact=False):
+        """
+        return peakels objects
+        :param compact: build CompactPeakel objects instead of Peakel
+        """
+        peakel_class = CompactPeakel if compact else Peakel
+        return self.get_peak_table().to_peakels(self.exp_design.polarity, peakel_class)
+
+    def _open(self):
+        """open the peaklist as expected by the csv module"""
+        if six.PY2:
+            return open(self.peaklist_filepath, 'rb')
+        return open(self.peaklist_filepath, newline='')
+
+    def _get_not_sample_keys(self):
+        """
+        :return: set of the columns which are not samples areas
+        """
+        return set(PeakListReader.KEYS + self.directories + PeakListReader.NOT_SAMPLE_KEYS)
+
+    def _get_sample_names(self, header):
+        """
+        :param header: list of columns names
+        :return: list of samples names
+        """
+        not_samples = self._get_not_sample_keys()
+        return [k for k in header if k not in not_samples]
+
+    def _parse_rows(self, rows, columns, mode_idx):
+        """
+        parse csv rows into a float matrix, block by block
+        :param rows: iterable of csv rows
+        :param columns: index of the columns to parse
+        :param mode_idx: index of the Mode column or None
+        :return: data matrix, list of modes
+        """
+        blocks, modes = [], []
+        block, i = np.empty((self.BLOCK_SIZE, len(columns)), dtype=np.float64), 0
+        for row in rows:
+            block[i] = [row[c] for c in columns]
+            if mode_idx is not None:
+                modes.append(row[mode_idx])
+            i += 1
+            if i == self.BLOCK_SIZE:
+                blocks.append(block)
+                block, i = np.empty((self.BLOCK_SIZE, len(columns)), dtype=np.float64), 0
+        blocks.append(block[:i])
+        return np.concatenate(blocks), modes
+
+    def _get_columns(self, header):
+        """
+        :param header: list of columns names
+        :return: sample names, index of the parsed columns, index of the Mode column or None
+        """
+        sample_names = self._get_sample_names(header)
+        columns = [header.index(k) for k in PeakListReader.KEYS[:6] + sample_names]
+        mode_idx = header.index("Mode") if "Mode" in header else None
+        return sample_names, columns, mode_idx
+
+    @staticmethod
+    def _to_peak_table(data, modes, sample_names, row_ids=None):
+        """
+        :param data: matrix returned by `_parse_rows`
+        :param modes: list of modes returned by `_parse_rows`
+        :param sample_names:
+        :param row_ids:
+        :return: PeakTable
+        """
+        polarities = None
+        if modes:
+            polarities = np.where(np.array(modes) == 'Positif', 1, -1)
+        return PeakTable(data[:, 0], data[:, 1], data[:, 2], data[:, 3], data[:, 4], data[:, 5],
+                         data[:, 6:], sample_names, polarities, row_ids=row_ids)
+
+    def get_peak_table(self):
+        """
+        parse the whole peaklist into a columnar PeakTable, or load it
+        from the binary cache if enabled and up to date
+        :return: PeakTable
+        """
+        if not self.use_cache:
+            return self._read_peak_table()
+
+        cache_prefix = self.peaklist_filepath + self.CACHE_SUFFIX
+        cache_key = self._get_cache_key()
+        header = PeakTable.read_header(cache_prefix)
+        if header is not None and header['metadata'].get('key') == cache_key:
+            logging.info("Loading peaklist from cache {0}".format(cache_prefix))
+            return PeakTable.load(cache_prefix)
+
+        table = self._read_peak_table()
+        try:
+            table.save(cache_prefix, key=cache_key)
+        except (IOError, OSError) as e:
+            logging.warning("Unable to write peaklist cache {0}: {1}".format(cache_prefix, e))
+        return table
+
+    def _get_cache_key(self):
+        """
+        identify the peaklist content using its size, its modification time
+        and a hash of its first and last bytes, and the columns which are not samples
+        :return: dict
+        """
+        stat = os.stat(self.peaklist_filepath)
+        sha1 = hashlib.sha1()
+        with open(self.peaklist_filepath, 'rb') as f:
+            sha1.update(f.read(self.CACHE_HASH_SIZE))
+            if stat.st_size > self.CACHE_HASH_SIZE:
+                f.seek(-self.CACHE_HASH_SIZE, os.SEEK_END)
+                sha1.update(f.read(self.CACHE_HASH_SIZE))
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest(),
+                'not_samples': sorted(str(k) for k in self._get_not_sample_keys())}
+
+    def _read_peak_table(self):
+        """
+        parse the whole peaklist
+        :return: PeakTable
+        """
+        with self._open() as f:
+            reader = csv.reader(f, delimiter="\t")
+            header = next(reader)
+            sample_names, columns, mode_idx = self._get_columns(header)
+            data, modes = self._parse_rows(reader, columns, mode_idx)
+        return self._to_peak_table(data, modes, sample_names)
+
+    @staticmethod
+    def _iter_lines(f, position=None):
+        """
+        :param f: peaklist opened in binary mode
+        :param position: one item list, set to the offset following the last line read
+        :return: generator of lines as expected by the csv module
+        """
+        for line in iter(f.readline, b''):
+            if position is not None:
+                position[0] += len(line)
+            yield six.ensure_str(line)
+
+    def _index_rows(self):
+        """
+        first pass over the peaklist keeping only the offset, the moz and the rt of each row.
+        Rows are parsed by the csv module, a quoted field may hold tabs or newlines
+        :return: header, offsets, moz, rt
+        """
+        offsets, mozs, rts = array('q'), array('d'), array('d')
+        position = [0]
+        with open(self.peaklist_filepath, 'rb') as f:
+            # the csv reader does not read ahead, a row starts where the previous one ends
+            reader = csv.reader(self._iter_lines(f, position), delimiter="\t")
+            header = next(reader)
+            mz_idx, rt_idx = header.index(PeakListReader.KEYS[0]), header.index(PeakListReader.KEYS[3])
+            offset = position[0]
+            for row in reader:
+                if row:
+                    offsets.append(offset)
+                    mozs.append(float(row[mz_idx]))
+                    rts.append(float(row[rt_idx]))
+                offset = position[0]
+        return header, np.array(offsets, dtype=np.int64), np.array(mozs), np.array(rts)
+
+    def get_chunk_overlap(self, sort_by='moz', max_isotopes_nb=5, error_rt=6.0):
+        """
+        default overlap between two consecutive chunks, i.e. the largest mass
+        difference looked for between two peakels (isotopes, adducts, fragments)
+        or the rt window in rt dimension
+        :param sort_by: 'moz' or 'rt'
+        :param max_isotopes_nb:
+        :param error_rt:
+        :return: float
+        """
+        if sort_by == 'rt':
+            return error_rt
+        mass_window = 1.000857 * max_isotopes_nb + 0.001091
+        for (mass, _), _ in self.exp_design.get_mass_to_check():
+            mass_window = max(mass_window, abs(mass))
+        return mass_window
+
+    def iter_peak_tables(self, chunk_size=100000, overlap=None, sort_by='moz'):
+        """
+        read the peaklist by chunks of `chunk_size` rows sorted by moz or rt.
+        Only offsets, moz and rt of all rows are kept in memory, each chunk is
+        extended on both edges by `overlap` (Da or seconds) so relations between
+        peakels lying at the border of two chunks are not lost.
+
+        :param chunk_size: number of rows owned by one chunk
+        :param overlap: overlap in moz or rt dimension, see `get_chunk_overlap`
+        :param sort_by: 'moz' or 'rt'
+        :return: generator of (PeakTable, core) where core is a boolean mask
+        of the rows owned by this chunk
+        """
+        if sort_by not in ('moz', 'rt'):
+            raise ValueError("chunks can only be sorted by 'moz' or 'rt'")
+        if overlap is None:
+            overlap = self.get_chunk_overlap(sort_by)
+
+        header, offsets, mozs, rts = self._index_rows()
+        sample_names, columns, mode_idx = self._get_columns(header)
+
+        keys = mozs if sort_by == 'moz' else rts
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        # tolerance on the borders
+        if sort_by == 'moz' and len(sorted_keys):
+            overlap += sorted_keys[-1] * self.exp_design.mz_tol_ppm / 1e6
+
+        with open(self.peaklist_filepath, 'rb') as f:
+            for start in range(0, len(order), chunk_size):
+                stop = min(start + chunk_size, len(order))
+                lo = np.searchsorted(sorted_keys, sorted_keys[start] - overlap, side='left')
+                hi = np.searchsorted(sorted_keys, sorted_keys[stop - 1] + overlap, side='right')
+
+                # read rows in the file order
+                row_ids = np.sort(order[lo:hi])
+                core = np.zeros(len(row_ids), dtype=bool)
+                core[np.searchsorted(row_ids, order[start:stop])] = True
+
+                rows = []
+                for offset in offsets[row_ids].tolist():
+                    f.seek(offset)
+                    rows.append(next(csv.reader(self._iter_lines(f), delimiter="\t")))
+                data, modes = self._parse_rows(rows, columns, mode_idx)
+                yield self._to_peak_table(data, modes, sample_names, row_ids=row_ids), core
+
+    def iter_peakels(self, chunk_size=100000, overlap=None, sort_by='moz'):
+        """
+        same as `iter_peak_tables` but yields peakels, the ids of the peakels are
+        the row numbers in the peaklist, the same in all chunks
+        :param chunk_size:
+        :param overlap:
+        :param sort_by:
+        :return: generator of (peakels, core peakels)
+        """
+        for table, core in self.iter_peak_tables(chunk_size, overlap, sort_by):
+            peakels = table.to_peakels(self.exp_design.polarity)
+            yield peakels, [p for p, is_core in zip(peakels, core) if is_core]
+
     def _find_directories(self):
         import os
         curr_dir = os.path.dirname(self.peaklist_filepath)
@@ -46,39 +297,3 @@ class PeakListReader(object):
             self.exp_design.create_group(c_dir, files)
 
         return group_directories
-
-    def _to_peakel_obj(self, d):
-        """ convert csv data to peakel objects  """
-        p = Peakel(float(d[PeakListReader.KEYS[0]]),
-                   float(d[PeakListReader.KEYS[1]]),
-                   float(d[PeakListReader.KEYS[2]]),
-                   float(d[PeakListReader.KEYS[3]]),
-                   float(d[PeakListReader.KEYS[4]]),
-                   float(d[PeakListReader.KEYS[5]]))
-
-        #  set the right polarity
-        polarity = None
-        if "Mode" in list(d.keys()):
-            polarity = 1 if d["Mode"] == 'Positif' else -1
-        else:
-            p.polarity = self.exp_design.polarity
-
-        #  remove keys
-        for k in (PeakListReader.KEYS + self.directories + ["", "BIO", "mzmed", "rt.minutes", "Var", "Blc.Ext", "BLC",
-                                                            "Mode", "Correlation_Dilution_Log", "NOT_M.QC", "NOT_M.Blc",
-                                                            "NOT_QC.Blc", "NOT_CV..", "NOT_CV", "NOT_Correl", "Correl",
-                                                            "NOT_BIO.Blc", "NOT_nom", "rt.min", "Negatifs"]):
-            try:
-                del d[k]
-            except KeyError:
-                pass
-
-        #  assign area of each sample
-        p.area_by_sample_name.update({a: float(b) for a, b in list(d.items())})
-        p.area = np.median(list(p.area_by_sample_name.values()))
-
-        if not p.area:
-            p.area = np.mean(list(p.area_by_sample_name.values()))
-            logging.debug("an elution peak has the median of "
-                          "its area equals to 0 ! Using mean instead: {}.".format(p.area))
-        return p
\ No newline at end of file
@@ -126,7 +126,7 @@ class ResultsExporter(object):
                 main_attribution_pattern_composition = self._get_main_attribution_pattern_composition(feature)
 
                 # isotopes to compute score
-                isostopes_score = [(i, i.get_attributions_by(lambda x: x.parent_id)[feature.id][0].attribution)
+                isostopes_score = [(i, i.get_attributions_with_parent(feature.id)[0].attribution)
                                    for i in feature.ip_score_isotopes if i is not feature]
                 # ip_score_isotopes = ";".join([str(i.id) + "=" + str(i.main_attribution.tag)
                 #                               for i in feature.ip_score_isotopes if i.main_attribution is not None
@@ -0,0 +1,180 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import gc
+import logging
+import time
+from collections import defaultdict as ddict
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+from mzos.feature import Peakel, CompactPeakel, Attribution, Annotation, PeakelIndex, SampleAreaMatrix
+from mzos.clustering import clusterize_dbscan_1d
+from mzos.database_finder import Metabolite, CompactMetabolite
+from six.moves import range
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+
+SAMPLES = ['sample{0}'.format(i) for i in range(8)]
+
+
+def _build_synthetic_run(n, peakel_class, metabolite_class, with_area_matrix=False):
+    """
+    build n peakels with areas, 2 attributions and 1 annotation each
+    :param n:
+    :param peakel_class:
+    :param metabolite_class:
+    :param with_area_matrix: if True areas are stored in a shared SampleAreaMatrix,
+    as built by `PeakTable.to_peakels`, otherwise in a dict per peakel
+    :return: list of peakels
+    """
+    rng = np.random.RandomState(0)
+    mozs = rng.uniform(100.0, 1000.0, n).tolist()
+    rts = rng.uniform(0.0, 1200.0, n).tolist()
+    areas = rng.uniform(1e3, 1e6, (n, len(SAMPLES)))
+    area_matrix = SampleAreaMatrix(areas.T, SAMPLES) if with_area_matrix else None
+    areas = areas.tolist()
+    peakels = []
+    for i in range(n):
+        p = peakel_class(mozs[i], mozs[i], mozs[i], rts[i])
+        if area_matrix is None:
+            p.area_by_sample_name = dict(zip(SAMPLES, areas[i]))
+        else:
+            p.set_area_matrix(area_matrix, i)
+        p.add_attribution(Attribution('Isotope C13', i, 1))
+        p.add_attribution(Attribution('Isotope C13', i + 1, 2))
+        m = metabolite_class('HMDB{0:05d}'.format(i), 'metabolite', 'C6H12O6', '', mozs[i], mozs[i])
+        p.annotations.append(Annotation(m, '[M-H]='))
+        peakels.append(p)
+    return peakels
+
+
+def bench_memory(n=500000):
+    """
+    compare the memory used by a synthetic run of `Peakel`/`Metabolite`
+    against `CompactPeakel`/`CompactMetabolite`, with areas in dicts or
+    in a shared matrix
+    :param n: number of peakels
+    :return: dict key: variant name, value: (memory in MB, time in seconds)
+    """
+    if tracemalloc is None:
+        raise RuntimeError("memory benchmark requires tracemalloc (python >= 3.4)")
+    results = {}
+    for name, peakel_class, metabolite_class, with_area_matrix in (('dict', Peakel, Metabolite, False),
+                                                                   ('slots', CompactPeakel, CompactMetabolite, False),
+                                                                   ('matrix', CompactPeakel, CompactMetabolite, True)):
+        gc.collect()
+        tracemalloc.start()
+        t = time.time()
+        peakels = _build_synthetic_run(n, peakel_class, metabolite_class, with_area_matrix)
+        elapsed = time.time() - t
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = (current / 1024.0 ** 2, elapsed)
+        del peakels
+        print("{0:>6}: {1:8.1f} MB, {2:6.2f} s".format(name, results[name][0], elapsed))
+    return results
+
+
+class _BinDictIndex(object):
+    """
+    previous implementation of PeakelIndex: peakels in bins of 1 Da,
+    candidates taken in the 3 neighbouring bins
+    """
+    def __init__(self, peakels, bin_size=1):
+        self._index = ddict(list)
+        self.inv_bin_size = 1.0 / bin_size
+        for p in peakels:
+            self._index[int(p.moz * self.inv_bin_size)].append(p)
+
+    def get_peakels_in_range(self, moz, mz_tol_ppm):
+        bin_ = int(moz * self.inv_bin_size)
+        tol_da = (mz_tol_ppm * moz) / 1e6
+        peaks = []
+        for i in range(bin_ - 1, bin_ + 2):
+            peaks.extend(self._index.get(i, []))
+        peaks = [p for p in peaks if abs(p.moz - moz) < tol_da]
+        peaks.sort(key=lambda x: x.moz)
+        return peaks, np.array([(p.moz - moz) / moz * 1e6 for p in peaks])
+
+
+def bench_range_queries(n=200000, nb_queries=100000, mz_tol_ppm=10.0):
+    """
+    compare range queries of the previous bin-dict index against
+    `PeakelIndex.get_peakels_in_range` and `PeakelIndex.get_indexes_in_ranges`
+    :param n: number of peakels
+    :param nb_queries:
+    :param mz_tol_ppm:
+    :return: dict key: implementation name, value: (build time, query time) in seconds
+    """
+    rng = np.random.RandomState(0)
+    peakels = [Peakel(moz, moz, moz, 0.0) for moz in rng.uniform(100.0, 1000.0, n).tolist()]
+    queries = rng.uniform(100.0, 1000.0, nb_queries)
+
+    results = {}
+    for name, index_class in (('bin dict', _BinDictIndex), ('sorted array', PeakelIndex)):
+        t = time.time()
+        index = index_class(peakels)
+        build = time.time() - t
+        t = time.time()
+        nb_matches = sum(len(index.get_peakels_in_range(moz, mz_tol_ppm)[0]) for moz in queries.tolist())
+        results[name] = (build, time.time() - t)
+        print("{0:>13}: build {1:6.3f} s, {2} queries {3:6.3f} s, {4} matches".format(
+            name, build, nb_queries, results[name][1], nb_matches))
+
+    t = time.time()
+    query_indexes, _, _ = index.get_indexes_in_ranges(queries, mz_tol_ppm)
+    results['batch'] = (results['sorted array'][0], time.time() - t)
+    print("{0:>13}: build {1:6.3f} s, {2} queries {3:6.3f} s, {4} matches".format(
+        'batch', results['batch'][0], nb_queries, results['batch'][1], len(query_indexes)))
+    return results
+
+
+def bench_dbscan(n=1000000, eps=0.001):
+    """
+    compare the scikit-learn DBSCAN against `clusterize_dbscan_1d` on retention times.
+    eps is small to keep the neighbours graph of scikit-learn in memory
+    :param n: number of peakels
+    :param eps:
+    :return: dict key: implementation name, value: time in seconds
+    """
+    rng = np.random.RandomState(0)
+    rts = rng.uniform(0.0, 1200.0, n)
+    peakels = list(range(n))
+
+    results = {}
+    t = time.time()
+    labels = DBSCAN(eps=eps, min_samples=1).fit(rts[:, np.newaxis]).labels_
+    results['sklearn'] = time.time() - t
+    print("{0:>8}: {1:6.2f} s, {2} clusters".format('sklearn', results['sklearn'], len(set(labels.tolist()))))
+
+    t = time.time()
+    clusters = clusterize_dbscan_1d(rts, peakels, eps=eps)
+    results['1d'] = time.time() - t
+    print("{0:>8}: {1:6.2f} s, {2} clusters".format('1d', results['1d'], len(clusters)))
+    return results
+
+
+BENCHMARKS = {'memory': bench_memory,
+              'range': bench_range_queries,
+              'dbscan': bench_dbscan}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mzOS benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("-n", type=int, default=None, help="size of the synthetic dataset")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    kwargs = {} if args.n is None else {'n': args.n}
+    BENCHMARKS[args.benchmark](**kwargs)
+
+
+if __name__ == '__main__':
+    main()
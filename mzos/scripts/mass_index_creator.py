@@ -0,0 +1,40 @@
+from __future__ import absolute_import
+import argparse
+import logging
+import time
+
+from mzos.database_finder import BucketMassIndex, DatabaseSearch
+
+
+def build_mass_index(kind, database, prefix=None):
+    """
+    write the bucket mass index of a database, used by the 'memory' engine
+    of DatabaseSearch as long as the database is not modified
+    :param kind: 'hmdb' or 'lmsd'
+    :param database: sqlite file
+    :param prefix: path prefix of the written files, default next to the database
+    :return: prefix
+    """
+    t = time.time()
+    index = BucketMassIndex.for_kind(kind, database)
+    prefix = prefix or BucketMassIndex.get_prefix(database)
+    index.save(prefix)
+    logging.info("Indexed {0} masses of {1} in {2} buckets, {3:.2f} s".format(
+        len(index), database, len(index.offsets) - 1, time.time() - t))
+    return prefix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build the bucket mass index of the hmdb or lmsd sqlite file")
+    parser.add_argument("kind", choices=['hmdb', 'lmsd'])
+    parser.add_argument("database", nargs='?', default=None,
+                        help="sqlite file, default mzos/ressources/<kind>.sqlite")
+    parser.add_argument("-o", "--output", default=None, help="path prefix of the written files")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    database = args.database or (DatabaseSearch.HMDB_FILE if args.kind == 'hmdb' else DatabaseSearch.LMSD_FILE)
+    build_mass_index(args.kind, database, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ import yaml
 from mzos import ressources
 from mzos.peaklist_reader import PeakListReader
 from mzos.annotator import PeakelsAnnotator
+from mzos.feature import PeakelIndex
 from mzos.database_finder import DatabaseSearch
 from mzos.stats import StatsModel
 from mzos.exp_design import ExperimentalSettings
@@ -53,6 +54,14 @@ def run_analysis(**kwargs):
     bayes = kwargs['bayes']
     kwargs.pop('bayes')
 
+    use_cache = kwargs.pop('use_cache', True)
+
+    n_jobs = kwargs.pop('n_jobs', None)
+
+    db_engine = kwargs.pop('db_engine', 'sqlite')
+
+    search_all_adducts = kwargs.pop('search_all_adducts', False)
+
     if xcms_pkl is None or not xcms_pkl:
         raise ValueError("Supply a XCMS peaklist.")
     if not os.path.isfile(xcms_pkl):
@@ -77,15 +86,16 @@ def run_analysis(**kwargs):
     logging.basicConfig(level=logging.INFO)
     t1 = time.clock()
 
-    peakels = PeakListReader(xcms_pkl, exp_settings).get_peakels()
+    peakels = PeakListReader(xcms_pkl, exp_settings, use_cache=use_cache).get_peakels()
     logging.info("Peaklist loaded.")
 
     # annotation
     peakels_annotator = PeakelsAnnotator(peakels, exp_settings)
     logging.info("Annotating...")
 
-    best_monos = peakels_annotator.annotate()
+    best_monos = peakels_annotator.annotate(n_jobs=n_jobs)
     logging.info("Monoisotopic found: #{0}".format(len(best_monos)))
+    logging.info(PeakelIndex.get_profiling_summary())
 
     # database finding
     db = []
@@ -96,9 +106,14 @@ def run_analysis(**kwargs):
             db.append(d)
     db = '+'.join(db)
 
-    search = DatabaseSearch(db, exp_settings)
+    search = DatabaseSearch(db, exp_settings, engine=db_engine)
     logging.info("Searching in database...")
     adducts_l = ['H1']
+    if search_all_adducts:
+        # searched in the same pass than H1, each feature with the adducts of its polarity
+        polarities = {IONISATION_MODE.NEG if p.polarity < 0 else IONISATION_MODE.POS for p in peakels}
+        for pol in sorted(polarities):
+            adducts_l += exp_settings.get_adducts_table(pol)
     nb_metabs, not_found = search.assign_formula(peakels, adducts_l, exp_settings.mz_tol_ppm)
     logging.info("Found #{} metabolites, #{} "
                  "elution peak with no metabolite assignments".format(nb_metabs, not_found))
@@ -109,6 +124,7 @@ def run_analysis(**kwargs):
     # populate annotations objects
     model.calculate_score()
     logging.info("Done.")
+    logging.info(PeakelIndex.get_profiling_summary())
 
     # scoring bayesian inferer
     if bayes:
@@ -136,7 +152,11 @@ def main():
         'is_dims': False,
         'db_search': ['hmdb', 'lmsd'],
         'bayes': True,
-        'output': 'results.csv'
+        'output': 'results.csv',
+        'use_cache': True,
+        'n_jobs': None,
+        'db_engine': 'sqlite',
+        'search_all_adducts': False
     }
 
     current_files = set(os.listdir(os.curdir))
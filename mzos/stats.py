@@ -1,7 +1,8 @@
 from __future__ import absolute_import
 from cmath import isnan
 from math import sqrt, log10
-from .feature import PeakelIndex
+from .feature import PeakelIndex, get_areas_matrix
+from .isotopes import IsotopesTable
 from .utils import calculate_mass_diff_da
 from collections import defaultdict as ddict
 import numpy as np
@@ -33,19 +34,25 @@ class StatsModel(object):
         return -10 * log10(x)
 
     # name metrics, weight allowed
-    def __init__(self, features, moz_tol_ppm):
+    def __init__(self, features, moz_tol_ppm, isotopes_table=None):
         self.features = features
         self.moz_tol_ppm = moz_tol_ppm
         self.metrics = [("isotopic_pattern_rmsd", 2.0), ("mass_difference", 1.0)]
 
+        # used to retrieve the isotope index of each isotope
+        if isotopes_table is None:
+            isotopes_table = IsotopesTable(max_charge=max([f.charge for f in features] + [1]),
+                                           max_isotopes_nb=max([len(f.isotopes) for f in features] + [5]))
+        self.isotopes_table = isotopes_table
+
         # sorted_features_by_area = sorted(features, key=lambda _: _.area)
 
         feature_by_index = ddict(list)
-        # assuming they are sorted by mass
         for f in self.features:
             feature_by_index[1].append(f)
-            for (i, isotope) in enumerate(f.isotopes):
-                feature_by_index[i + 2].append(isotope)
+            for isotope in f.isotopes:
+                idx = self.isotopes_table.get_isotope_index(isotope.moz - f.moz, f.charge)
+                feature_by_index[idx + 1].append(isotope)
         # retrive min max intensity value by intensity index
         self.min_max_values_by_isotopes_index = dict()
 
@@ -53,12 +60,14 @@ class StatsModel(object):
             sorted_values = sorted(values, key=lambda __: __.area)
             self.min_max_values_by_isotopes_index[index] = (sorted_values[0].area, sorted_values[-1].area)
 
-    def _calculate_worst_cases(self, feature, theoritical_isotopes):
+    def _calculate_worst_cases(self, feature, theoritical_isotopes, peakel_index=None):
         """
         @param: feature, the feature to evaluate
         @param: theortical isotopic pattern
+        @param: peakel_index, index of the isotopic pattern of the feature, built if None
         """
-        peakel_index = PeakelIndex(feature.get_isotopic_pattern_as_peakel())
+        if peakel_index is None:
+            peakel_index = PeakelIndex(feature.get_isotopic_pattern_as_peakel())
         rmsd, mass_diff = 0, 0
         for idx, iso in enumerate(theoritical_isotopes):
             # find isotopes
@@ -78,6 +87,8 @@ class StatsModel(object):
         feature: peakel instance with several isotopes
         metabolites: list of metabolites
         """
+        # same isotopic pattern for all annotations, indexed once
+        peakel_index = None
         for annot in feature.annotations:
 
             m = annot.metabolite
@@ -89,7 +100,8 @@ class StatsModel(object):
 
             ip = m.isotopic_pattern_pos if feature.polarity == 1 else m.isotopic_pattern_neg
             isotopic_pattern = [(float(a), float(b)) for a, b in eval(ip)]
-            worst_rmsd, worst_mass_diff, peakel_index = self._calculate_worst_cases(feature, isotopic_pattern)
+            worst_rmsd, worst_mass_diff, peakel_index = self._calculate_worst_cases(feature, isotopic_pattern,
+                                                                                    peakel_index)
 
             # interpol_worst_rmsd, interpol_worst_mass_diff = 1.0, 1.0
             # as we interpolate al line y = x we use directly the result and pass
@@ -132,32 +144,31 @@ class StatsModel(object):
             return float('nan')
         max_rel_int = max(theo_ip, key=lambda x: x[1])[1]
         isotopic_pattern = feature.get_isotopic_pattern_as_peakel()
+        row_by_peakel = {p: i for i, p in enumerate(isotopic_pattern)}
 
-        sample_rmsd = []
-        for sample in list(feature.area_by_sample_name.keys()):
-            rmsd = 0.0
-            max_real_int = max(isotopic_pattern,
-                               key=lambda x: x.area_by_sample_name[sample]).area_by_sample_name[sample]
-
-            if not max_real_int:
-                continue
-
-            for idx, (moz, rel_int) in enumerate(theo_ip):
-                p = peakel_idx.get_nearest_peakel(moz, self.moz_tol_ppm)
-                if p is not None:
-                    feature.ip_score_isotopes.add(p)
-                    area = p.area_by_sample_name[sample]
-                    # fixme: could be penalized ?
-                    if not area:
-                        continue
-                    # rmsd += ((area * max_rel_int / max_real_int) - rel_int) ** 2
-                    rmsd += ((area / max_real_int * 100) * max_rel_int - rel_int) ** 2
-                else:
-                    # could do something like the first quartile of the distribution of all intensities
-                    pass
+        # one row per peakel, one column per sample
+        areas = get_areas_matrix(isotopic_pattern).astype(np.float64)
+        max_real_int = areas.max(axis=0)
+        samples = max_real_int != 0
+        if not samples.any():
+            return float('nan')
+        areas, max_real_int = areas[:, samples], max_real_int[samples]
 
-            sample_rmsd.append(sqrt(rmsd))
+        rmsd = np.zeros(len(max_real_int))
+        for idx, (moz, rel_int) in enumerate(theo_ip):
+            p = peakel_idx.get_nearest_peakel(moz, self.moz_tol_ppm)
+            if p is not None:
+                feature.ip_score_isotopes.add(p)
+                area = areas[row_by_peakel[p]]
+                # fixme: could be penalized ?
+                found = area != 0
+                # rmsd += ((area * max_rel_int / max_real_int) - rel_int) ** 2
+                rmsd[found] += ((area[found] / max_real_int[found] * 100) * max_rel_int - rel_int) ** 2
+            else:
+                # could do something like the first quartile of the distribution of all intensities
+                pass
 
+        sample_rmsd = np.sqrt(rmsd)
         return np.mean(sample_rmsd) if method == "mean" else np.median(sample_rmsd)
 
     def _calculate_rmsd(self, feature, peakel_idx, theo_ip):
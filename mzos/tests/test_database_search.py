@@ -1,10 +1,19 @@
 from __future__ import absolute_import
+import os
 import unittest
+import os.path as op
+import shutil
+import sqlite3
+import tempfile
 
-from mzos.database_finder import DatabaseSearch
-from mzos.database_finder import get_moz_bounds
+import numpy as np
+
+from mzos.database_finder import BucketMassIndex, DatabaseSearch, MassIndex, Metabolite, connect_read_only
+from mzos.database_finder import bulk_search, get_adducts_masses, get_moz_bounds, has_index_on
+from mzos.exp_design import ExperimentalSettings, IONISATION_MODE
 from mzos.feature import Peakel
 from mzos.formula import Formula
+from mzos.scripts.mass_index_creator import build_mass_index
 from mzos.tests import WithHMDBMixin
 
 
@@ -36,3 +45,164 @@ class TestDatabaseSearch(WithHMDBMixin, unittest.TestCase):
         self.assertAlmostEqual(m, 260.029718526, places=2)
 
 
+class TestMassIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.hmdb = op.join(self.directory, 'hmdb.sqlite')
+        conn = sqlite3.connect(self.hmdb)
+        conn.execute('create table metabolite ({0})'.format(','.join(Metabolite.COLUMNS)))
+        rows = [('HMDB1', 'Fructose 6-phosphate', 'C6H13O9P', '', 260.029718526, 0.0, '', '', '', 'C00085'),
+                ('HMDB2', 'Glucose 6-phosphate', 'C6H13O9P', '', 260.02972, 0.0, '', '', '', 'C00092'),
+                ('HMDB3', 'no kegg', 'C6H13O9P', '', 260.0297, 0.0, '', '', '', None),
+                ('HMDB4', 'Glucose', 'C6H12O6', '', 180.06339, 0.0, '', '', '', 'C00031')]
+        conn.executemany('insert into metabolite values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, null, null)', rows)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_mass_index(self):
+        index = MassIndex.for_hmdb(self.hmdb)
+        self.assertEqual(len(index), 4)
+        starts, stops = index.get_ranges([180.06339, 300.0], [260.0297, 301.0])
+        self.assertEqual((starts.tolist(), stops.tolist()), ([0, 4], [2, 4]))
+        # entities are built once
+        self.assertIs(index.get_entities([1])[0], index.get_entities([1])[0])
+        # a wrong path is not created as an empty database
+        missing = op.join(self.directory, 'missing.sqlite')
+        self.assertRaises(sqlite3.OperationalError, MassIndex.for_hmdb, missing)
+        self.assertFalse(op.exists(missing))
+
+    def test_bulk_search(self):
+        masses = [180.06339, 260.0297, 500.0]
+        min_masses, max_masses = [m - 0.001 for m in masses], [m + 0.001 for m in masses]
+        hits = lambda: [[m.hmdb_id for m in r] for r in bulk_search(self.hmdb, 'hmdb', masses, min_masses,
+                                                                   max_masses)]
+        # temporary copy of the masses without index
+        expected = hits()
+        self.assertEqual(expected, [['HMDB4'], ['HMDB1', 'HMDB2'], []])
+        conn = sqlite3.connect(self.hmdb)
+        self.assertFalse(has_index_on(conn, 'metabolite', 'mono_mass'))
+        conn.execute('create index mass_index on metabolite(mono_mass)')
+        self.assertTrue(has_index_on(conn, 'metabolite', 'mono_mass'))
+        self.assertFalse(has_index_on(conn, 'metabolite', 'kegg_id'))
+        plan = conn.execute('explain query plan select * from metabolite where mono_mass >= 1.0 and mono_mass <= 2.0')
+        self.assertTrue(any('mass_index' in row[-1] for row in plan))
+        conn.close()
+        # join on the indexed table
+        self.assertEqual(hits(), expected)
+
+    def test_memory_engine(self):
+        peakels = []
+        for moz, polarity in ((260.029718526 - 1.007825, -1), (180.06339 + 1.007825, 1), (500.0, 1)):
+            peakel = Peakel(moz, 0.0, 0.0, 0.0)
+            peakel.charge = 1
+            peakel.polarity = polarity
+            peakels.append(peakel)
+        self.assertRaises(ValueError, DatabaseSearch, 'hmdb', None, engine='foo')
+        self.assertRaises(ValueError, DatabaseSearch, 'kegg', None)
+        db_search = DatabaseSearch('hmdb', None, engine='memory')
+        db_search.HMDB_FILE = self.hmdb
+        self.assertEqual(db_search.assign_formula(peakels, ['H1'], 10.0), (3, 1))
+        # nearest first, metabolites without kegg id are skipped
+        self.assertEqual([a.metabolite.name for a in peakels[0].annotations],
+                         ['Fructose 6-phosphate', 'Glucose 6-phosphate'])
+        self.assertEqual([(a.metabolite.name, a.for_adduct) for a in peakels[1].annotations],
+                         [('Glucose', '[M-H]=')])
+        self.assertEqual(peakels[2].annotations, [])
+
+    def test_assign_formula_by_chunks(self):
+        peakels = []
+        for moz in (259.0219, 181.0712, 500.0):
+            peakel = Peakel(moz, 0.0, 0.0, 0.0)
+            peakel.charge = 1
+            peakel.polarity = -1 if moz > 200 else 1
+            peakels.append(peakel)
+        db_search = DatabaseSearch('hmdb', None, engine='memory')
+        db_search.HMDB_FILE = self.hmdb
+        counts = [(len(chunk), m_count, not_found) for chunk, m_count, not_found in
+                  db_search.assign_formula_by_chunks([peakels[:2], peakels[2:]], ['H1'], 10.0)]
+        self.assertEqual(counts, [(2, 3, 0), (1, 0, 1)])
+        self.assertEqual(len(peakels[0].annotations), 2)
+
+    def test_engines(self):
+        conn = connect_read_only(self.hmdb)
+        self.assertRaises(sqlite3.OperationalError, conn.execute, 'delete from metabolite')
+        conn.close()
+
+        annotations = []
+        for engine in DatabaseSearch.ENGINES:
+            peakels = []
+            for moz in (259.0219, 260.0297, 181.0712):
+                peakel = Peakel(moz, 0.0, 0.0, 0.0)
+                peakel.charge = 1
+                peakel.polarity = -1 if moz > 200 else 1
+                peakels.append(peakel)
+            db_search = DatabaseSearch('hmdb', None, engine=engine)
+            db_search.HMDB_FILE = self.hmdb
+            self.assertEqual(db_search.assign_formula(peakels, ['H1', 'Na1'], 10.0), (3, 4))
+            annotations.append([[(a.metabolite.name, a.for_adduct) for a in p.annotations] for p in peakels])
+        for other in annotations[1:]:
+            self.assertEqual(other, annotations[0])
+
+    def test_adducts_table(self):
+        # [M+Na]+ and [2M+H]+ of glucose, [M-H]- of fructose 6-phosphate
+        adducts = ['H1', ('[M+Na+]', 1, 1, -21.98194), ('[2M+H]+', 2, 1, 1.007276)]
+        for engine in DatabaseSearch.ENGINES:
+            peakels = []
+            for moz, polarity in ((180.06339 + 1.007825 + 21.98194, 1), (2 * (180.06339 + 1.007825) - 1.007276, 1),
+                                  (260.029718526 - 1.007825, -1)):
+                peakel = Peakel(moz, 0.0, 0.0, 0.0)
+                peakel.charge = 1
+                peakel.polarity = polarity
+                peakels.append(peakel)
+            db_search = DatabaseSearch('hmdb', None, engine=engine)
+            db_search.HMDB_FILE = self.hmdb
+            # positive adducts are not searched for the negative feature
+            self.assertEqual(db_search.assign_formula(peakels, adducts, 10.0), (4, 4))
+            self.assertEqual([[(a.metabolite.name, a.for_adduct) for a in p.annotations] for p in peakels],
+                             [[('Glucose', '[M+Na+]')], [('Glucose', '[2M+H]+')],
+                              [('Fructose 6-phosphate', '[M+H]='), ('Glucose 6-phosphate', '[M+H]=')]])
+
+    def test_negative_adducts_table(self):
+        # [M+Cl]- of glucose with the adducts of both polarities
+        exp_settings = ExperimentalSettings(10.0, IONISATION_MODE.POS, False)
+        adducts = exp_settings.get_adducts_table(IONISATION_MODE.NEG) + exp_settings.get_adducts_table()
+        for engine in DatabaseSearch.ENGINES:
+            peakel = Peakel(180.06339 + 34.968853, 0.0, 0.0, 0.0)
+            peakel.charge = 1
+            peakel.polarity = -1
+            masses = get_adducts_masses([peakel], adducts)
+            self.assertAlmostEqual(masses[0][0], 180.06339, places=5)
+            self.assertTrue(np.isnan(masses[-1][0]))
+            db_search = DatabaseSearch('hmdb', None, engine=engine)
+            db_search.HMDB_FILE = self.hmdb
+            self.assertEqual(db_search.assign_formula([peakel], adducts, 10.0), (1, 3))
+            self.assertEqual([(a.metabolite.name, a.for_adduct) for a in peakel.annotations],
+                             [('Glucose', 'Adduct [M+Cl (35)]')])
+
+    def test_bucket_mass_index(self):
+        index = MassIndex.for_hmdb(self.hmdb)
+        prefix = build_mass_index('hmdb', self.hmdb)
+        self.assertEqual(prefix, BucketMassIndex.get_prefix(self.hmdb))
+        buckets = BucketMassIndex.load(prefix)
+        self.assertIsInstance(buckets.masses, np.memmap)
+        masses = np.array([180.06339, 260.0297, 260.03, 500.0, 10.0])
+        min_masses, max_masses = masses - 0.0005, masses + 0.0005
+        # ranges cover the whole buckets of the bounds
+        starts, stops = buckets.get_ranges(min_masses, max_masses)
+        self.assertEqual((starts.tolist(), stops.tolist()), ([0, 1, 1, 4, 0], [1, 4, 4, 4, 0]))
+        self.assertEqual([[m.hmdb_id for m in hits] for hits in buckets.search(masses, min_masses, max_masses)],
+                         [[m.hmdb_id for m in hits] for hits in index.search(masses, min_masses, max_masses)])
+
+        # used by the memory engine until the database changes
+        db_search = DatabaseSearch('hmdb', None, engine='memory')
+        db_search.HMDB_FILE = self.hmdb
+        self.assertIsInstance(db_search.get_mass_indexes()[0], BucketMassIndex)
+        conn = sqlite3.connect(self.hmdb)
+        conn.execute("insert into metabolite (acession, mono_mass, kegg_id) values ('HMDB5', 100.0, 'C1')")
+        conn.commit()
+        conn.close()
+        os.utime(self.hmdb, (0, 0))
+        self.assertIsNone(BucketMassIndex.load_if_up_to_date(self.hmdb))
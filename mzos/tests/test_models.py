@@ -1,17 +1,24 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import unittest
+import pickle
+from collections import defaultdict as ddict
 import os.path as op
+import tempfile
 
 import scipy as sp
 import numpy as np
 
-from mzos.feature import Peakel, Annotation, Attribution, PeakelIndex
-from mzos.clustering import clusterize_hierarchical, clusterize_basic, clusterize_dbscan
+from mzos.feature import Peakel, CompactPeakel, Annotation, Attribution, AttributionSet, PeakelIndex, \
+    PeakelIndex2D, SampleAreaMatrix
+from mzos.annotator import PeakelsAnnotator
+from mzos.isotopes import IsotopesTable, HALOGEN_ISOTOPES
+from mzos.clustering import clusterize_hierarchical, clusterize_basic, clusterize_dbscan, \
+    clusterize_hierarchical_1d, get_correlation_distances, clusterize_dbscan_1d
 from mzos.peakel_clusterer import PeakelClusterer
 from mzos.exp_design import ExperimentalSettings
 from mzos.formula import Formula
-from mzos.database_finder import Metabolite
+from mzos.database_finder import Metabolite, CompactMetabolite
 
 
 class TestClustering(unittest.TestCase):
@@ -55,6 +62,15 @@ class TestClustering(unittest.TestCase):
         print(("len clusters basic: {0}".format(len(clusters))))
         self.assertGreaterEqual(4, len(clusters))
 
+    def test_clusterize_basic_sweep(self):
+        peakels = [Peakel(100.0, 0.0, 0.0, rt) for rt in [10.5, 2.0, 30.0, 0.0, 10.0, 1.0]]
+        clusters = clusterize_basic(peakels, PeakelClusterer.BASIC_RT_CALLABLE, 6.0)
+        self.assertEqual([[p.rt for p in c] for c in clusters], [[0.0, 1.0, 2.0], [10.0, 10.5], [30.0]])
+        # compared to the running mean of the cluster, not to its first peakel
+        peakels = [Peakel(100.0, 0.0, 0.0, rt) for rt in [0.0, 2.0, 4.0]]
+        clusters = clusterize_basic(peakels, PeakelClusterer.BASIC_RT_CALLABLE, 6.0)
+        self.assertEqual([[p.rt for p in c] for c in clusters], [[0.0, 2.0], [4.0]])
+
     def test_clusterize_hierarchical(self):
         rts = [[f.rt] for f in self.features]
         matrix_dist = sp.spatial.distance.pdist(np.array(rts))  # euclidean distance
@@ -62,6 +78,50 @@ class TestClustering(unittest.TestCase):
         print(("len clusters hierarchical: {0}".format(len(clusters))))
         self.assertGreaterEqual(4, len(clusters))
 
+    def test_clusterize_hierarchical_1d(self):
+        rng = np.random.RandomState(0)
+        rts = rng.uniform(0.0, 100.0, 50)
+        peakels = [Peakel(100.0, 0.0, 0.0, rt) for rt in rts.tolist()]
+        for method in ('single', 'complete'):
+            k = sp.cluster.hierarchy.linkage(sp.spatial.distance.pdist(rts[:, np.newaxis]), method=method)
+            labels = sp.cluster.hierarchy.fcluster(k, 6.0, criterion='distance')
+            expected = {frozenset(p for p, l in zip(peakels, labels) if l == label) for label in set(labels)}
+            clusters = clusterize_hierarchical_1d(peakels, rts, 6.0, method)
+            self.assertEqual({frozenset(c) for c in clusters}, expected)
+        self.assertRaises(ValueError, clusterize_hierarchical_1d, peakels, rts, 6.0, 'average')
+
+        peakel_clusterer = PeakelClusterer(self.features, rt_clust_method=2, corr_int_method=2)
+        self.assertEqual([len(c) for c in peakel_clusterer.clusterize_by_rt(6.0)], [4, 2, 1])
+
+    def test_correlation_chunks(self):
+        ints = [list(f.area_by_sample_name.values()) for f in self.features] + [[1.0, 1.0, 1.0, 1.0]]
+        matrix_dist = get_correlation_distances(ints)
+        self.assertEqual(matrix_dist.shape, (28,))
+        self.assertTrue((sp.spatial.distance.squareform(matrix_dist)[-1, :-1] == 1.0).all())
+
+        # not split by default
+        self.assertEqual(PeakelClusterer(self.features)._get_corr_chunks(self.features), [self.features])
+        peakel_clusterer = PeakelClusterer(self.features, rt_clust_method=2, corr_int_method=2,
+                                           max_corr_cluster_size=3)
+        # split at the largest rt gaps
+        chunks = peakel_clusterer._get_corr_chunks(self.features[::-1])
+        self.assertEqual([[f.rt for f in c] for c in chunks],
+                         [[1256.52, 1258.52], [1261.52, 1262.52], [1274.52, 1275.52, 1281.52]])
+        clusters, correlations = peakel_clusterer._check_update_corrs([self.features], None, 0.4,
+                                                                      with_correlations=True)
+        self.assertTrue(all(len(c) <= 3 for c in clusters))
+        self.assertEqual([m.shape for m in correlations], [(len(c), len(c)) for c in clusters])
+        all_correlations = PeakelClusterer.get_intensity_correlations(self.features)
+        positions = [self.features.index(p) for p in clusters[0]]
+        self.assertTrue(np.allclose(correlations[0], all_correlations[np.ix_(positions, positions)]))
+
+        # a chunk of one peakel is kept as a cluster, a rt cluster of one peakel is not
+        peakel_clusterer.max_corr_cluster_size = 2
+        chunks = peakel_clusterer._get_corr_chunks(self.features[4:])
+        self.assertEqual([[f.rt for f in c] for c in chunks], [[1274.52, 1275.52], [1281.52]])
+        clusters = peakel_clusterer._check_update_corrs([self.features[4:], self.features[:1]], None, 0.4)
+        self.assertEqual(sorted(p.rt for c in clusters for p in c), [1274.52, 1275.52, 1281.52])
+
     def test_clusterize_dbscan_rt(self):
         clusters = clusterize_dbscan([[x.rt] for x in self.features], self.features, eps=3.0, min_samples=1)
         for c in clusters:
@@ -72,6 +132,41 @@ class TestClustering(unittest.TestCase):
         print(("len clusters dbscan: {0}".format(len(clusters))))
         self.assertGreaterEqual(4, len(clusters))
 
+    def test_check_update_corrs_n_jobs(self):
+        rng = np.random.RandomState(0)
+        rt_clusters = []
+        for size in (3, 40, 12, 25):
+            cluster = []
+            for i in range(size):
+                p = Peakel(100.0, 0.0, 0.0, 10.0 * size)
+                p.area_by_sample_name = dict(zip('abcdef', rng.uniform(1e3, 1e5, 6)))
+                cluster.append(p)
+            rt_clusters.append(cluster)
+        peakel_clusterer = PeakelClusterer([], corr_int_method=2)
+        expected = peakel_clusterer._check_update_corrs(rt_clusters, None, 0.4)
+        self.assertEqual(sorted(n for n, _ in peakel_clusterer.corr_timings), [3, 12, 25, 40])
+        clusters, correlations = peakel_clusterer._check_update_corrs(rt_clusters, None, 0.4,
+                                                                      with_correlations=True, n_jobs=2)
+        self.assertEqual(clusters, expected)
+        self.assertEqual([m.shape[0] for m in correlations], [len(c) for c in clusters])
+        self.assertRaises(ValueError, peakel_clusterer._check_update_corrs, rt_clusters, None, 0.4, n_jobs=0)
+
+    def test_clusterize_dbscan_1d(self):
+        from sklearn.cluster import DBSCAN
+        rts = np.round(np.random.RandomState(0).uniform(0.0, 100.0, 200), 1)
+        labels = DBSCAN(eps=0.5, min_samples=1).fit(rts[:, np.newaxis]).labels_
+        expected = ddict(list)
+        for i, label in enumerate(labels):
+            expected[label].append(i)
+        self.assertEqual(clusterize_dbscan_1d(rts, list(range(200)), eps=0.5), list(expected.values()))
+        self.assertEqual(clusterize_dbscan_1d([], [], eps=0.5), [])
+
+        # eps defaults to error_rt / 2
+        peakel_clusterer = PeakelClusterer(self.features, rt_clust_method=3, corr_int_method=2)
+        self.assertEqual([len(c) for c in peakel_clusterer.clusterize_by_rt(6.0)], [4, 2, 1])
+        peakel_clusterer = PeakelClusterer(self.features, rt_clust_method=3, corr_int_method=2, dbscan_eps=0.35)
+        self.assertEqual(len(peakel_clusterer.clusterize_by_rt(6.0)), 7)
+
     def test_clusterize_hierarchical_int(self):
         ints = [list(f.area_by_sample_name.values()) for f in self.features]
         matrix_dist = sp.spatial.distance.pdist(np.array(ints), metric="correlation")  # euclidean distance
@@ -146,11 +241,357 @@ class TestClustering(unittest.TestCase):
         real_mass = self.f1.get_real_mass()
         self.assertAlmostEqual(real_mass, self.f1.moz + 1.007276)
 
+    def test_attribution_set(self):
+        p = Peakel(300.0, 0.0, 0.0, 100.0)
+        a1, a2, a3 = Attribution('Isotope C13', 1, 1), Attribution('Isotope C13', 2, 2), Attribution('[M+Na]', 1, 2)
+        for a in (a1, a2, a3, Attribution('Isotope C13', 1, 1)):
+            p.add_attribution(a)
+        self.assertEqual(len(p.attributions), 3)
+        self.assertEqual(list(p.attributions), [a1, a2, a3])
+        # keys are not contiguous, all attributions are grouped
+        self.assertEqual(p.get_attributions_by_parent_id(), {1: [a1, a3], 2: [a2]})
+        self.assertEqual(p.get_attributions_by_charge(), {1: [a1], 2: [a2, a3]})
+        self.assertEqual(p.get_attributions_by(lambda x: x.attribution), {'Isotope C13': [a1, a2], '[M+Na]': [a3]})
+        self.assertEqual(p.get_attributions_with_charge(2), [a2, a3])
+
+        p.remove_attribution_with_parent(1)
+        self.assertEqual(p.get_attributions_with_parent(1), [a3])
+        self.assertEqual(p.main_attribution, a2)
+        p.remove_attribution_with_parent(1)
+        self.assertEqual(p.get_attributions_with_parent(1), [])
+        self.assertEqual(p.get_attributions_by_charge(), {2: [a2]})
+
+        copy = pickle.loads(pickle.dumps(p))
+        self.assertEqual(list(copy.attributions), [a2])
+        self.assertEqual(copy.get_attributions_with_parent(2), [a2])
+
+        # indexed by parent id and charge once large, same results
+        many = [Attribution('Isotope C13', i // 2, 1 + i % 2) for i in range(AttributionSet.INDEX_MIN_SIZE + 4)]
+        attributions = AttributionSet(many)
+        self.assertIsNotNone(attributions._by_parent_id)
+        self.assertEqual(attributions.by_parent_id(), {i: many[2 * i:2 * i + 2] for i in range(len(many) // 2)})
+        self.assertEqual(attributions.with_charge(2), many[1::2])
+        self.assertIn(many[0], attributions)
+        attributions.remove(many[0])
+        self.assertNotIn(many[0], attributions)
+        self.assertEqual(attributions.with_parent_id(0), [many[1]])
+        self.assertEqual(list(attributions), many[1:])
+        self.assertRaises(KeyError, attributions.remove, many[0])
+
+    def test_compact_feature(self):
+        f1 = CompactPeakel(1256.52, 0.0, 0.0, 1256.52)
+        f2 = CompactPeakel(1257.52, 0.0, 0.0, 1256.52)
+        self.assertFalse(hasattr(f1, '__dict__'))
+        self.assertRaises(AttributeError, setattr, f1, 'foo', 1)
+        # containers are created at their first access
+        self.assertIsNone(f1._isotopes)
+        self.assertIsNone(f2._attributions)
+        self.assertEqual(pickle.loads(pickle.dumps(f1)).isotopes, set())
+
+        f1.isotopes.add(f2)
+        f2.set_main_attribution(Attribution('isotope c13', f1.id, 1))
+        s, nb_isos, nb_adducts = f1.get_top_down_attribution_tree()
+        self.assertEqual(nb_isos, 1)
+        self.assertIn('({0}=isotope c13)'.format(f2.id), s)
+
+        t = ("acession", "name", "formula", "inchi", 180.06, "average_mass", "description", "status", "origin",
+             "kegg_id", "isotopic_pattern_pos", "isotopic_pattern_neg")
+        m = CompactMetabolite(*t)
+        self.assertFalse(hasattr(m, '__dict__'))
+        self.assertEqual(m.hmdb_id, 'acession')
+        self.assertEqual(m.inchi_key, 'inchi')
+        self.assertEqual(m.mono_mass, 180.06)
+        f1.annotations.append(Annotation(metabolite=m, for_adduct='H2'))
+        self.assertEqual(f1.get_metabolites(), [m])
+
+    def test_sample_area_matrix(self):
+        samples = ['a', 'b', 'c', 'd']
+        values = np.array([[f.area_by_sample_name[s] for f in self.features] for s in samples])
+        matrix = SampleAreaMatrix(values, samples)
+        peakels = [Peakel(f.moz, 0.0, 0.0, f.rt) for f in self.features]
+        for i, p in enumerate(peakels):
+            p.set_area_matrix(matrix, i)
+
+        self.assertEqual(list(peakels[1].area_by_sample_name.keys()), samples)
+        self.assertAlmostEqual(peakels[1].area_by_sample_name['c'], 15000.0)
+        self.assertAlmostEqual(peakels[0].corr_intensity_against(peakels[3]),
+                               self.f1.corr_intensity_against(self.f4), places=5)
+
+        # matrix is not pickled, areas are
+        p = pickle.loads(pickle.dumps(peakels[2]))
+        self.assertIsNone(p.area_matrix)
+        self.assertAlmostEqual(p.area_by_sample_name['d'], 10000 / 1.89, places=2)
+
+        peakel_clusterer = PeakelClusterer(peakels, rt_clust_method=3, corr_int_method=2)
+        clusters = peakel_clusterer.clusterize(error_rt=6.0)
+        self.assertGreaterEqual(4, len(clusters))
+
     def test_nearest_peak(self):
         findex = PeakelIndex(self.features)
         p = findex.get_nearest_peakel(1261.52, 10)
         self.assertAlmostEqual(p.moz, 1261.52)
 
+    def test_query_many(self):
+        findex = PeakelIndex(self.features)
+        ppm = 1261.52 * 10 / 1e6
+        indexes, errors = findex.query_many([1261.52 + ppm / 2, 1261.52 - ppm, 1200.0, 1281.52], 10)
+        self.assertIs(findex.sorted_peaks[indexes[0]], self.f3)
+        self.assertAlmostEqual(errors[0], -5.0, places=3)
+        self.assertEqual(list(indexes[1:3]), [-1, -1])
+        self.assertTrue(np.isnan(errors[1]))
+        self.assertIs(findex.sorted_peaks[indexes[3]], self.f7)
+
+        peakels = findex.get_nearest_peakels([1256.52, 1259.0], 10)
+        self.assertEqual(peakels, [self.f1, None])
+
+    def test_range_query(self):
+        f8 = Peakel(1261.5201, 0.0, 0.0, 1261.52)
+        findex = PeakelIndex(self.features + [f8])
+        peakels, errors = findex.get_peakels_in_range(1261.52005, 10)
+        self.assertEqual(peakels, [self.f3, f8])
+        self.assertEqual(len(errors), 2)
+        self.assertLess(errors[0], 0)
+        self.assertGreater(errors[1], 0)
+
+        queries, indexes, errors = findex.get_indexes_in_ranges([1261.52005, 1200.0, 1281.52], 10)
+        self.assertEqual(list(queries), [0, 0, 2])
+        self.assertEqual([findex.sorted_peaks[i] for i in indexes], [self.f3, f8, self.f7])
+        self.assertAlmostEqual(errors[2], 0.0)
+
+    def test_index_view(self):
+        PeakelIndex.reset_profiling()
+        findex = PeakelIndex(self.features)
+        view = findex.view([self.f1, self.f5, self.f7])
+        self.assertEqual(len(view), 3)
+        self.assertIs(view.get_nearest_peakel(1256.52, 10), self.f1)
+        # not in the view
+        self.assertIsNone(view.get_nearest_peakel(1261.52, 10))
+        self.assertEqual(view.get_nearest_peakels([1274.52, 1262.52, 1281.52], 10), [self.f5, None, self.f7])
+        peakels, errors = view.get_peakels_in_range(1275.0, 400)
+        self.assertEqual(peakels, [self.f5])
+        self.assertIn("1 peakel indexes and 1 index views", PeakelIndex.get_profiling_summary())
+
+    def test_index_2d(self):
+        f1 = Peakel(200.0, 0.0, 0.0, 100.0)
+        f2 = Peakel(201.0020, 0.0, 0.0, 100.5)
+        # closer in moz but not eluting at the same time
+        f3 = Peakel(201.0019, 0.0, 0.0, 300.0)
+        findex = PeakelIndex2D([f1, f2, f3], rt_bin_size=2.0)
+        self.assertIs(findex.get_nearest_peakel(201.00195, 10), f3)
+        self.assertIs(findex.get_nearest_peakel_in_window(201.00195, 10, 100.0, 3.0), f2)
+        self.assertEqual(findex.get_peakels_in_window(201.00195, 10, 200.0, 150.0), [f3, f2])
+        self.assertEqual(findex.get_peakels_in_window(201.00195, 10, 200.0, 3.0), [])
+
+        indexes, errors = findex.query_many_in_window([201.00195, 201.00195, 150.0], [100.0, 299.0, 100.0], 10, 3.0)
+        self.assertEqual([findex.sorted_peaks[i] if i >= 0 else None for i in indexes], [f2, f3, None])
+        self.assertTrue(np.isnan(errors[2]))
+
+        exp_settings = ExperimentalSettings(10, -1, is_dims_exp=False)
+        annotator = PeakelsAnnotator([f1, f2, f3], exp_settings)
+        isotopes = annotator._look_for_isotopes(f1, ddict(set), 1, 0, 3, 6.0)
+        self.assertEqual(isotopes, {1: {f2}})
+
+    def test_batched_isotopes(self):
+        mo = Peakel(300.0, 0.0, 0.0, 100.0)
+        iso1 = Peakel(301.00195, 0.0, 0.0, 100.2)
+        # more intense than iso1, following masses are computed from its moz
+        iso2 = Peakel(302.0029, 0.0, 0.0, 100.1)
+        iso3 = Peakel(305.00656, 0.0, 0.0, 99.9)
+        half = Peakel(300.50098, 0.0, 0.0, 100.0)
+        for p, area in zip([mo, iso1, iso2, iso3, half], [1e6, 1e5, 2e5, 1e4, 1e3]):
+            p.area = area
+        cluster = [mo, iso1, iso2, iso3, half]
+        exp_settings = ExperimentalSettings(10, -1, is_dims_exp=False)
+        annotator = PeakelsAnnotator(cluster, exp_settings)
+        candidates = annotator._get_isotopes_candidates(cluster, 2, 4, 6.0)
+        self.assertEqual(candidates.shape, (5, 2, 4))
+        for p, c in zip(cluster, candidates):
+            batched = annotator._look_for_isotopes(p, ddict(set), 2, 1, 4, 6.0, c)
+            expected = annotator._look_for_isotopes(p, ddict(set), 2, 1, 4, 6.0)
+            self.assertEqual(batched, expected)
+        self.assertEqual(annotator._look_for_isotopes(mo, ddict(set), 2, 1, 4, 6.0, candidates[0]),
+                         {1: {iso1, iso2, iso3}, 2: {half, iso1}})
+
+    def test_isotopes_table(self):
+        table = IsotopesTable(max_charge=2, max_isotopes_nb=3)
+        self.assertEqual(table.offsets.shape, (2, 3, 1))
+        self.assertEqual(table.get(2, 1), ((1.000857 + 0.001091) / 2, 'Isotope C13'))
+        self.assertEqual(table.get_isotope_index(2.0028, 1), 2)
+        self.assertEqual(table.get_isotope_index(1.0, 2), 2)
+
+        # smallest delta, not the smallest tag, within the model tolerance
+        table = IsotopesTable({1.003355: 'Z', 0.997035: 'A'}, max_charge=1, max_isotopes_nb=1)
+        self.assertEqual(table.get(1, 1)[1], 'Z')
+        table = IsotopesTable({0.997035: 'A'}, max_charge=1, max_isotopes_nb=1)
+        self.assertEqual(table.get(1, 1)[1], IsotopesTable.MODEL_TAG)
+
+        isotopes = dict(PeakelsAnnotator.ISOTOPES)
+        isotopes.update(HALOGEN_ISOTOPES)
+        annotator = PeakelsAnnotator([], ExperimentalSettings(10, -1, is_dims_exp=False), isotopes)
+        table = annotator.get_isotopes_table(1, 4)
+        self.assertIs(table, annotator.get_isotopes_table(1, 4))
+        # halogens have their own offsets, model offsets keep their tags
+        self.assertEqual([table.get(1, j)[1] for j in range(1, 5)], ['Isotope C13'] * 4)
+        self.assertEqual(table.get_targets(1, 3), [table.get(1, 3)])
+        self.assertEqual(sorted(table.get_targets(1, 4)),
+                         sorted([table.get(1, 4), (2 * 1.997050, 'Isotope Cl37'), (2 * 1.997953, 'Isotope Br81')]))
+        self.assertEqual(table.get_tag(1, 2, 1.99706), 'Isotope Cl37')
+        self.assertEqual(table.get_isotope_index(1.99706, 1), 2)
+
+    def test_halogen_isotopes(self):
+        # chlorinated compound, M+2 of Cl37 is 19 ppm away from the model offset
+        mo = Peakel(300.0, 0.0, 0.0, 100.0)
+        iso1 = Peakel(300.0 + 1.003355, 0.0, 0.0, 100.0)
+        cl37 = Peakel(300.0 + 1.997050, 0.0, 0.0, 100.0)
+        for p, area in zip([mo, iso1, cl37], [1e6, 2e5, 3e5]):
+            p.area = area
+        cluster = [mo, iso1, cl37]
+        exp_settings = ExperimentalSettings(10, -1, is_dims_exp=False)
+
+        annotator = PeakelsAnnotator(cluster, exp_settings)
+        annotator._find_isotopes(cluster, max_charge=1, max_isotopes_nb=3, max_gap=1)
+        self.assertEqual(mo.isotopes, {iso1})
+
+        isotopes = dict(PeakelsAnnotator.ISOTOPES)
+        isotopes.update(HALOGEN_ISOTOPES)
+        for p in cluster:
+            p.isotopes, p.attributions, p.main_attribution = set(), AttributionSet(), None
+        annotator = PeakelsAnnotator(cluster, exp_settings, isotopes)
+        self.assertEqual(annotator._look_for_isotopes(mo, ddict(set), 1, 1, 3, 6.0), {1: {iso1, cl37}})
+        annotator._find_isotopes(cluster, max_charge=1, max_isotopes_nb=3, max_gap=1)
+        self.assertEqual(mo.isotopes, {iso1, cl37})
+        self.assertEqual((cl37.main_attribution.attribution, cl37.main_attribution.parent_id),
+                         ('Isotope Cl37', mo.id))
+
+    def test_isotopes_graph_resolver(self):
+        mo = Peakel(300.0, 0.0, 0.0, 100.0)
+        iso1 = Peakel(301.00195, 0.0, 0.0, 100.1)
+        iso2 = Peakel(302.0029, 0.0, 0.0, 100.2)
+        # less intense peakel whose isotopes candidates are mo and iso2
+        other = Peakel(300.0029 - 1.001948, 0.0, 0.0, 100.0)
+        for p, area in zip([mo, iso1, iso2, other], [1e6, 5e5, 1e5, 1e3]):
+            p.area = area
+        cluster = [other, iso1, mo, iso2]
+        exp_settings = ExperimentalSettings(10, -1, is_dims_exp=False)
+        annotator = PeakelsAnnotator(cluster, exp_settings)
+        self.assertRaises(ValueError, annotator.annotate, isotopes_resolver='foo')
+
+        mos, isotopes = annotator._find_isotopes_by_graph(cluster, max_charge=1, max_isotopes_nb=3, max_gap=1)
+        self.assertEqual(set(mos), {mo, other})
+        self.assertEqual(isotopes, {iso1, iso2})
+        self.assertEqual(mo.isotopes, {iso1, iso2})
+        self.assertEqual(iso2.main_attribution.parent_id, mo.id)
+        # truncated before mo which is already a monoisotopic peakel
+        self.assertEqual(other.isotopes, set())
+
+    def test_multimer_adducts(self):
+        directory = tempfile.mkdtemp()
+        adducts_conf = op.join(directory, 'adducts.csv')
+        with open(adducts_conf, 'w') as f:
+            f.write("name,nmol,charge,mass\n[2M-H]-,2,-1,-1.007276\n[M-2H]2-,1,-2,1.007276\n")
+        frag_conf = op.join(directory, 'frags.csv')
+        with open(frag_conf, 'w') as f:
+            f.write("name,nmol,charge,mass\n")
+
+        exp_settings = ExperimentalSettings(10, -1, is_dims_exp=False, frag_conf=frag_conf,
+                                            neg_adducts_conf=adducts_conf)
+        self.assertEqual(exp_settings.get_mass_to_check_table(),
+                         [('[2M-H]-', 2, -1, -1.007276), ('[M-2H]2-', 1, -2, 1.007276)])
+        mo = Peakel(298.992724, 0.0, 0.0, 100.0)
+        dimer = Peakel(598.992724, 0.0, 0.0, 100.1)
+        doubly = Peakel(148.992724, 0.0, 0.0, 99.9)
+        # same masses in another cluster
+        far = Peakel(598.992724, 0.0, 0.0, 500.0)
+        cluster = [dimer, mo, doubly]
+        annotator = PeakelsAnnotator(cluster + [far], exp_settings)
+        candidates = annotator._get_parents_candidates([cluster, [far]])
+        self.assertEqual([c.shape for c in candidates], [(3, 2), (1, 2)])
+        self.assertTrue((candidates[1] == -1).all())
+
+        self.assertEqual(annotator.find_adducts_and_fragments([cluster, [far]]), [mo, far])
+        self.assertEqual(mo.adducts, {dimer, doubly})
+        self.assertEqual(dimer.main_attribution, Attribution('[2M-H]-', mo.id, 1))
+        self.assertEqual(doubly.main_attribution, Attribution('[M-2H]2-', mo.id, 2))
+
+    def test_negative_adducts(self):
+        # [M+Cl]- and [M+HCOO]- of the [M-H]- ion with the default adducts file
+        exp_settings = ExperimentalSettings(10, -1, is_dims_exp=False)
+        mo = Peakel(300.0, 0.0, 0.0, 100.0)
+        chloride = Peakel(300.0 + 35.976678, 0.0, 0.0, 100.1)
+        formate = Peakel(300.0 + 46.00548, 0.0, 0.0, 99.9)
+        cluster = [mo, chloride, formate]
+        annotator = PeakelsAnnotator(cluster, exp_settings)
+        self.assertEqual(annotator.find_adducts_and_fragments([cluster]), [mo])
+        self.assertEqual(mo.adducts, {chloride, formate})
+        self.assertEqual(chloride.main_attribution, Attribution('Adduct [M+Cl (35)]', mo.id, 1))
+        self.assertEqual(formate.main_attribution, Attribution('Adduct [M+HCOO]-', mo.id, 1))
+
+    def test_adducts_min_corr_intensity(self):
+        mo = Peakel(300.0, 0.0, 0.0, 100.0)
+        # [M+Na+] and [M-H2O] fragment of mo
+        sodium = Peakel(300.0 + 21.98194, 0.0, 0.0, 100.1)
+        water = Peakel(300.0 - 18.01057, 0.0, 0.0, 99.9)
+        for p, areas in zip([mo, sodium, water], [[1e3, 2e3, 3e3, 4e3], [2e3, 4e3, 6e3, 9e3], [4e3, 3e3, 2e3, 1e3]]):
+            p.area_by_sample_name = dict(zip('abcd', areas))
+            p.area = np.median(areas)
+        cluster = [mo, sodium, water]
+        correlations = PeakelClusterer.get_intensity_correlations(cluster)
+        self.assertEqual(correlations.shape, (3, 3))
+        self.assertAlmostEqual(correlations[0, 2], -1.0)
+
+        exp_settings = ExperimentalSettings(10, 1, is_dims_exp=False)
+        annotator = PeakelsAnnotator(cluster, exp_settings)
+        annotator.find_adducts_and_fragments([cluster], correlations=[correlations], min_corr_intensity=0.9)
+        self.assertEqual(mo.adducts, {sodium})
+        self.assertIsNone(water.main_attribution)
+
+    def test_annotate_n_jobs(self):
+        def get_annotations(n_jobs):
+            rng = np.random.RandomState(0)
+            peakels = []
+            for i in range(30):
+                moz, rt = rng.uniform(100.0, 900.0), rng.uniform(0.0, 300.0)
+                for p in (Peakel(moz, 0.0, 0.0, rt),
+                          Peakel(moz + 1.003355, 0.0, 0.0, rt + 0.1),
+                          Peakel(moz - 18.010565, 0.0, 0.0, rt - 0.1)):
+                    p.area_by_sample_name = dict(zip('abcd', rng.uniform(1e3, 1e5, 4)))
+                    p.area = np.median(list(p.area_by_sample_name.values()))
+                    p.id = len(peakels) + 1
+                    peakels.append(p)
+            exp_settings = ExperimentalSettings(10, -1, is_dims_exp=False)
+            best_mos = PeakelsAnnotator(peakels, exp_settings).annotate(n_jobs=n_jobs)
+            attribution = lambda a: None if a is None else (a.attribution, a.parent_id, a.charge)
+            return [p.id for p in best_mos], \
+                [(sorted(i.id for i in p.isotopes), sorted(i.id for i in p.adducts),
+                  attribution(p.main_attribution)) for p in peakels]
+
+        best_mos, annotations = get_annotations(1)
+        self.assertTrue(any(isotopes for isotopes, _, _ in annotations))
+        self.assertTrue(any(adducts for _, adducts, _ in annotations))
+        self.assertEqual(get_annotations(2), (best_mos, annotations))
+        self.assertEqual(get_annotations(None), (best_mos, annotations))
+
+    def test_annotate_n_jobs_overlapping_clusters(self):
+        def get_annotations(n_jobs):
+            # iso is an isotope of mo1 and mo2 which are in other rt clusters
+            mo1, iso, mo2 = Peakel(100.0, 0.0, 0.0, 100.0), Peakel(101.001948, 0.0, 0.0, 101.0), \
+                Peakel(100.0001, 0.0, 0.0, 102.0)
+            for i, (p, area) in enumerate(zip([mo1, iso, mo2], [1e5, 1e4, 2e5])):
+                p.id, p.area = i + 1, area
+            annotator = PeakelsAnnotator([mo1, iso, mo2], ExperimentalSettings(10, -1, is_dims_exp=False))
+            annotator.annotate(n_jobs=n_jobs, dbscan_eps=0.5)
+            self.assertEqual(len(annotator.peakel_clusterer.clusterize_by_rt(6.0)), 3)
+            return [(sorted(i.id for i in p.isotopes), p.main_attribution) for p in (mo1, iso, mo2)]
+
+        annotations = get_annotations(None)
+        self.assertEqual(annotations[0][0], [2])
+        self.assertEqual(annotations[2][0], [2])
+        self.assertEqual(get_annotations(1), annotations)
+        self.assertEqual(get_annotations(2), annotations)
+        for n_jobs in (0, -2, 1.5):
+            self.assertRaises(ValueError, PeakelsAnnotator([], ExperimentalSettings(10, -1, False))._get_pool,
+                              n_jobs)
+
     def test_fail(self):
         findex = PeakelIndex(self.features)
         ppm = 1261.52 * 10 / 1e6
@@ -1,8 +1,17 @@
 from __future__ import absolute_import
+import csv
 import unittest
 import os.path as op
+import shutil
+import tempfile
+
+import numpy as np
+
 from mzos.peaklist_reader import PeakListReader
+from mzos.peak_table import PeakTable
 from mzos.exp_design import ExperimentalSettings
+from mzos.annotator import PeakelsAnnotator
+from mzos.feature import Peakel
 
 
 class TestPeakListReader(unittest.TestCase):
@@ -14,3 +23,147 @@ class TestPeakListReader(unittest.TestCase):
         self.assertEqual(len(peakels), 3238)
         self.assertTrue(all(isinstance(p.moz, float) for p in peakels))
         self.assertTrue(all(p.moz != 0.0 for p in peakels))
+
+
+class TestPeakTable(unittest.TestCase):
+    ROWS = [['mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', 'npeaks', 's1', 's2', 's3'],
+            ['180.06', '180.05', '180.07', '60.2', '58.0', '62.0', '3', '10.0', '30.0', '20.0'],
+            ['181.06', '181.05', '181.07', '60.4', '58.0', '62.0', '3', '0.0', '0.0', '9.0'],
+            ['255.23', '255.22', '255.24', '300.1', '298.0', '302.0', '3', '5.0', '7.0', '6.0']]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = op.join(self.directory, 'peaklist.tsv')
+        with open(self.filepath, 'w') as f:
+            f.write('\n'.join('\t'.join(r) for r in self.ROWS) + '\n')
+        self.exp_settings = ExperimentalSettings(mz_tol_ppm=10.0, polarity=-1, is_dims_exp=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_peak_table(self):
+        table = PeakListReader(self.filepath, self.exp_settings).get_peak_table()
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.sample_names, ['s1', 's2', 's3'])
+        self.assertEqual(table.areas.shape, (3, 3))
+        # float32 areas shared by the peakels
+        self.assertEqual(table.areas.dtype, np.float32)
+        self.assertTrue(np.shares_memory(table.to_peakels()[0].area_matrix.values, table.areas))
+        self.assertAlmostEqual(table.moz[2], 255.23)
+        self.assertAlmostEqual(table.rtmax[0], 62.0)
+        # median, mean when median is null
+        self.assertAlmostEqual(table.area[0], 20.0)
+        self.assertAlmostEqual(table.area[1], 3.0)
+
+        row = table.row(2)
+        self.assertAlmostEqual(row.rt, 300.1)
+        self.assertEqual(list(row.areas), [5.0, 7.0, 6.0])
+
+    def test_get_peakels(self):
+        peakels = PeakListReader(self.filepath, self.exp_settings).get_peakels()
+        self.assertEqual(len(peakels), 3)
+        self.assertTrue(all(p.polarity == -1 for p in peakels))
+        self.assertEqual(peakels[0].area_by_sample_name, {'s1': 10.0, 's2': 30.0, 's3': 20.0})
+        self.assertAlmostEqual(peakels[1].area, 3.0)
+
+    def test_iter_peak_tables(self):
+        reader = PeakListReader(self.filepath, self.exp_settings)
+        chunks = list(reader.iter_peak_tables(chunk_size=1, overlap=1.5))
+        self.assertEqual(len(chunks), 3)
+        # first chunk owns the lowest moz, 181.06 is in the overlap
+        table, core = chunks[0]
+        self.assertEqual(list(table.row_ids), [0, 1])
+        self.assertEqual(list(core), [True, False])
+        # each row is owned by exactly one chunk
+        owned = sorted(i for t, c in chunks for i in t.row_ids[c])
+        self.assertEqual(owned, [0, 1, 2])
+
+    def test_iter_peakels(self):
+        reader = PeakListReader(self.filepath, self.exp_settings)
+        chunks = list(reader.iter_peakels(chunk_size=2, overlap=1.5, sort_by='rt'))
+        self.assertEqual(len(chunks), 2)
+        peakels, core = chunks[0]
+        self.assertEqual([p.id for p in core], [1, 2])
+        self.assertEqual([p.id for p in chunks[1][1]], [3])
+        # peakels created afterwards do not reuse the row ids
+        ones = np.ones(1)
+        table = PeakTable(ones, ones, ones, ones, ones, ones, np.ones((1, 1)), ['s1'], row_ids=np.array([10 ** 6]))
+        self.assertEqual([p.id for p in table.to_peakels()], [10 ** 6 + 1])
+        self.assertGreater(Peakel(100.0, 0.0, 0.0, 0.0).id, 10 ** 6 + 1)
+
+    def _write_quoted_peaklist(self):
+        """
+        3 molecules with an isotope and a water loss, BIO column holds tabs and newlines
+        """
+        rng = np.random.RandomState(0)
+        rows = [['mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', 'npeaks', 'BIO', 's1', 's2', 's3']]
+        for moz, rt in ((180.06339, 60.0), (300.1, 200.0), (450.2, 400.0)):
+            for m, ratio in ((moz, 1.0), (moz + 1.003355, 0.2), (moz - 18.01057 - 1e-6, 0.5)):
+                areas = [1e4 * ratio * x for x in rng.uniform(0.95, 1.05, 3) * [1.0, 3.0, 2.0]]
+                rows.append([str(v) for v in [m, m, m, rt + rng.uniform(-0.1, 0.1), 0, 0, 3]] +
+                            ['a\tb\nc'] + [str(v) for v in areas])
+        with open(self.filepath, 'w') as f:
+            csv.writer(f, delimiter='\t', lineterminator='\n').writerows(rows)
+
+    def test_iter_quoted_fields(self):
+        self._write_quoted_peaklist()
+        reader = PeakListReader(self.filepath, self.exp_settings)
+        table = reader.get_peak_table()
+        chunks = list(reader.iter_peak_tables(chunk_size=4, overlap=1.5))
+        moz = np.zeros(len(table))
+        for t, core in chunks:
+            moz[t.row_ids[core]] = t.moz[core]
+        self.assertTrue(np.array_equal(moz, table.moz))
+
+    def test_annotate_by_chunks(self):
+        self._write_quoted_peaklist()
+        reader = PeakListReader(self.filepath, self.exp_settings)
+
+        def get_state(peakels):
+            attribution = lambda a: None if a is None else (a.attribution, a.parent_id, a.charge)
+            return {p.id: (sorted(i.id for i in p.isotopes), sorted(i.id for i in p.adducts),
+                           attribution(p.main_attribution)) for p in peakels}
+
+        # same ids than the chunks peakels, i.e. the row numbers, ties are broken the same way
+        peakels = reader.get_peakels()
+        for i, p in enumerate(peakels):
+            p.id = i + 1
+        PeakelsAnnotator(peakels, self.exp_settings).annotate()
+        state = get_state(peakels)
+        self.assertEqual(state[1], ([2], [3], None))
+        # isotope and water loss are owned by other chunks than their parent
+        chunks = list(PeakelsAnnotator.annotate_by_chunks(reader.iter_peakels(chunk_size=1), self.exp_settings))
+        chunk_peakels = [p for chunk in chunks for p in chunk]
+        self.assertEqual(sorted(p.id for p in chunk_peakels), list(range(1, 10)))
+        self.assertEqual(get_state(chunk_peakels), state)
+        # relations link the yielded peakels, not copies
+        yielded = set(chunk_peakels)
+        self.assertTrue(all(i in yielded for p in chunk_peakels for i in p.isotopes | p.adducts))
+
+    def test_cache(self):
+        reader = PeakListReader(self.filepath, self.exp_settings, use_cache=True)
+        table = reader.get_peak_table()
+        self.assertTrue(op.exists(self.filepath + PeakListReader.CACHE_SUFFIX + PeakTable.HEADER_SUFFIX))
+
+        cached = reader.get_peak_table()
+        # memory-mapped, no copy
+        self.assertFalse(cached.areas.flags.owndata)
+        self.assertIsInstance(cached.areas, np.memmap)
+        self.assertFalse(cached.moz.flags.owndata)
+        peakels = cached.to_peakels()
+        self.assertTrue(np.shares_memory(peakels[0].area_matrix.values, cached.areas))
+        self.assertEqual(cached.sample_names, table.sample_names)
+        self.assertTrue(np.array_equal(cached.moz, table.moz))
+        self.assertTrue(np.array_equal(cached.area, table.area))
+        self.assertIsNone(cached.polarities)
+
+        # so does another selection of the samples columns
+        reader.directories = ['s3']
+        self.assertEqual(reader.get_peak_table().sample_names, ['s1', 's2'])
+        reader = PeakListReader(self.filepath, self.exp_settings, use_cache=True)
+        self.assertEqual(reader.get_peak_table().sample_names, ['s1', 's2', 's3'])
+
+        # modified peaklist invalidates the cache
+        with open(self.filepath, 'a') as f:
+            f.write('\t'.join(['300.1', '300.0', '300.2', '10.0', '9.0', '11.0', '3', '1.0', '2.0', '3.0']) + '\n')
+        self.assertEqual(len(reader.get_peak_table()), 4)
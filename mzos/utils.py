@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 import subprocess
 import logging
+import multiprocessing
+import numbers
 import os.path as op
 
 EMASS_PATH = [op.abspath("mzos/third_party/emass/emass"),
@@ -37,3 +39,15 @@ def calculate_mass_diff_da(feature, moz_metabolite, include_isotopes=False):
         return abs(feature.get_real_mass() - moz_metabolite)
     # TODO kind of rmsd but on masses ?
     return 0
+
+
+def get_nb_jobs(n_jobs):
+    """
+    :param n_jobs: positive number of jobs, -1 to use all the cpus
+    :return: number of jobs
+    """
+    if n_jobs == -1:
+        return multiprocessing.cpu_count()
+    if not isinstance(n_jobs, numbers.Integral) or n_jobs < 1:
+        raise ValueError("n_jobs must be a positive integer or -1 to use all the cpus, got {0}".format(n_jobs))
+    return n_jobs